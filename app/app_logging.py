@@ -1,14 +1,113 @@
+import atexit
+import json
 import logging
 import os
+import queue
+import random
 import sys
+from logging.handlers import QueueHandler, QueueListener
 
-from structlog import configure
+from structlog import configure, wrap_logger
+from structlog.exceptions import DropEvent
 from structlog.processors import JSONRenderer, TimeStamper
 from structlog.stdlib import add_log_level, filter_by_level
 
+from app import metrics
+from app.json_codec import orjson
+
+LOGGING_PROFILE = os.getenv("LOGGING_PROFILE", "standard")
+LOG_SUCCESS_SAMPLE_RATE = float(os.getenv("LOG_SUCCESS_SAMPLE_RATE", "0.01"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "0"))
+
+LOG_LINES_DROPPED = metrics.Counter('log_lines_dropped_total', 'Log lines dropped because the log queue was full')
+
+log_queue_listener = None
+
+# The lines logged for every successfully handled message, which the high throughput profile samples
+PER_MESSAGE_SUCCESS_EVENTS = frozenset(['Pub/Sub Message received for processing', 'Message processing complete'])
+
+
+def sample_success_lines(sample_rate, events=PER_MESSAGE_SUCCESS_EVENTS):
+    """
+    Build a processor which keeps only a share of the given per message success lines, all other lines (including
+    every warning and error) are kept
+
+    :param sample_rate: The share of success lines to keep, between 0 and 1
+    :param events: The log events to sample
+    """
+
+    def sampler(_1, _2, event_dict):
+        if event_dict.get('event') in events and random.random() >= sample_rate:
+            raise DropEvent
+        return event_dict
+
+    return sampler
+
+
+def orjson_serializer(event_dict, **_kwargs):
+    """
+    Render an event dict with orjson, falling back to the standard library for anything orjson cannot encode
+    """
+    try:
+        return orjson.dumps(event_dict, default=repr).decode('utf-8')
+    except TypeError:  # e.g. integers outside the 64 bit range orjson supports
+        return json.dumps(event_dict, default=repr)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Hands log records to a background writer thread through a bounded queue. When the queue is full the record is
+    dropped and counted, so a slow stdout never blocks the thread that logged it.
+    """
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_LINES_DROPPED.labels().inc()
+
+
+class _LogQueueListener(QueueListener):
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)  # wait for room, so everything queued before stopping is still written
+
+
+def start_log_queue(handler, queue_size=LOG_QUEUE_SIZE):
+    """
+    Route the root logger's records through a bounded queue to the given handler on a background writer thread
+
+    :param handler: The handler the writer thread emits records to, e.g. a StreamHandler on stdout
+    :param queue_size: The maximum number of records waiting to be written
+    """
+    global log_queue_listener
+    log_queue = queue.Queue(maxsize=queue_size)
+    log_queue_listener = _LogQueueListener(log_queue, handler)
+    root_logger = logging.getLogger()
+    root_logger.handlers = [DroppingQueueHandler(log_queue)]
+    log_queue_listener.start()
+    atexit.register(stop_log_queue)
+
+
+def stop_log_queue():
+    """
+    Write out every queued record and stop the writer thread, then log directly to its handler from then on
+    """
+    global log_queue_listener
+    if not log_queue_listener:
+        return
+    listener, log_queue_listener = log_queue_listener, None
+    listener.stop()
+    logging.getLogger().handlers = list(listener.handlers)
+    dropped = LOG_LINES_DROPPED.labels().get()
+    if dropped:
+        wrap_logger(logging.getLogger(__name__)).warning('Log lines dropped while the log queue was full',
+                                                         dropped=int(dropped))
+
 
 def logger_initial_config(
-    service_name=None, log_level=None, logger_format=None, logger_date_format=None
+    service_name=None, log_level=None, logger_format=None, logger_date_format=None, profile=None,
+    queue_size=None
 ):
 
     if not logger_date_format:
@@ -19,6 +118,10 @@ def logger_initial_config(
         logger_format = "%(message)s"
     if not service_name:
         service_name = os.getenv("NAME", "census-rm-pubsub")
+    if not profile:
+        profile = LOGGING_PROFILE
+    if queue_size is None:
+        queue_size = LOG_QUEUE_SIZE
     try:
         indent = int(os.getenv("JSON_INDENT_LOGGING"))
     except TypeError:
@@ -34,6 +137,26 @@ def logger_initial_config(
         return event_dict
 
     logging.basicConfig(stream=sys.stdout, level=log_level, format=logger_format)
+    if queue_size and not log_queue_listener:
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(logging.Formatter(logger_format))
+        start_log_queue(stream_handler, queue_size)
+
+    if profile == 'high_throughput':
+        # Cache each logger's processor chain on first use, drop most per message success lines before they are
+        # timestamped and rendered, and render with orjson when it is installed
+        configure(
+            processors=[
+                filter_by_level,
+                sample_success_lines(LOG_SUCCESS_SAMPLE_RATE),
+                add_log_level,
+                add_service,
+                TimeStamper(fmt=logger_date_format, utc=True, key="created_at"),
+                JSONRenderer(serializer=orjson_serializer) if orjson and not indent else JSONRenderer(indent=indent),
+            ],
+            cache_logger_on_first_use=True,
+        )
+        return
 
     configure(
         processors=[
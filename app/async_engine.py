@@ -0,0 +1,348 @@
+import asyncio
+import logging
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from time import monotonic
+
+from google.api_core.exceptions import DeadlineExceeded, GoogleAPICallError
+from structlog import wrap_logger
+
+from app import json_codec, metrics, quarantine
+from app.dedup import dedup_cache, dedup_key
+from app.pulled_message import PulledMessage
+from app.rabbit_helper import (RABBIT_EXCHANGE, RABBIT_HEARTBEAT, RABBIT_HOST, RABBIT_PASSWORD, RABBIT_PORT,
+                               RABBIT_USERNAME, RABBIT_VIRTUALHOST)
+from app.reject_cache import reject_cache
+from app.stage_timing import start_timer
+from app.subscriber import (LEASE_RENEWAL_MARGIN, MIN_ACK_DEADLINE, PULL_ACK_DEADLINE, PULL_RETRY_DELAY,
+                            PULL_RETRY_MAX_DELAY)
+from app.translators import TRANSLATORS, InvalidMessage
+
+try:
+    import aio_pika
+except ImportError:  # aio-pika is only needed for the asyncio run mode
+    aio_pika = None
+
+ASYNC_PULL_MAX_MESSAGES = int(os.getenv("ASYNC_PULL_MAX_MESSAGES", "100"))
+ASYNC_PULL_TIMEOUT = float(os.getenv("ASYNC_PULL_TIMEOUT", "30"))
+ASYNC_ACK_MAX_LATENCY_MS = float(os.getenv("ASYNC_ACK_MAX_LATENCY_MS", "100"))
+ACK_IDS_PER_REQUEST = 1000  # well within the Pub/Sub request size limit
+
+logger = wrap_logger(logging.getLogger(__name__))
+
+
+class AckBatcher:
+    """
+    Collects the ack IDs of a subscription's settled messages and sends them in batched acknowledge requests, and
+    the nacks in batched requests to redeliver them straight away, at most `max_latency_ms` after they settle.
+
+    Pulled messages are not leased as streaming pull leases them, so the batcher also extends the ack deadlines of
+    the leased messages still waiting for capacity or a confirm to PULL_ACK_DEADLINE before they could expire,
+    assuming the minimum subscription ack deadline at first, for at most `max_lease_duration` seconds.
+    """
+
+    def __init__(self, client, subscription_path, executor, max_latency_ms=ASYNC_ACK_MAX_LATENCY_MS,
+                 max_lease_duration=None):
+        self._client = client
+        self._subscription_path = subscription_path
+        self._executor = executor
+        self._max_latency = max_latency_ms / 1000
+        self._max_lease_duration = max_lease_duration
+        self._acks = deque()  # appended to by quarantine writes on the executor too, deques are thread safe
+        self._nacks = deque()
+        self._leases = {}  # ack ID: (monotonic time it was pulled, monotonic time its lease expires)
+        self._leases_lock = threading.Lock()
+
+    def lease(self, ack_ids, pulled_at):
+        with self._leases_lock:
+            for ack_id in ack_ids:
+                self._leases[ack_id] = (pulled_at, pulled_at + MIN_ACK_DEADLINE)
+
+    def ack(self, ack_id):
+        self._release(ack_id)
+        self._acks.append(ack_id)
+
+    def nack(self, ack_id):
+        self._release(ack_id)
+        self._nacks.append(ack_id)
+
+    def _release(self, ack_id):
+        with self._leases_lock:
+            self._leases.pop(ack_id, None)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self._max_latency)
+            await self.extend_leases()
+            await self.flush()
+
+    async def extend_leases(self):
+        """
+        Extend the ack deadlines of the leased messages whose leases are about to expire, dropping those held for
+        longer than the max lease duration so Pub/Sub redelivers them
+        """
+        now = monotonic()
+        due = deque()
+        with self._leases_lock:
+            for ack_id, (pulled_at, lease_expires) in list(self._leases.items()):
+                if self._max_lease_duration is not None and now - pulled_at >= self._max_lease_duration:
+                    del self._leases[ack_id]
+                elif lease_expires - LEASE_RENEWAL_MARGIN <= now:
+                    due.append(ack_id)
+                    self._leases[ack_id] = (pulled_at, now + PULL_ACK_DEADLINE)
+        for ack_ids in _take_batches(due):
+            await self._send('modify_ack_deadline', partial(self._client.modify_ack_deadline,
+                                                            subscription=self._subscription_path, ack_ids=ack_ids,
+                                                            ack_deadline_seconds=PULL_ACK_DEADLINE))
+
+    async def flush(self):
+        for ack_ids in _take_batches(self._acks):
+            await self._send('acknowledge', partial(self._client.acknowledge, subscription=self._subscription_path,
+                                                    ack_ids=ack_ids))
+        for ack_ids in _take_batches(self._nacks):
+            await self._send('modify_ack_deadline', partial(self._client.modify_ack_deadline,
+                                                            subscription=self._subscription_path, ack_ids=ack_ids,
+                                                            ack_deadline_seconds=0))
+
+    async def _send(self, name, request):
+        """
+        Send an acknowledge or modify ack deadline request. A failed request is logged rather than raised, so the
+        batcher keeps running; Pub/Sub redelivers its messages once their ack deadline passes.
+        """
+        try:
+            await asyncio.get_event_loop().run_in_executor(self._executor, request)
+        except Exception as e:
+            logger.error('Failed to send acks to Pub/Sub, the messages will be redelivered',
+                         subscription_path=self._subscription_path, request=name,
+                         ack_ids=len(request.keywords['ack_ids']), error=repr(e))
+
+
+def _take_batches(ack_ids):
+    while ack_ids:
+        batch = []
+        while ack_ids and len(batch) < ACK_IDS_PER_REQUEST:
+            batch.append(ack_ids.popleft())
+        yield batch
+
+
+class AsyncEngine:
+    """
+    Runs every subscription and the rabbitmq publisher on one event loop, as an alternative to the threaded
+    streaming pull callbacks and confirm publisher.
+
+    Each subscription has a pull loop, running the blocking pull calls on a small thread pool, which starts a task
+    per message. Tasks translate messages with the same translators, dedup cache and fast reject cache as
+    app.subscriber, publish the event with an async AMQP client and ack the Pub/Sub message once rabbitmq
+    confirms it. Pulling pauses while a subscription's flow control `max_messages` are in flight, and the ack
+    deadlines of pulled messages are extended until they are settled, see AckBatcher. Failed pulls are retried
+    with exponential backoff, as app.subscriber._pull_batches does.
+
+    :param publish: coroutine function publishing a message body with a routing key, returning once rabbitmq has
+                    confirmed it, see connect_publisher
+    """
+
+    def __init__(self, subscriptions, publish, client, max_messages=ASYNC_PULL_MAX_MESSAGES):
+        self._subscriptions = list(subscriptions)
+        self._publish = publish
+        self._client = client
+        self._max_messages = max_messages
+        self._executor = ThreadPoolExecutor(max_workers=2 * len(self._subscriptions) + 1,
+                                            thread_name_prefix='async-engine')
+        self._tasks = set()
+
+    async def run(self):
+        await asyncio.gather(*(self._pull_loop(subscription) for subscription in self._subscriptions))
+
+    async def _pull_loop(self, subscription):
+        subscription_path = self._client.subscription_path(subscription.subscription_project_id,
+                                                           subscription.subscription_name)
+        acks = AckBatcher(self._client, subscription_path, self._executor,
+                          max_lease_duration=subscription.flow_control.max_lease_duration)
+        capacity = asyncio.Semaphore(subscription.flow_control.max_messages)
+        ack_task = asyncio.ensure_future(acks.run())
+        logger.info('Pulling Pub/Sub Messages', subscription_path=subscription_path,
+                    max_messages=subscription.flow_control.max_messages)
+        retry_delay = PULL_RETRY_DELAY
+        try:
+            while True:
+                try:
+                    await self.pull(subscription, subscription_path, acks, capacity)
+                except GoogleAPICallError as e:
+                    logger.error('Pub/Sub pull request failed, retrying', subscription_path=subscription_path,
+                                 retry_delay=retry_delay, error=repr(e))
+                    await asyncio.sleep(retry_delay)
+                    retry_delay = min(retry_delay * 2, PULL_RETRY_MAX_DELAY)
+                    continue
+                retry_delay = PULL_RETRY_DELAY
+        finally:
+            ack_task.cancel()
+            await acks.flush()
+
+    async def pull(self, subscription, subscription_path, acks, capacity):
+        """
+        Pull a batch of messages and start a task handling each of them, waiting for capacity first. The messages are
+        leased as soon as they are pulled.
+
+        :raises: GoogleAPICallError if the pull request fails
+        """
+        try:
+            response = await asyncio.get_event_loop().run_in_executor(self._executor, partial(
+                self._client.pull, subscription=subscription_path, max_messages=self._max_messages,
+                timeout=ASYNC_PULL_TIMEOUT))
+        except DeadlineExceeded:
+            return  # nothing to pull
+        acks.lease([received_message.ack_id for received_message in response.received_messages], monotonic())
+        for received_message in response.received_messages:
+            await capacity.acquire()
+            task = asyncio.ensure_future(self.handle(subscription, PulledMessage(received_message, acks)))
+            self._tasks.add(task)
+            task.add_done_callback(partial(self._on_done, capacity))
+
+    def _on_done(self, capacity, task):
+        self._tasks.discard(task)
+        capacity.release()
+        if not task.cancelled() and task.exception():
+            logger.error('Unexpected error handling Pub/Sub Message', error=repr(task.exception()))
+
+    async def handle(self, subscription, message):
+        """
+        The asyncio counterpart of app.subscriber.process_message
+        """
+        subscription_name = subscription.subscription_name
+        started = monotonic()
+        metrics.MESSAGES_RECEIVED.labels(subscription_name).inc()
+        if reject_cache.fast_reject(subscription, message):
+            return
+        metrics.HANDLERS_IN_FLIGHT.labels(subscription_name).inc()
+        timer = start_timer(subscription_name)
+        try:
+            log = logger.bind(message_id=message.message_id,
+                              subscription_name=subscription_name,
+                              subscription_project=subscription.subscription_project_id)
+            getattr(log, subscription.log_level)('Pub/Sub Message received for processing')
+            timer.mark('log')
+
+            try:
+                event_message, log = TRANSLATORS[subscription.translator](message, log, timer)
+            except InvalidMessage as e:
+                metrics.VALIDATION_FAILURES.labels(subscription_name, e.reason).inc()
+                reject_cache.add(subscription.key, message, e.reason)
+                if await self._quarantine(subscription, message, e.reason, log):  # acked once quarantined
+                    reject_cache.set_quarantined(subscription.key, message)
+                timer.record(log)
+                return  # Failed validation
+
+            key = dedup_key(event_message)
+            if dedup_cache.is_duplicate(key):
+                getattr(log, subscription.log_level)('Duplicate of an already published message, acking')
+                self._ack(subscription_name, message)
+                timer.record(log)
+                return
+
+            body = json_codec.dumps(event_message)
+            timer.mark('serialise')
+            published = await self._publish_confirmed(subscription_name, message, body, subscription.routing_key, log)
+            timer.mark('publish')
+            if not published:
+                return
+            dedup_cache.add(key)
+
+            getattr(log, subscription.log_level)('Message processing complete')
+            timer.mark('log')
+            timer.record(log)
+        finally:
+            metrics.HANDLERS_IN_FLIGHT.labels(subscription_name).dec()
+            metrics.HANDLER_DURATION.labels(subscription_name).observe(monotonic() - started)
+
+    async def _publish_confirmed(self, subscription_name, message, body, routing_key, log):
+        """
+        Publish the body, then ack the message once rabbitmq confirms it or nack it if the publish fails
+
+        :return: whether the publish was confirmed
+        """
+        published_at = monotonic()
+        try:
+            await self._publish(body, routing_key)
+        except Exception as e:
+            log.error('Failed to publish message to rabbitmq, nacking', error=repr(e))
+            metrics.MESSAGES_NACKED.labels(subscription_name).inc()
+            message.nack()
+            return False
+        metrics.PUBLISH_LATENCY.labels(subscription_name).observe(monotonic() - published_at)
+        self._ack(subscription_name, message)
+        return True
+
+    @staticmethod
+    def _ack(subscription_name, message):
+        metrics.MESSAGES_ACKED.labels(subscription_name).inc()
+        message.ack()
+
+    async def _quarantine(self, subscription, message, reason, log):
+        """
+        Quarantine an invalid message as app.quarantine.quarantine_message does, publishing with the async client
+
+        :return: whether the message was quarantined
+        """
+        if quarantine.QUARANTINE_ROUTING_KEY:
+            body = json_codec.dumps(quarantine.quarantine_record(subscription, message, reason))
+            return await self._publish_confirmed(subscription.subscription_name, message, body,
+                                                 quarantine.QUARANTINE_ROUTING_KEY, log)
+        if not quarantine.quarantine_store:
+            return False
+        return await asyncio.get_event_loop().run_in_executor(self._executor, partial(
+            quarantine.quarantine_message, subscription, message, reason, log, routing_key=None))
+
+    async def close(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._executor.shutdown(wait=False)
+
+
+async def connect_publisher(exchange_name=RABBIT_EXCHANGE):
+    """
+    Connect to rabbitmq with aio-pika, on a channel with publisher confirms
+
+    :return: the connection and a coroutine function publishing a message body with a routing key, which returns
+             once rabbitmq has confirmed the publish and raises if it is rejected
+    """
+    if aio_pika is None:
+        raise RuntimeError('The asyncio run mode needs aio-pika, install it with `pipenv install`')
+    connection = await aio_pika.connect_robust(host=RABBIT_HOST, port=int(RABBIT_PORT), login=RABBIT_USERNAME,
+                                               password=RABBIT_PASSWORD, virtualhost=RABBIT_VIRTUALHOST,
+                                               heartbeat=RABBIT_HEARTBEAT)
+    channel = await connection.channel(publisher_confirms=True)
+    exchange = await channel.get_exchange(exchange_name, ensure=False)
+    logger.info('Successfully initialised rabbitmq', exchange=exchange_name)
+
+    async def publish(body, routing_key):
+        await exchange.publish(aio_pika.Message(body, content_type='application/json',
+                                                delivery_mode=aio_pika.DeliveryMode.PERSISTENT),
+                               routing_key=routing_key)
+
+    return connection, publish
+
+
+async def _run(subscriptions, client, readiness):
+    connection, publish = await connect_publisher()
+    engine = AsyncEngine(subscriptions, publish, client)
+    try:
+        with readiness:
+            await engine.run()
+    finally:
+        await engine.close()
+        await connection.close()
+
+
+def run_async_engine(subscriptions, client, readiness):
+    """
+    Run the subscriptions on the asyncio engine until one of their pull loops fails
+
+    :param subscriptions: the Subscriptions to listen on
+    :param client: a SubscriberClient
+    :param readiness: the Readiness to hold once rabbitmq is connected
+    """
+    asyncio.get_event_loop().run_until_complete(_run(subscriptions, client, readiness))
@@ -0,0 +1,101 @@
+import logging
+import os
+import threading
+
+from structlog import wrap_logger
+
+from app import metrics
+
+PUBLISH_LATENCY_THRESHOLD_MS = float(os.getenv("PUBLISH_LATENCY_THRESHOLD_MS", "2000"))
+
+CONNECTION_BLOCKED = 'connection_blocked'
+DISCONNECTED = 'disconnected'
+PUBLISH_LATENCY = 'publish_latency'
+
+BACKPRESSURE = metrics.Gauge('rabbitmq_backpressure', '1 while message callbacks are paused by rabbitmq backpressure',
+                             ['cause'])
+
+logger = wrap_logger(logging.getLogger(__name__))
+
+
+class Backpressure:
+    """
+    Tracks whether rabbitmq is pushing back, because it has blocked the publisher's connection (on a memory or disk
+    alarm), because the publisher has lost its connection, or because its smoothed publish confirm latency is over a
+    threshold, and holds the message callbacks until it recovers.
+
+    Held callbacks keep their messages outstanding, so once each subscription's flow control limit is reached the
+    subscriber client stops pulling until the callbacks are released. In flight messages and memory stay bounded
+    by the flow control settings.
+    """
+
+    def __init__(self, latency_threshold_ms=PUBLISH_LATENCY_THRESHOLD_MS, smoothing=0.2):
+        self._latency_threshold = latency_threshold_ms / 1000
+        self._smoothing = smoothing
+        self._smoothed_latency = None
+        self._causes = set()
+        self._lock = threading.Lock()
+        self._clear = threading.Event()
+        self._clear.set()
+
+    @property
+    def paused(self):
+        return not self._clear.is_set()
+
+    def wait_until_clear(self, timeout=None):
+        """
+        Block while rabbitmq is pushing back
+
+        :return: whether the backpressure has cleared
+        """
+        return self._clear.wait(timeout)
+
+    def set_cause(self, cause, active):
+        with self._lock:
+            if active == (cause in self._causes):
+                return
+            if active:
+                self._causes.add(cause)
+                self._clear.clear()
+                logger.warning('Pausing message processing on rabbitmq backpressure', cause=cause)
+            else:
+                self._causes.discard(cause)
+                logger.info('Rabbitmq backpressure cleared', cause=cause)
+                if not self._causes:
+                    self._clear.set()
+                    logger.info('Resuming message processing')
+        BACKPRESSURE.labels(cause).set(1 if active else 0)
+
+    def on_connection_blocked(self, *_args):
+        self.set_cause(CONNECTION_BLOCKED, True)
+
+    def on_connection_unblocked(self, *_args):
+        self.set_cause(CONNECTION_BLOCKED, False)
+
+    def on_disconnected(self):
+        self.set_cause(DISCONNECTED, True)
+
+    def on_connected(self):
+        self.set_cause(DISCONNECTED, False)
+
+    def observe_publish_latency(self, latency):
+        """
+        :param latency: seconds from publishing a message until rabbitmq confirmed it
+        """
+        if not self._latency_threshold:
+            return
+        if self._smoothed_latency is None:
+            self._smoothed_latency = latency
+        else:
+            self._smoothed_latency += self._smoothing * (latency - self._smoothed_latency)
+        self.set_cause(PUBLISH_LATENCY, self._smoothed_latency > self._latency_threshold)
+
+    def on_publishes_confirmed(self):
+        """
+        Called once nothing is awaiting a confirm, so slow confirms no longer hold back new messages
+        """
+        self._smoothed_latency = None
+        self.set_cause(PUBLISH_LATENCY, False)
+
+
+backpressure = Backpressure()
@@ -0,0 +1,65 @@
+import os
+from datetime import datetime, timezone
+from functools import lru_cache
+
+from rfc3339 import parse_datetime
+
+DATETIME_CACHE_SIZE = int(os.getenv("DATETIME_CACHE_SIZE", "1024"))
+
+OFFLINE_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+ASCII_DIGITS = frozenset('0123456789')
+
+
+def _has_fixed_fields(date_time):
+    """
+    :return: whether the string starts with a zero padded `YYYY-MM-DDTHH:MM:SS` of ASCII digits, which can be sliced
+             directly. int() alone would also take signs, spaces, underscores and non ASCII digits in the fields.
+    """
+    return (date_time[4] == '-' and date_time[7] == '-' and date_time[10] == 'T' and date_time[13] == ':'
+            and date_time[16] == ':'
+            and ASCII_DIGITS.issuperset(date_time[0:4] + date_time[5:7] + date_time[8:10] + date_time[11:13]
+                                        + date_time[14:16] + date_time[17:19]))
+
+
+@lru_cache(maxsize=DATETIME_CACHE_SIZE)
+def normalise_offline_datetime(date_time):
+    """
+    Parse a `%Y-%m-%dT%H:%M:%S` datetime string, assumed to be UTC, into an ISO 8601 string with UTC offset.
+    The common zero padded shape is sliced directly, anything else falls back to strptime so the accepted
+    inputs are unchanged.
+
+    :param date_time: the datetime string from the message
+    :return: the ISO 8601 datetime string, (e.g.: "2008-08-24T00:00:00+00:00")
+    :raises: ValueError if the string is not a valid datetime in the expected format
+    """
+    if len(date_time) == 19 and _has_fixed_fields(date_time):
+        try:
+            return datetime(int(date_time[0:4]), int(date_time[5:7]), int(date_time[8:10]),
+                            int(date_time[11:13]), int(date_time[14:16]), int(date_time[17:19]),
+                            tzinfo=timezone.utc).isoformat()
+        except ValueError:
+            pass
+    return datetime.strptime(date_time, OFFLINE_DATETIME_FORMAT).replace(tzinfo=timezone.utc).isoformat()
+
+
+@lru_cache(maxsize=DATETIME_CACHE_SIZE)
+def normalise_rfc3339_datetime(date_time):
+    """
+    Parse an RFC 3339 datetime string into an ISO 8601 string. UTC timestamps with a `Z` suffix, the shape GCS uses,
+    are sliced directly, anything else falls back to the full RFC 3339 parser.
+
+    :param date_time: the datetime string from the message
+    :return: the ISO 8601 datetime string, (e.g.: "2008-08-24T00:00:00+00:00")
+    :raises: ValueError if the string is not a valid RFC 3339 datetime
+    """
+    if (len(date_time) >= 20 and date_time[-1] == 'Z' and _has_fixed_fields(date_time)
+            and (len(date_time) == 20 or date_time[19] == '.' and len(date_time) > 21
+                 and ASCII_DIGITS.issuperset(date_time[20:-1]))):
+        try:
+            microsecond = int(float('0.' + date_time[20:-1]) * 1000000 + 0.5) if len(date_time) > 20 else 0
+            return datetime(int(date_time[0:4]), int(date_time[5:7]), int(date_time[8:10]),
+                            int(date_time[11:13]), int(date_time[14:16]), int(date_time[17:19]), microsecond,
+                            tzinfo=timezone.utc).isoformat()
+        except ValueError:
+            pass
+    return parse_datetime(date_time).isoformat()
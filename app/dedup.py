@@ -0,0 +1,122 @@
+import atexit
+import os
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+from app import metrics
+from app.dedup_index import DEDUP_INDEX_FILE, DedupIndex
+
+DEDUP_CACHE_SIZE = int(os.getenv("DEDUP_CACHE_SIZE", "100000"))
+DEDUP_CACHE_TTL = float(os.getenv("DEDUP_CACHE_TTL", "3600"))
+
+DEDUP_HITS = metrics.Counter('dedup_cache_hits_total', 'Messages found to be duplicates of a published event')
+DEDUP_MISSES = metrics.Counter('dedup_cache_misses_total', 'Messages not found in the dedup cache')
+DEDUP_EVICTIONS = metrics.Counter('dedup_cache_evictions_total', 'Entries removed from the dedup cache', ['cause'])
+DEDUP_ENTRIES = metrics.Gauge('dedup_cache_entries', 'Published events remembered by the dedup cache')
+
+
+def dedup_key(event_message):
+    """
+    :param event_message: a translated event
+    :return: the key identifying the event for deduplication, its event type and transaction ID
+    """
+    event = event_message['event']
+    return event['type'], event['transactionId']
+
+
+class DedupCache:
+    """
+    Remembers the keys of recently published events, so Pub/Sub redeliveries of a message which has already been
+    published can be acked without publishing it again.
+
+    Holds at most `max_size` keys, evicting the least recently seen first, and forgets a key `ttl` seconds after it
+    was published. A key is only remembered once rabbitmq has confirmed its publish, so a message whose publish
+    failed is still published when it is redelivered. At most `max_size` messages awaiting confirms are tracked,
+    forgetting the oldest first, so a message which never settles cannot leak.
+
+    Keys can also be written through to an on disk DedupIndex, which is consulted on a cache miss, so duplicates
+    are still caught after a restart.
+    """
+
+    def __init__(self, max_size=DEDUP_CACHE_SIZE, ttl=DEDUP_CACHE_TTL, index=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.index = index
+        self._entries = OrderedDict()  # key: expiry time
+        self._pending = OrderedDict()  # message ID: key, for messages published but not yet confirmed
+        self._lock = threading.Lock()
+
+    def is_duplicate(self, key):
+        if not self.max_size:
+            return False
+        with self._lock:
+            expiry = self._entries.get(key)
+            if expiry is not None and expiry < monotonic():
+                del self._entries[key]
+                DEDUP_EVICTIONS.labels('expired').inc()
+                expiry = None
+            if expiry is not None:
+                self._entries.move_to_end(key)
+        if expiry is None and not (self.index and self.index.contains(key)):
+            DEDUP_MISSES.labels().inc()
+            return False
+        DEDUP_HITS.labels().inc()
+        return True
+
+    def add(self, key):
+        if not self.max_size:
+            return
+        if self.index:
+            self.index.add(key)
+        with self._lock:
+            self._entries[key] = monotonic() + self.ttl
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                DEDUP_EVICTIONS.labels('size').inc()
+            DEDUP_ENTRIES.labels().set(len(self._entries))
+
+    def track(self, message, key):
+        """
+        Remember the key once the publish of the message is confirmed, see on_settled
+        """
+        if not self.max_size:
+            return
+        with self._lock:
+            self._pending[message.message_id] = key
+            while len(self._pending) > self.max_size:
+                self._pending.popitem(last=False)
+
+    def untrack(self, message):
+        """
+        Forget a tracked message which will not be published after all
+        """
+        with self._lock:
+            self._pending.pop(message.message_id, None)
+
+    def on_settled(self, message, acked):
+        """
+        Publisher settle listener, adding the key of a tracked message to the cache when its publish is confirmed
+        """
+        with self._lock:
+            key = self._pending.pop(message.message_id, None)
+        if key is not None and acked:
+            self.add(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+dedup_cache = DedupCache()
+
+
+def init_dedup_index(path=DEDUP_INDEX_FILE):
+    """
+    Open the on disk dedup index behind the dedup cache, if a path for it is configured
+    """
+    if not path or not dedup_cache.max_size:
+        return
+    dedup_cache.index = DedupIndex(path)
+    dedup_cache.index.start()
+    atexit.register(dedup_cache.index.stop)
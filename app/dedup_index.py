@@ -0,0 +1,152 @@
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from time import monotonic, time
+
+from structlog import wrap_logger
+
+from app import metrics
+
+DEDUP_INDEX_FILE = os.getenv("DEDUP_INDEX_FILE")
+DEDUP_INDEX_TTL = float(os.getenv("DEDUP_INDEX_TTL", "86400"))
+DEDUP_INDEX_MAX_BYTES = int(os.getenv("DEDUP_INDEX_MAX_BYTES", str(256 * 1024 * 1024)))
+DEDUP_INDEX_COMPACT_INTERVAL = float(os.getenv("DEDUP_INDEX_COMPACT_INTERVAL", "300"))
+DEDUP_INDEX_BATCH_SIZE = 500
+
+DEDUP_INDEX_HITS = metrics.Counter('dedup_index_hits_total', 'Duplicates only found in the on disk dedup index')
+DEDUP_INDEX_DROPPED = metrics.Counter('dedup_index_writes_dropped_total',
+                                      'Keys not written to the on disk dedup index because its write queue was full')
+DEDUP_INDEX_BYTES = metrics.Gauge('dedup_index_bytes', 'Size of the on disk dedup index')
+
+logger = wrap_logger(logging.getLogger(__name__))
+
+
+class DedupIndex:
+    """
+    An on disk index of the keys of published events, in an SQLite database, so duplicate suppression survives a
+    restart. Lookups are a primary key read. Writes are queued and committed in batches by a background thread, which
+    also compacts the index: keys older than `ttl` seconds are deleted and, if the database grows past `max_bytes`,
+    the oldest keys are deleted until it fits.
+    """
+    _STOP = object()
+
+    def __init__(self, path, ttl=DEDUP_INDEX_TTL, max_bytes=DEDUP_INDEX_MAX_BYTES,
+                 compact_interval=DEDUP_INDEX_COMPACT_INTERVAL, queue_size=10000):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._compact_interval = compact_interval
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._read_connection = None
+        self._read_lock = threading.Lock()
+        self._thread = None
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def start(self):
+        write_connection = self._connect()
+        write_connection.execute('CREATE TABLE IF NOT EXISTS published ('
+                                 'event_type TEXT NOT NULL, transaction_id TEXT NOT NULL, published_at REAL NOT NULL, '
+                                 'PRIMARY KEY (event_type, transaction_id)) WITHOUT ROWID')
+        write_connection.execute('CREATE INDEX IF NOT EXISTS published_at_index ON published (published_at)')
+        write_connection.commit()
+        self._read_connection = self._connect()
+        self.compact(write_connection)
+        self._thread = threading.Thread(target=self._run, args=(write_connection,), name='dedup-index-writer',
+                                        daemon=True)
+        self._thread.start()
+        logger.info('Opened dedup index', path=self.path, size_bytes=self.size_bytes(write_connection))
+
+    def stop(self, timeout=None):
+        """
+        Write any queued keys and close the index
+        """
+        if not self._thread:
+            return
+        self._queue.put(self._STOP)
+        self._thread.join(timeout)
+        self._thread = None
+        self._read_connection.close()
+
+    def contains(self, key):
+        event_type, transaction_id = key
+        with self._read_lock:
+            row = self._read_connection.execute(
+                'SELECT published_at FROM published WHERE event_type = ? AND transaction_id = ?',
+                (event_type, str(transaction_id))).fetchone()
+        if row is None or row[0] < time() - self.ttl:
+            return False
+        DEDUP_INDEX_HITS.labels().inc()
+        return True
+
+    def add(self, key):
+        """
+        Queue a key to be written, dropping it rather than blocking if the writer has fallen behind
+        """
+        event_type, transaction_id = key
+        try:
+            self._queue.put_nowait((event_type, str(transaction_id), time()))
+        except queue.Full:
+            DEDUP_INDEX_DROPPED.labels().inc()
+
+    def _run(self, connection):
+        next_compaction = monotonic() + self._compact_interval
+        stopping = False
+        while not stopping:
+            try:
+                rows = [self._queue.get(timeout=max(next_compaction - monotonic(), 0))]
+            except queue.Empty:
+                rows = []
+            while rows and len(rows) < DEDUP_INDEX_BATCH_SIZE:
+                try:
+                    rows.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if self._STOP in rows:
+                rows.remove(self._STOP)
+                stopping = True
+            try:
+                if rows:
+                    connection.executemany('INSERT OR REPLACE INTO published VALUES (?, ?, ?)', rows)
+                    connection.commit()
+                if monotonic() >= next_compaction:
+                    self.compact(connection)
+                    next_compaction = monotonic() + self._compact_interval
+            except sqlite3.Error as e:
+                logger.error('Failed to write dedup index', error=repr(e))
+        connection.close()
+
+    def compact(self, connection):
+        """
+        Delete expired keys, then while the database is over its disk budget delete the oldest keys, aiming for 90% of
+        the budget, and rebuild it to return the space to the file system
+        """
+        connection.execute('DELETE FROM published WHERE published_at < ?', (time() - self.ttl,))
+        connection.commit()
+        size_bytes = self.size_bytes(connection)
+        while size_bytes > self.max_bytes:
+            count = connection.execute('SELECT COUNT(*) FROM published').fetchone()[0]
+            if not count:
+                break
+            delete = max(count - int(count * 0.9 * self.max_bytes / size_bytes), 1)
+            connection.execute('DELETE FROM published WHERE (event_type, transaction_id) IN '
+                               '(SELECT event_type, transaction_id FROM published ORDER BY published_at LIMIT ?)',
+                               (delete,))
+            connection.commit()
+            connection.execute('VACUUM')
+            size_bytes = self.size_bytes(connection)
+            logger.info('Compacted dedup index to fit its disk budget', deleted=delete, size_bytes=size_bytes)
+        DEDUP_INDEX_BYTES.labels().set(size_bytes)
+
+    @staticmethod
+    def size_bytes(connection):
+        page_count = connection.execute('PRAGMA page_count').fetchone()[0]
+        freelist_count = connection.execute('PRAGMA freelist_count').fetchone()[0]
+        page_size = connection.execute('PRAGMA page_size').fetchone()[0]
+        return (page_count - freelist_count) * page_size
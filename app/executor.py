@@ -0,0 +1,70 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
+
+from app import metrics
+
+DEFAULT_EXECUTOR_THREADS = 10
+
+executors = {}
+
+
+class SubscriptionExecutor(ThreadPoolExecutor):
+    """
+    A thread pool dedicated to the callbacks of a single subscription, which keeps track of how many of its threads
+    are busy so that its utilisation and queue depth can be reported.
+    """
+
+    def __init__(self, subscription_name, max_workers=DEFAULT_EXECUTOR_THREADS):
+        super().__init__(max_workers=max_workers, thread_name_prefix=f'{subscription_name}-callback')
+        self.subscription_name = subscription_name
+        self._active = 0
+        self._active_lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        # Keep the message as the first work item arg, the scheduler relies on it to nack queued work on shutdown
+        return super().submit(partial(self._run_tracked, fn), *args, **kwargs)
+
+    def _run_tracked(self, fn, *args, **kwargs):
+        with self._active_lock:
+            self._active += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._active_lock:
+                self._active -= 1
+
+    def stats(self):
+        return {
+            'max_workers': self._max_workers,
+            'active_workers': self._active,
+            'utilisation': self._active / self._max_workers,
+            'queue_depth': self._work_queue.qsize(),
+        }
+
+
+def create_scheduler(subscription_name, max_workers=DEFAULT_EXECUTOR_THREADS):
+    """
+    Create a callback scheduler for a subscription backed by its own sized thread pool, so a flood of messages on
+    one subscription cannot starve the callbacks of another. The pool's size, busy threads and queue depth are
+    exported as gauges, read when the metrics are scraped.
+
+    :param subscription_name: The name of the pubsub subscription the scheduler is for
+    :param max_workers: The number of callback threads for the subscription
+    :return: a ThreadScheduler to pass to the subscribe call
+    """
+    executor = SubscriptionExecutor(subscription_name, max_workers)
+    executors[subscription_name] = executor
+    metrics.EXECUTOR_THREADS.labels(subscription_name).set_function(lambda: executor.stats()['max_workers'])
+    metrics.EXECUTOR_ACTIVE_THREADS.labels(subscription_name).set_function(lambda: executor.stats()['active_workers'])
+    metrics.EXECUTOR_QUEUE_DEPTH.labels(subscription_name).set_function(lambda: executor.stats()['queue_depth'])
+    return ThreadScheduler(executor=executor)
+
+
+def executor_stats():
+    """
+    :return: utilisation and queue depth of each subscription's callback thread pool, keyed by subscription name
+    """
+    return {subscription_name: executor.stats() for subscription_name, executor in executors.items()}
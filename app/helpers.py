@@ -0,0 +1,69 @@
+import json
+import os
+import threading
+
+# Set by the command line tools before the app modules read them, unless overridden
+MAX_THROUGHPUT_SETTINGS = {
+    'LOGGING_PROFILE': 'high_throughput',
+    'LOG_QUEUE_SIZE': '10000',
+    'RABBIT_MAX_IN_FLIGHT': '10000',
+}
+
+
+def use_max_throughput_settings(**settings):
+    """
+    Default the environment to the maximum throughput settings, and any others given, unless they are already set.
+    Must be called before the app modules which read them are imported.
+    """
+    for name, value in dict(MAX_THROUGHPUT_SETTINGS, **settings).items():
+        os.environ.setdefault(name, value)
+
+
+class ConfirmBatch:
+    """
+    Counts a batch of published messages as rabbitmq confirms or rejects each of them, so the publishing thread can
+    wait for the whole batch to be settled
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._unsettled = size
+        self._lock = threading.Lock()
+        self.all_acked = True
+        self.settled = threading.Event()
+        if not size:
+            self.settled.set()
+
+    def settle(self, acked):
+        with self._lock:
+            self.all_acked = self.all_acked and acked
+            self._unsettled -= 1
+            if not self._unsettled:
+                self.settled.set()
+
+
+def write_checkpoint(path, checkpoint):
+    """
+    Atomically replace the checkpoint file with the JSON checkpoint, fsynced so it survives a crash
+    """
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_path, path)
+
+
+def select_subscriptions(subscriptions, names):
+    """
+    :param subscriptions: the subscription registry
+    :param names: subscription keys or Pub/Sub subscription names
+    :return: the selected Subscriptions
+    :raises: KeyError for a name which is not in the registry
+    """
+    by_name = {subscription.subscription_name: subscription for subscription in subscriptions.values()}
+    return [subscriptions[name] if name in subscriptions else by_name[name] for name in names]
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
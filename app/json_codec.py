@@ -0,0 +1,52 @@
+import json
+import os
+
+try:
+    import orjson
+except ImportError:  # orjson is an optional speed up, the standard library is used without it
+    orjson = None
+
+JSON_CODEC = os.getenv("JSON_CODEC", "orjson" if orjson else "json")
+
+JSONDecodeError = json.JSONDecodeError  # orjson's decode error is a subclass, so this catches both
+
+
+def _orjson_loads(data):
+    """
+    Decode JSON straight from the raw bytes (or str) of a message
+
+    :raises: JSONDecodeError if the data is not valid JSON or not bytes or str
+    """
+    return orjson.loads(data)
+
+
+def _orjson_dumps(obj):
+    """
+    Encode an object as UTF-8 JSON bytes, ready to be used as a message body as is
+    """
+    try:
+        return orjson.dumps(obj)
+    except TypeError:  # e.g. integers outside the 64 bit range orjson supports
+        return _json_dumps(obj)
+
+
+def _json_loads(data):
+    """
+    Decode JSON straight from the raw bytes (or str) of a message
+
+    :raises: JSONDecodeError if the data is not valid JSON, TypeError if it is not bytes or str
+    """
+    return json.loads(data)
+
+
+def _json_dumps(obj):
+    """
+    Encode an object as UTF-8 JSON bytes, ready to be used as a message body as is
+    """
+    return json.dumps(obj).encode('utf-8')
+
+
+if JSON_CODEC == 'orjson' and orjson:
+    loads, dumps = _orjson_loads, _orjson_dumps
+else:
+    loads, dumps = _json_loads, _json_dumps
@@ -0,0 +1,250 @@
+import logging
+import os
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from structlog import wrap_logger
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "8000"))
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+logger = wrap_logger(logging.getLogger(__name__))
+
+registry = []
+
+
+class _Metric:
+    """
+    A metric family with a fixed set of label names. Each distinct set of label values gets its own child, which
+    is created once and then looked up by a single dict get, so recording a value costs a lock and an addition.
+    """
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._children_lock = threading.Lock()
+        registry.append(self)
+
+    def labels(self, *labelvalues):
+        child = self._children.get(labelvalues)
+        if child is None:
+            with self._children_lock:
+                child = self._children.setdefault(labelvalues, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _label_string(self, labelvalues, extra=()):
+        pairs = list(zip(self.labelnames, labelvalues)) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"') for _, value in pairs)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.metric_type}']
+        for labelvalues, child in list(self._children.items()):
+            lines.extend(self._render_child(labelvalues, child))
+        return lines
+
+    def _render_child(self, labelvalues, child):
+        return [f'{self.name}{self._label_string(labelvalues)} {child.get()}']
+
+
+class _Value:
+    def __init__(self):
+        self._value = 0.0
+        self._function = None
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self._value -= amount
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+    def set_function(self, function):
+        """
+        Read the value from the function each time the metrics are rendered, for state which is cheaper to read
+        when scraped than to keep up to date
+        """
+        self._function = function
+
+    def get(self):
+        return float(self._function()) if self._function else self._value
+
+
+class Counter(_Metric):
+    metric_type = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+
+class Gauge(_Metric):
+    metric_type = 'gauge'
+
+    def _new_child(self):
+        return _Value()
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def get(self):
+        with self._lock:
+            return list(self._counts), self._sum
+
+
+class Histogram(_Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def _render_child(self, labelvalues, child):
+        counts, total = child.get()
+        lines, cumulative = [], 0
+        for upper_bound, count in zip(list(self.buckets) + ['+Inf'], counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{self._label_string(labelvalues, [("le", upper_bound)])} {cumulative}')
+        lines.append(f'{self.name}_count{self._label_string(labelvalues)} {cumulative}')
+        lines.append(f'{self.name}_sum{self._label_string(labelvalues)} {total}')
+        return lines
+
+
+def render_metrics():
+    """
+    :return: every registered metric in the Prometheus text exposition format
+    """
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def combine_metrics(texts):
+    """
+    Combine the metrics of several processes, summing the samples with the same name and labels. Counters,
+    histograms and the gauges in this module are all additive across processes.
+
+    :param texts: metrics in the Prometheus text exposition format, as rendered by render_metrics
+    :return: the combined metrics in the same format, with each metric's samples kept together
+    """
+    families = {}  # metric name: (HELP and TYPE lines, {series: value})
+    for text in texts:
+        family = None
+        for line in text.splitlines():
+            if line.startswith('#'):
+                family = families.setdefault(line.split(' ', 3)[2], ([], {}))
+                if line not in family[0]:
+                    family[0].append(line)
+            elif line:
+                series, value = line.rsplit(' ', 1)
+                family[1][series] = family[1].get(series, 0.0) + float(value)
+    lines = []
+    for comments, samples in families.values():
+        lines.extend(comments)
+        lines.extend(f'{series} {value}' for series, value in samples.items())
+    return '\n'.join(lines) + '\n'
+
+
+def drop_gauges(text):
+    """
+    :param text: metrics in the Prometheus text exposition format, as rendered by render_metrics
+    :return: the metrics without their gauges, which describe a process's current state rather than its history
+    """
+    gauges = {line.split(' ', 3)[2] for line in text.splitlines()
+              if line.startswith('# TYPE ') and line.rsplit(' ', 1)[1] == 'gauge'}
+    lines, name = [], None
+    for line in text.splitlines():
+        if line.startswith('#'):
+            name = line.split(' ', 3)[2]
+        if line and name not in gauges:
+            lines.append(line)
+    return '\n'.join(lines) + '\n'
+
+
+MESSAGES_RECEIVED = Counter('pubsub_messages_received_total', 'Pub/Sub messages received by the callbacks',
+                            ['subscription'])
+MESSAGES_ACKED = Counter('pubsub_messages_acked_total', 'Pub/Sub messages acked', ['subscription'])
+MESSAGES_NACKED = Counter('pubsub_messages_nacked_total', 'Pub/Sub messages nacked for redelivery', ['subscription'])
+VALIDATION_FAILURES = Counter('pubsub_validation_failures_total', 'Pub/Sub messages which failed validation',
+                              ['subscription', 'reason'])
+HANDLER_DURATION = Histogram('pubsub_handler_duration_seconds', 'Time spent in the message callback',
+                             ['subscription'])
+HANDLERS_IN_FLIGHT = Gauge('pubsub_handlers_in_flight', 'Message callbacks currently running', ['subscription'])
+PUBLISH_LATENCY = Histogram('rabbitmq_publish_latency_seconds',
+                            'Time from publishing a message to rabbitmq until the broker confirms or rejects it',
+                            ['subscription'])
+PUBLISHES_UNCONFIRMED = Gauge('rabbitmq_publishes_unconfirmed', 'Messages published to rabbitmq awaiting confirm',
+                              ['subscription'])
+EXECUTOR_THREADS = Gauge('pubsub_executor_threads', 'Threads in the callback thread pool', ['subscription'])
+EXECUTOR_ACTIVE_THREADS = Gauge('pubsub_executor_active_threads', 'Callback threads currently running a message',
+                                ['subscription'])
+EXECUTOR_QUEUE_DEPTH = Gauge('pubsub_executor_queue_depth', 'Messages queued for a free callback thread',
+                             ['subscription'])
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass  # scrapes are not worth a log line each
+
+
+class _MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_metrics_server(port=METRICS_PORT, address='', render=render_metrics):
+    """
+    Serve the metrics at /metrics on a daemon thread
+
+    :param port: The port to listen on
+    :param address: The address to bind to, defaults to all interfaces
+    :param render: returns the metrics to serve, defaults to this process's registered metrics
+    :return: the running HTTPServer, so it can be shut down
+    """
+    server = _MetricsServer((address, port), _MetricsRequestHandler)
+    server.render = render
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logger.info('Serving metrics', port=server.server_address[1])
+    return server
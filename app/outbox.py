@@ -0,0 +1,278 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+from itertools import islice
+from time import monotonic
+
+from structlog import wrap_logger
+
+from app import metrics
+from app.helpers import ConfirmBatch, write_checkpoint
+from app.publisher import max_batch_size, publisher
+from app.stage_timing import NULL_TIMER
+
+OUTBOX_DIR = os.getenv("OUTBOX_DIR")
+OUTBOX_SEGMENT_BYTES = int(os.getenv("OUTBOX_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+OUTBOX_FSYNC_MAX_MESSAGES = int(os.getenv("OUTBOX_FSYNC_MAX_MESSAGES", "500"))
+OUTBOX_FSYNC_MAX_LATENCY_MS = float(os.getenv("OUTBOX_FSYNC_MAX_LATENCY_MS", "10"))
+OUTBOX_DRAIN_INTERVAL = float(os.getenv("OUTBOX_DRAIN_INTERVAL", "5"))
+OUTBOX_DRAIN_BATCH_SIZE = int(os.getenv("OUTBOX_DRAIN_BATCH_SIZE", "1000"))
+
+OUTBOX_JOURNALLED = metrics.Counter('outbox_messages_journalled_total',
+                                    'Messages written to the outbox journal while rabbitmq was unavailable')
+OUTBOX_DRAINED = metrics.Counter('outbox_messages_drained_total', 'Journalled messages confirmed by rabbitmq')
+OUTBOX_BACKLOG_BYTES = metrics.Gauge('outbox_backlog_bytes', 'Bytes of the outbox journal still to be drained')
+
+logger = wrap_logger(logging.getLogger(__name__))
+
+
+def segment_path(directory, segment):
+    return os.path.join(directory, f'journal-{segment:010}.log')
+
+
+def list_segments(directory):
+    return sorted(int(name[len('journal-'):-len('.log')]) for name in os.listdir(directory)
+                  if name.startswith('journal-') and name.endswith('.log'))
+
+
+class OutboxJournal:
+    """
+    An append only journal of translated messages, written while rabbitmq is unavailable so their Pub/Sub messages
+    can be acked instead of being redelivered over and over.
+
+    Appends are written by a single writer thread which fsyncs once per batch, then tells each message's callback
+    it is durably journalled. Each record is a line of `routing key<TAB>subscription name<TAB>body`. The journal is
+    split into numbered segment files so drained segments can be deleted.
+    """
+    _STOP = object()
+
+    def __init__(self, directory, segment_bytes=OUTBOX_SEGMENT_BYTES, max_messages=OUTBOX_FSYNC_MAX_MESSAGES,
+                 max_latency_ms=OUTBOX_FSYNC_MAX_LATENCY_MS):
+        self.directory = directory
+        self._segment_bytes = segment_bytes
+        self._max_messages = max_messages
+        self._max_latency = max_latency_ms / 1000
+        self._queue = queue.Queue()  # bounded by the confirm publisher's in flight limit
+        self._file = None
+        self._thread = None
+        self.active_segment = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        segments = list_segments(self.directory)
+        self._open_segment(segments[-1] + 1 if segments else 0)
+        self._thread = threading.Thread(target=self._run, name='outbox-journal-writer', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Write and fsync anything queued, then close the journal
+        """
+        if not self._thread:
+            return
+        self._queue.put(self._STOP)
+        self._thread.join(timeout)
+        self._thread = None
+        self._file.close()
+
+    def append(self, body, routing_key, subscription_name, on_journalled):
+        """
+        Queue a message to be journalled
+
+        :param body: the message body, UTF-8 JSON bytes
+        :param routing_key: the routing key to publish it with when drained
+        :param subscription_name: the subscription the message was received on
+        :param on_journalled: called with True once the message is durably journalled, or False if it could not be
+        """
+        self._queue.put((f'{routing_key}\t{subscription_name}\t'.encode('utf-8') + body + b'\n', on_journalled))
+
+    def _open_segment(self, segment):
+        if self._file:
+            self._file.close()
+        self.active_segment = segment
+        self._file = open(segment_path(self.directory, segment), 'ab')
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            if batch:
+                self._write(batch)
+
+    def _next_batch(self):
+        item = self._queue.get()
+        if item is self._STOP:
+            return [], True
+        batch = [item]
+        deadline = monotonic() + self._max_latency
+        while len(batch) < self._max_messages:
+            try:
+                item = self._queue.get(timeout=max(deadline - monotonic(), 0))
+            except queue.Empty:
+                break
+            if item is self._STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _write(self, batch):
+        try:
+            if self._file.tell() >= self._segment_bytes:
+                self._open_segment(self.active_segment + 1)
+            self._file.write(b''.join(record for record, _ in batch))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except OSError as e:
+            logger.error('Failed to write outbox journal', error=repr(e))
+            journalled = False
+        else:
+            OUTBOX_JOURNALLED.labels().inc(len(batch))
+            journalled = True
+        for _, on_journalled in batch:
+            on_journalled(journalled)
+
+
+class _JournalRecord:
+    """
+    Stands in for a Pub/Sub message when a journal record is published, so the confirm publisher can ack or nack it
+    """
+    message_id = None
+
+    def __init__(self, drain_batch):
+        self._drain_batch = drain_batch
+
+    def ack(self):
+        self._drain_batch.settle(True)
+
+    def nack(self):
+        self._drain_batch.settle(False)
+
+
+class OutboxDrainer:
+    """
+    Replays the outbox journal into rabbitmq through the confirm publisher whenever it is connected, remembering
+    how far it has got in a checkpoint file. The checkpoint only moves past a batch of records once rabbitmq has
+    confirmed every one of them, so a record may be published twice after a failure but is never lost. Segments
+    are deleted once fully drained.
+    """
+
+    def __init__(self, journal, confirm_publisher, interval=OUTBOX_DRAIN_INTERVAL,
+                 batch_size=OUTBOX_DRAIN_BATCH_SIZE):
+        self._journal = journal
+        self._confirm_publisher = confirm_publisher
+        self._interval = interval
+        self._batch_size = max_batch_size(batch_size, confirm_publisher)
+        self._checkpoint_path = os.path.join(journal.directory, 'checkpoint')
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='outbox-drainer', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def read_checkpoint(self):
+        try:
+            with open(self._checkpoint_path) as f:
+                checkpoint = json.load(f)
+            return checkpoint['segment'], checkpoint['offset']
+        except FileNotFoundError:
+            return 0, 0
+
+    def write_checkpoint(self, segment, offset):
+        write_checkpoint(self._checkpoint_path, {'segment': segment, 'offset': offset})
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            if self._confirm_publisher.wait_until_ready(0):
+                try:
+                    self.drain()
+                except OSError as e:
+                    logger.error('Failed to drain outbox journal', error=repr(e))
+
+    def drain(self):
+        """
+        Publish the journalled records after the checkpoint until the journal is drained or a publish fails
+
+        :return: whether the journal was fully drained
+        """
+        checkpoint_segment, offset = self.read_checkpoint()
+        for segment in list_segments(self._journal.directory):
+            if segment < checkpoint_segment:
+                os.remove(segment_path(self._journal.directory, segment))
+                continue
+            if segment > checkpoint_segment:
+                checkpoint_segment, offset = segment, 0
+            offset = self._drain_segment(segment, offset)
+            if offset is None:
+                return False
+            if segment != self._journal.active_segment:
+                self.write_checkpoint(segment + 1, 0)
+                os.remove(segment_path(self._journal.directory, segment))
+        OUTBOX_BACKLOG_BYTES.labels().set(0)
+        return True
+
+    def _drain_segment(self, segment, offset):
+        """
+        :return: the offset drained up to, or None if a publish failed
+        """
+        with open(segment_path(self._journal.directory, segment), 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            OUTBOX_BACKLOG_BYTES.labels().set(f.tell() - offset)
+            f.seek(offset)
+            while not self._stopped.is_set():
+                if not self._confirm_publisher.wait_until_ready(0):
+                    return None  # disconnected part way through, drain the rest once reconnected
+                lines = list(islice(f, self._batch_size))
+                if lines and not lines[-1].endswith(b'\n'):
+                    lines.pop()  # the writer is part way through this record, drain it next time
+                if not lines:
+                    return offset
+                if not self._publish_records(lines):
+                    logger.warning('Rabbitmq did not confirm drained outbox records, retrying later',
+                                   segment=segment, offset=offset)
+                    return None
+                offset += sum(len(line) for line in lines)
+                self.write_checkpoint(segment, offset)
+                f.seek(offset)
+        return None
+
+    def _publish_records(self, lines):
+        drain_batch = ConfirmBatch(len(lines))
+        batch = []
+        for line in lines:
+            routing_key, subscription_name, body = line.rstrip(b'\n').split(b'\t', 2)
+            batch.append((_JournalRecord(drain_batch), body, routing_key.decode('utf-8'),
+                          subscription_name.decode('utf-8'), NULL_TIMER))
+        self._confirm_publisher.publish_batch(batch, journal=False)
+        while not drain_batch.settled.wait(1):
+            if self._stopped.is_set():
+                return False
+        if drain_batch.all_acked:
+            OUTBOX_DRAINED.labels().inc(len(lines))
+        return drain_batch.all_acked
+
+
+def init_outbox(outbox_dir=OUTBOX_DIR):
+    """
+    Journal messages to the outbox while rabbitmq is unavailable and drain them once it is back, if an outbox
+    directory is configured
+    """
+    if not outbox_dir:
+        return
+    journal = OutboxJournal(outbox_dir)
+    journal.start()
+    publisher.outbox = journal
+    drainer = OutboxDrainer(journal, publisher)
+    drainer.start()
+    atexit.register(journal.stop, timeout=30)
+    atexit.register(drainer.stop, timeout=30)
+    logger.info('Outbox enabled', outbox_dir=outbox_dir)
@@ -0,0 +1,439 @@
+import logging
+import os
+import queue
+import threading
+from collections import OrderedDict
+from functools import partial
+from itertools import cycle
+from time import monotonic, perf_counter
+
+import pika
+from pika.adapters.select_connection import IOLoop
+from pika.exceptions import AMQPChannelError, AMQPConnectionError
+from pika.spec import Basic, PERSISTENT_DELIVERY_MODE
+from structlog import wrap_logger
+
+from app import metrics
+from app.backpressure import backpressure
+from app.rabbit_helper import RABBIT_EXCHANGE, RABBIT_POOL_SIZE, RABBIT_ROUTE, connection_parameters
+from app.stage_timing import NULL_TIMER
+
+RABBIT_MAX_IN_FLIGHT = int(os.getenv("RABBIT_MAX_IN_FLIGHT", "1000"))
+RABBIT_RECONNECT_DELAY = float(os.getenv("RABBIT_RECONNECT_DELAY", "5"))
+RABBIT_CONNECT_TIMEOUT = float(os.getenv("RABBIT_CONNECT_TIMEOUT", "30"))
+PUBLISH_QUEUE_SIZE = int(os.getenv("PUBLISH_QUEUE_SIZE", "10000"))
+PUBLISH_BATCH_MAX_MESSAGES = int(os.getenv("PUBLISH_BATCH_MAX_MESSAGES", "200"))
+PUBLISH_BATCH_MAX_BYTES = int(os.getenv("PUBLISH_BATCH_MAX_BYTES", str(1024 * 1024)))
+PUBLISH_BATCH_MAX_LATENCY_MS = float(os.getenv("PUBLISH_BATCH_MAX_LATENCY_MS", "5"))
+
+logger = wrap_logger(logging.getLogger(__name__))
+
+
+class ConfirmPublisher:
+    """
+    Publishes to rabbitmq with publisher confirms on a dedicated IO thread, keeping many publishes in flight.
+
+    Every publish is tracked against its delivery tag. The originating Pub/Sub message is acked when the broker
+    confirms the publish and nacked, so Pub/Sub will redeliver it, if the broker rejects it or the connection is
+    lost before it is confirmed.
+
+    The connection's blocked notifications and the publish confirm latency are reported to app.backpressure, which
+    holds the message callbacks while rabbitmq is pushing back. Losing or regaining the connection is reported to
+    `connection_listener`, called on the IO thread with the publisher, which by default holds the callbacks while
+    the publisher is disconnected and has no outbox.
+
+    If an outbox journal is set, see app.outbox, messages published while rabbitmq is unavailable are journalled
+    instead and their Pub/Sub messages acked once they are durably written.
+    """
+
+    def __init__(self, exchange_name=RABBIT_EXCHANGE, max_in_flight=RABBIT_MAX_IN_FLIGHT,
+                 reconnect_delay=RABBIT_RECONNECT_DELAY, connection_listener=None):
+        self._exchange_name = exchange_name
+        self._connection_listener = connection_listener or self._hold_callbacks_while_disconnected
+        self._reconnect_delay = reconnect_delay
+        self._properties = pika.BasicProperties(content_type='application/json',
+                                                delivery_mode=PERSISTENT_DELIVERY_MODE)
+        self.max_in_flight = max_in_flight
+        self._capacity = threading.BoundedSemaphore(max_in_flight)
+        self._settle_listeners = []
+        self.outbox = None
+        self._ready = threading.Event()
+        self._ioloop = None
+        self._thread = None
+        self._stopping = False
+
+        # Only touched on the IO thread
+        self._connection = None
+        self._channel = None
+        self._delivery_tag = 0
+        self._unconfirmed = OrderedDict()
+
+    def start(self):
+        self._stopping = False
+        self._ioloop = IOLoop()
+        self._thread = threading.Thread(target=self._run, name='rabbit-publisher', daemon=True)
+        self._thread.start()
+
+    def wait_until_ready(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    def stop(self, timeout=None):
+        self._stopping = True
+        self._ioloop.add_callback_threadsafe(self._close)
+        self._thread.join(timeout)
+
+    def add_settle_listener(self, listener):
+        """
+        :param listener: called on the IO thread with (Pub/Sub message, acked) as each publish is settled, before
+                         the message is acked or nacked
+        """
+        self._settle_listeners.append(listener)
+
+    def publish(self, message, body, routing_key=RABBIT_ROUTE, subscription_name=None, timer=NULL_TIMER):
+        """
+        Hand a message to the IO thread for publishing and return without waiting for the broker.
+        Blocks while the maximum number of unconfirmed messages are in flight.
+
+        :param message: the Pub/Sub message to ack or nack once the broker has responded
+        :param body: the message body to publish
+        :param routing_key: the routing key to publish with
+        :param subscription_name: the subscription the message was received on, to label its metrics
+        :param timer: the message's StageTimer, to time acking it once the broker has responded
+        """
+        self.publish_batch([(message, body, routing_key, subscription_name, timer)])
+
+    def publish_batch(self, batch, journal=True):
+        """
+        Hand a batch of messages to the IO thread to be published back to back on the channel, needing a single
+        wake up of the IO thread and usually a single multiple-ack from the broker to confirm the whole batch.
+
+        Messages which already have capacity are handed over before waiting for more, so a caller never holds
+        capacity while it waits and concurrent callers cannot deadlock each other, however large their batches.
+
+        :param batch: a list of (Pub/Sub message, body, routing key, subscription name, StageTimer) tuples
+        :param journal: whether to journal the messages to the outbox while disconnected, rather than nack them.
+                        False for records drained from the outbox, which must never be journalled again.
+        """
+        start = 0
+        for end in range(len(batch)):
+            if not self._capacity.acquire(blocking=False):
+                if end > start:
+                    self._ioloop.add_callback_threadsafe(partial(self._publish_batch, batch[start:end], journal))
+                    start = end
+                self._capacity.acquire()
+        if len(batch) > start:
+            self._ioloop.add_callback_threadsafe(partial(self._publish_batch, batch[start:], journal))
+
+    def _run(self):
+        self._connect()
+        self._ioloop.start()
+
+    def _connect(self):
+        if self._stopping:
+            return
+        logger.debug('Connecting confirm publisher to rabbitmq')
+        self._connection = pika.SelectConnection(connection_parameters(),
+                                                 on_open_callback=self._on_connection_open,
+                                                 on_open_error_callback=self._on_connection_open_error,
+                                                 on_close_callback=self._on_connection_closed,
+                                                 custom_ioloop=self._ioloop)
+        self._connection.add_on_connection_blocked_callback(backpressure.on_connection_blocked)
+        self._connection.add_on_connection_unblocked_callback(backpressure.on_connection_unblocked)
+
+    def _close(self):
+        if self._connection and self._connection.is_open:
+            self._connection.close()
+        else:
+            self._ioloop.stop()
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_open_error(self, _connection, error):
+        logger.error('Failed to connect confirm publisher to rabbitmq', error=repr(error))
+        self._ioloop.call_later(self._reconnect_delay, self._connect)
+
+    def _on_connection_closed(self, _connection, reason):
+        self._on_disconnect()
+        if self._stopping:
+            self._ioloop.stop()
+            return
+        logger.error('Confirm publisher lost rabbitmq connection, reconnecting', reason=repr(reason))
+        self._ioloop.call_later(self._reconnect_delay, self._connect)
+
+    def _on_channel_open(self, channel):
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.confirm_delivery(ack_nack_callback=self._on_delivery_confirmation,
+                                 callback=partial(self._on_confirm_select_ok, channel))
+
+    def _on_confirm_select_ok(self, channel, _frame):
+        self._channel = channel
+        self._delivery_tag = 0
+        self._ready.set()
+        self._connection_listener(self)
+        logger.info('Confirm publisher ready', exchange=self._exchange_name)
+
+    def _on_channel_closed(self, _channel, reason):
+        self._on_disconnect()
+        if not self._stopping and self._connection.is_open:
+            logger.error('Confirm publisher channel closed', reason=repr(reason))
+            self._connection.close()
+
+    def _on_disconnect(self):
+        self._ready.clear()
+        self._channel = None
+        unconfirmed, self._unconfirmed = self._unconfirmed, OrderedDict()
+        for message, subscription_name, published_at, timer in unconfirmed.values():
+            self._settle(message, acked=False, subscription_name=subscription_name, published_at=published_at,
+                         timer=timer)
+        backpressure.on_connection_unblocked()  # a new connection starts unblocked
+        backpressure.on_publishes_confirmed()
+        self._connection_listener(self)
+
+    def _hold_callbacks_while_disconnected(self, _publisher):
+        if self._ready.is_set():
+            backpressure.on_connected()
+        elif not self.outbox and not self._stopping:
+            backpressure.on_disconnected()  # rather than nack every message straight back to Pub/Sub
+
+    def _publish_batch(self, batch, journal=True):
+        for message, body, routing_key, subscription_name, timer in batch:
+            self._publish(message, body, routing_key, subscription_name, timer, journal)
+
+    def _publish(self, message, body, routing_key, subscription_name=None, timer=NULL_TIMER, journal=True):
+        if self._channel is None:
+            if self.outbox and journal:
+                self.outbox.append(body, routing_key, subscription_name,
+                                   partial(self._settle, message, subscription_name=subscription_name, timer=timer))
+                return
+            self._settle(message, acked=False, subscription_name=subscription_name, timer=timer)
+            return
+        try:
+            self._channel.basic_publish(self._exchange_name, routing_key, body, self._properties)
+        except (AMQPConnectionError, AMQPChannelError) as e:
+            logger.error('Failed to publish message to rabbitmq', error=repr(e))
+            self._settle(message, acked=False, subscription_name=subscription_name, timer=timer)
+            return
+        self._delivery_tag += 1
+        self._unconfirmed[self._delivery_tag] = (message, subscription_name, monotonic(), timer)
+        metrics.PUBLISHES_UNCONFIRMED.labels(subscription_name).inc()
+
+    def _on_delivery_confirmation(self, frame):
+        method = frame.method
+        acked = isinstance(method, Basic.Ack)
+        if method.multiple:
+            confirmed_tags = []
+            for delivery_tag in self._unconfirmed:
+                if delivery_tag > method.delivery_tag:
+                    break
+                confirmed_tags.append(delivery_tag)
+        else:
+            confirmed_tags = [method.delivery_tag]
+
+        if not acked:
+            logger.warning('Rabbitmq rejected published messages', delivery_tag=method.delivery_tag,
+                           multiple=method.multiple)
+        for delivery_tag in confirmed_tags:
+            unconfirmed = self._unconfirmed.pop(delivery_tag, None)
+            if unconfirmed is not None:
+                message, subscription_name, published_at, timer = unconfirmed
+                self._settle(message, acked, subscription_name, published_at, timer)
+        if not self._unconfirmed:
+            backpressure.on_publishes_confirmed()
+
+    def _settle(self, message, acked, subscription_name=None, published_at=None, timer=NULL_TIMER):
+        if published_at is not None:
+            latency = monotonic() - published_at
+            metrics.PUBLISH_LATENCY.labels(subscription_name).observe(latency)
+            backpressure.observe_publish_latency(latency)
+            metrics.PUBLISHES_UNCONFIRMED.labels(subscription_name).dec()
+        started = perf_counter() if timer.sampled else None
+        try:
+            for listener in self._settle_listeners:
+                try:
+                    listener(message, acked)
+                except Exception as e:
+                    logger.error('Publish settle listener failed', error=repr(e))
+            if acked:
+                metrics.MESSAGES_ACKED.labels(subscription_name).inc()
+                message.ack()
+            else:
+                metrics.MESSAGES_NACKED.labels(subscription_name).inc()
+                message.nack()
+        finally:
+            self._capacity.release()
+            if timer.sampled:
+                timer.observe('ack', perf_counter() - started)
+
+
+class PublisherPool:
+    """
+    A bounded pool of confirm publishers shared by the message handlers, each with its own connection and IO thread.
+    Each batch is handed to the next connected publisher in turn, so publishing is spread over `size` connections
+    and carries on over the others while one reconnects.
+
+    Messages are only journalled or nacked as by a disconnected ConfirmPublisher once every publisher in the pool
+    has lost its connection, and only then are the message callbacks held.
+    """
+
+    def __init__(self, size=RABBIT_POOL_SIZE, **kwargs):
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self._stopping = False
+        self.publishers = [ConfirmPublisher(connection_listener=self._on_connection_changed, **kwargs)
+                           for _ in range(size)]
+        self.max_in_flight = self.publishers[0].max_in_flight
+        self._next = cycle(self.publishers)
+
+    @property
+    def outbox(self):
+        return self.publishers[0].outbox
+
+    @outbox.setter
+    def outbox(self, outbox):
+        for confirm_publisher in self.publishers:
+            confirm_publisher.outbox = outbox
+
+    def start(self):
+        self._stopping = False
+        for confirm_publisher in self.publishers:
+            confirm_publisher.start()
+
+    def wait_until_ready(self, timeout=None):
+        """
+        :return: whether any publisher in the pool is ready
+        """
+        return self._ready.wait(timeout)
+
+    def stop(self, timeout=None):
+        self._stopping = True
+        for confirm_publisher in self.publishers:
+            confirm_publisher.stop(timeout)
+
+    def add_settle_listener(self, listener):
+        for confirm_publisher in self.publishers:
+            confirm_publisher.add_settle_listener(listener)
+
+    def publish_batch(self, batch, journal=True):
+        """
+        Publish the batch with the next connected publisher, see ConfirmPublisher.publish_batch
+        """
+        for _ in range(len(self.publishers)):
+            confirm_publisher = next(self._next)
+            if confirm_publisher.wait_until_ready(0):
+                break
+        confirm_publisher.publish_batch(batch, journal)
+
+    def _on_connection_changed(self, _publisher):
+        with self._lock:
+            if any(confirm_publisher.wait_until_ready(0) for confirm_publisher in self.publishers):
+                self._ready.set()
+                backpressure.on_connected()
+            else:
+                self._ready.clear()
+                if not self.outbox and not self._stopping:
+                    backpressure.on_disconnected()
+
+
+def max_batch_size(batch_size, *confirm_publishers):
+    """
+    :return: the batch size capped at the publishers' in flight limit, as a batch never needs more capacity than a
+             publisher has, see ConfirmPublisher.publish_batch
+    """
+    return min([batch_size] + [confirm_publisher.max_in_flight for confirm_publisher in confirm_publishers])
+
+
+class PublishBatcher:
+    """
+    Collects translated messages from the subscriber callbacks on a bounded queue and drains them on a dedicated
+    thread into batches for the confirm publisher.
+
+    A batch is handed over as soon as it reaches the maximum message count or size in bytes, or once its oldest
+    message has waited for the maximum latency, whichever comes first.
+    """
+    _STOP = object()
+
+    def __init__(self, confirm_publisher, max_messages=PUBLISH_BATCH_MAX_MESSAGES, max_bytes=PUBLISH_BATCH_MAX_BYTES,
+                 max_latency_ms=PUBLISH_BATCH_MAX_LATENCY_MS, queue_size=PUBLISH_QUEUE_SIZE):
+        self._confirm_publisher = confirm_publisher
+        self._max_messages = max_batch_size(max_messages, confirm_publisher)
+        self._max_bytes = max_bytes
+        self._max_latency = max_latency_ms / 1000
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='rabbit-publish-batcher', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Publish anything still queued and stop the batching thread
+        """
+        self._queue.put(self._STOP)
+        self._thread.join(timeout)
+
+    def submit(self, message, body, routing_key=RABBIT_ROUTE, subscription_name=None, timer=NULL_TIMER):
+        """
+        Queue a message for publishing, blocking while the queue is full
+        """
+        self._queue.put((message, body, routing_key, subscription_name, timer))
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            if batch:
+                self._confirm_publisher.publish_batch(batch)
+
+    def _next_batch(self):
+        """
+        Block for the first message then collect more until the batch is full or its latency budget is spent
+        :return: the batch and whether the batcher has been asked to stop
+        """
+        item = self._queue.get()
+        if item is self._STOP:
+            return [], True
+
+        batch, batch_bytes = [item], len(item[1])
+        deadline = monotonic() + self._max_latency
+        while len(batch) < self._max_messages and batch_bytes < self._max_bytes:
+            try:
+                item = self._queue.get(timeout=max(deadline - monotonic(), 0))
+            except queue.Empty:
+                break
+            if item is self._STOP:
+                return batch, True
+            batch.append(item)
+            batch_bytes += len(item[1])
+        return batch, False
+
+
+publisher = PublisherPool()
+publish_batcher = PublishBatcher(publisher)
+
+
+def init_publisher(timeout=RABBIT_CONNECT_TIMEOUT):
+    """
+    Start the pool of confirm publishers and the batching stage, waiting for a publisher's channel to be ready
+    :raises: AMQPConnectionError if no publisher is ready within the timeout and there is no outbox
+    """
+    publisher.start()
+    if not publisher.wait_until_ready(timeout):
+        if not publisher.outbox:
+            raise AMQPConnectionError('Timed out waiting for confirm publisher to connect to rabbitmq')
+        logger.warning('Confirm publisher not connected to rabbitmq, journalling messages to the outbox')
+    publish_batcher.start()
+
+
+def publish_message(message, body, routing_key=RABBIT_ROUTE, subscription_name=None, timer=NULL_TIMER):
+    """
+    Queue a message body to be published to rabbitmq, acking the Pub/Sub message once the broker confirms it
+
+    :param message: the Pub/Sub message the body was translated from
+    :param body: the message to send to the exchange in JSON format
+    :param routing_key: the routing key to publish with
+    :param subscription_name: the subscription the message was received on, to label its metrics
+    :param timer: the message's StageTimer, to time acking it once the broker confirms it
+    """
+    publish_batcher.submit(message, body, routing_key, subscription_name, timer)
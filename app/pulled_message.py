@@ -0,0 +1,21 @@
+class PulledMessage:
+    """
+    Adapts a message received by a synchronous pull to the interface of a streaming pull Message, so the
+    translators and process_message can handle it as is.
+
+    :param acks: records the ack IDs of the messages acked and nacked, to be sent in batched requests
+    """
+    __slots__ = ('ack_id', 'message_id', 'data', 'attributes', '_acks')
+
+    def __init__(self, received_message, acks):
+        self.ack_id = received_message.ack_id
+        self.message_id = received_message.message.message_id
+        self.data = received_message.message.data
+        self.attributes = received_message.message.attributes
+        self._acks = acks
+
+    def ack(self):
+        self._acks.ack(self.ack_id)
+
+    def nack(self):
+        self._acks.nack(self.ack_id)
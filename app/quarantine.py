@@ -0,0 +1,100 @@
+import json
+import os
+import threading
+from datetime import datetime, timezone
+
+from app import metrics
+from app.publisher import publish_message, publisher
+from app.reject_cache import reject_cache
+
+QUARANTINE_DIR = os.getenv("QUARANTINE_DIR")
+QUARANTINE_ROUTING_KEY = os.getenv("QUARANTINE_ROUTING_KEY")
+QUARANTINE_FILE_NAME = 'quarantine.jsonl'
+
+MESSAGES_QUARANTINED = metrics.Counter('pubsub_messages_quarantined_total',
+                                       'Invalid Pub/Sub messages quarantined and acked', ['subscription', 'reason'])
+
+
+def quarantine_record(subscription, message, reason):
+    """
+    :return: a JSON serialisable record of an invalid message, with everything needed to re-inject it once fixed
+    """
+    return {
+        'quarantined_at': datetime.now(timezone.utc).isoformat(),
+        'reason': reason,
+        'subscription': subscription.key,
+        'subscription_name': subscription.subscription_name,
+        'translator': subscription.translator,
+        'routing_key': subscription.routing_key,
+        'message_id': message.message_id,
+        'attributes': dict(message.attributes),
+        # surrogateescape round trips bytes which are not UTF-8, see record_data
+        'data': message.data.decode('utf-8', 'surrogateescape') if isinstance(message.data, bytes) else message.data,
+    }
+
+
+def record_data(record):
+    """
+    :return: the message data of a quarantine record, as the bytes originally received
+    """
+    return record['data'].encode('utf-8', 'surrogateescape') if record['data'] is not None else None
+
+
+class QuarantineStore:
+    """
+    A local dead letter store for invalid messages, appended to a JSON Lines file. Each record is fsynced before
+    its Pub/Sub message is acked, so nothing is lost, and invalid messages stop being redelivered.
+    """
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, QUARANTINE_FILE_NAME)
+        self._directory = directory
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record).encode('utf-8') + b'\n'
+        with self._lock:
+            os.makedirs(self._directory, exist_ok=True)
+            with open(self.path, 'ab') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+
+quarantine_store = QuarantineStore(QUARANTINE_DIR) if QUARANTINE_DIR else None
+publisher.add_settle_listener(reject_cache.on_settled)
+
+
+def quarantine_message(subscription, message, reason, log, store=None, routing_key=QUARANTINE_ROUTING_KEY):
+    """
+    Set aside an invalid message with the reason it failed validation, so it is acked rather than redelivered.
+    The message is published to rabbitmq with the quarantine routing key, acked once the broker confirms it, if
+    QUARANTINE_ROUTING_KEY is set, else written to the local quarantine store and acked.
+    The message's entry in the reject cache, added beforehand, is marked quarantined once the message is acked, or
+    discarded if quarantining fails.
+
+    :return: whether the message was quarantined, False if no quarantine is configured
+    """
+    store = store or quarantine_store
+    if not routing_key and not store:
+        return False
+
+    record = quarantine_record(subscription, message, reason)
+    if routing_key:
+        reject_cache.track_quarantine(subscription.key, message)
+        publish_message(message, json.dumps(record).encode('utf-8'), routing_key=routing_key,
+                        subscription_name=subscription.subscription_name)
+    else:
+        try:
+            store.write(record)
+        except OSError as e:
+            log.error('Failed to quarantine message', error=repr(e))
+            reject_cache.discard(subscription.key, message)  # quarantine the redelivery
+            return False
+        metrics.MESSAGES_ACKED.labels(subscription.subscription_name).inc()
+        message.ack()
+        reject_cache.set_quarantined(subscription.key, message)
+
+    MESSAGES_QUARANTINED.labels(subscription.subscription_name, reason).inc()
+    log.warning('Quarantined invalid Pub/Sub Message', reason=reason)
+    return True
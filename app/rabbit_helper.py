@@ -2,6 +2,7 @@ import logging
 import os
 
 import pika
+from pika.exceptions import AMQPChannelError, AMQPConnectionError
 from pika.spec import PERSISTENT_DELIVERY_MODE
 from structlog import wrap_logger
 
@@ -13,6 +14,8 @@ RABBIT_PORT = os.getenv("RABBIT_PORT", "6672")
 RABBIT_VIRTUALHOST = os.getenv("RABBIT_VIRTUALHOST", "/")
 RABBIT_USERNAME = os.getenv("RABBIT_USERNAME", "guest")
 RABBIT_PASSWORD = os.getenv("RABBIT_PASSWORD", "guest")
+RABBIT_HEARTBEAT = int(os.getenv("RABBIT_HEARTBEAT", "30"))
+RABBIT_POOL_SIZE = int(os.getenv("RABBIT_POOL_SIZE", "4"))  # confirm publishers, each with its own connection
 
 logger = wrap_logger(logging.getLogger(__name__))
 
@@ -24,6 +27,7 @@ def init_rabbitmq(exchange_name=RABBIT_EXCHANGE):
     """
     rabbitmq_connection = _create_connection()
     _ = rabbitmq_connection.channel()
+    rabbitmq_connection.close()
 
     logger.info('Successfully initialised rabbitmq', exchange=exchange_name)
 
@@ -32,9 +36,10 @@ def send_message_to_rabbitmq(message,
                              exchange_name=RABBIT_EXCHANGE,
                              routing_key=RABBIT_ROUTE):
     """
-    Send message to rabbitmq
+    Send a one-off message to rabbitmq on a connection of its own. The message handlers publish through the pool of
+    confirm publishers in app.publisher instead.
 
-    :param message: The message to send to the exchange in JSON format
+    :param message: The message to send to the exchange in JSON format, as bytes or str
     :param exchange_name: The rabbitmq exchange to publish to, (e.g.: "events")
     :param routing_key:
     :return: boolean
@@ -43,20 +48,31 @@ def send_message_to_rabbitmq(message,
     properties = pika.BasicProperties(content_type='application/json', delivery_mode=PERSISTENT_DELIVERY_MODE)
 
     rabbitmq_connection = _create_connection()
-    rabbitmq_channel = rabbitmq_connection.channel()
-    rabbitmq_channel.basic_publish(exchange=exchange_name,
-                                   routing_key=routing_key,
-                                   body=str(message),
-                                   properties=properties)
+    try:
+        rabbitmq_connection.channel().basic_publish(exchange=exchange_name, routing_key=routing_key, body=message,
+                                                    properties=properties)
+    finally:
+        _close_quietly(rabbitmq_connection)
 
     logger.info('Message successfully sent to rabbitmq', exchange=exchange_name, route=routing_key)
 
-    rabbitmq_connection.close()
+
+def connection_parameters():
+    credentials = pika.PlainCredentials(RABBIT_USERNAME, RABBIT_PASSWORD)
+    return pika.ConnectionParameters(RABBIT_HOST, RABBIT_PORT, RABBIT_VIRTUALHOST, credentials,
+                                     heartbeat=RABBIT_HEARTBEAT)
 
 
 def _create_connection():
-    credentials = pika.PlainCredentials(RABBIT_USERNAME, RABBIT_PASSWORD)
-    parameters = pika.ConnectionParameters(RABBIT_HOST, RABBIT_PORT, RABBIT_VIRTUALHOST, credentials)
+    parameters = connection_parameters()
 
     logger.debug('Connecting to rabbitmq', url=parameters.host)
     return pika.BlockingConnection(parameters)
+
+
+def _close_quietly(connection):
+    try:
+        if connection.is_open:
+            connection.close()
+    except (AMQPConnectionError, AMQPChannelError):
+        pass
@@ -0,0 +1,152 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+from structlog import wrap_logger
+
+from app import metrics
+
+REJECT_CACHE_SIZE = int(os.getenv("REJECT_CACHE_SIZE", "10000"))
+REJECT_LOG_INTERVAL = float(os.getenv("REJECT_LOG_INTERVAL", "60"))
+
+FAST_REJECTS = metrics.Counter('pubsub_fast_rejects_total',
+                               'Redelivered messages rejected as known invalid without being decoded',
+                               ['subscription', 'reason'])
+
+logger = wrap_logger(logging.getLogger(__name__))
+
+
+def payload_fingerprint(message):
+    """
+    :return: a digest of the message's data and attributes, which is the same for every resend of a payload
+    """
+    data = message.data or b''
+    digest = hashlib.blake2b(data.encode('utf-8') if isinstance(data, str) else data, digest_size=16)
+    for name, value in sorted(message.attributes.items()):
+        digest.update(f'\0{name}\0{value}'.encode('utf-8', 'surrogateescape'))
+    return digest.digest()
+
+
+class RejectCache:
+    """
+    Remembers the fingerprints of messages which failed validation, their message ID and a hash of their payload, so
+    redeliveries and resends of them are rejected before they are decoded or logged. Holds at most `max_size`
+    fingerprints, evicting the least recently seen first.
+
+    Validation is deterministic, so a known invalid message is dealt with as it was first time round: acked if it
+    was quarantined, else left unacked. A message whose quarantine record is published is only marked quarantined
+    once rabbitmq confirms the record, see track_quarantine. If quarantining fails the message is forgotten, so its
+    redelivery is quarantined again rather than acked and lost. Fast rejects are counted in a metric and summarised
+    in at most one log line every `log_interval` seconds.
+    """
+
+    def __init__(self, max_size=REJECT_CACHE_SIZE, log_interval=REJECT_LOG_INTERVAL):
+        self.max_size = max_size
+        self._log_interval = log_interval
+        self._entries = OrderedDict()  # (subscription key, fingerprint): (reason, quarantined)
+        self._pending = OrderedDict()  # message ID: subscription key, for quarantine records not yet confirmed
+        self._lock = threading.Lock()
+        self._unlogged = 0
+        self._next_log = monotonic()
+
+    def _fingerprints(self, subscription_key, message):
+        yield subscription_key, message.message_id
+        yield subscription_key, payload_fingerprint(message)
+
+    def get(self, subscription_key, message):
+        """
+        :return: the (reason, quarantined) the message was rejected with before, or None if it is not known invalid
+        """
+        if not self._entries:
+            return None  # skip hashing the payload while nothing has failed validation
+        for fingerprint in self._fingerprints(subscription_key, message):
+            with self._lock:
+                entry = self._entries.get(fingerprint)
+                if entry is not None:
+                    self._entries.move_to_end(fingerprint)
+                    return entry
+        return None
+
+    def add(self, subscription_key, message, reason, quarantined=False):
+        if not self.max_size:
+            return
+        for fingerprint in self._fingerprints(subscription_key, message):
+            with self._lock:
+                self._entries[fingerprint] = (reason, quarantined)
+                self._entries.move_to_end(fingerprint)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+
+    def set_quarantined(self, subscription_key, message):
+        for fingerprint in self._fingerprints(subscription_key, message):
+            with self._lock:
+                entry = self._entries.get(fingerprint)
+                if entry is not None:
+                    self._entries[fingerprint] = (entry[0], True)
+
+    def discard(self, subscription_key, message):
+        for fingerprint in self._fingerprints(subscription_key, message):
+            with self._lock:
+                self._entries.pop(fingerprint, None)
+
+    def track_quarantine(self, subscription_key, message):
+        """
+        Mark the message quarantined once the publish of its quarantine record is confirmed, see on_settled
+        """
+        if not self.max_size:
+            return
+        with self._lock:
+            self._pending[message.message_id] = subscription_key
+            while len(self._pending) > self.max_size:
+                self._pending.popitem(last=False)
+
+    def on_settled(self, message, acked):
+        """
+        Publisher settle listener, marking a tracked message quarantined when its quarantine record is confirmed, or
+        forgetting it if the record is rejected
+        """
+        if not self._pending:
+            return
+        with self._lock:
+            subscription_key = self._pending.pop(message.message_id, None)
+        if subscription_key is None:
+            return
+        if acked:
+            self.set_quarantined(subscription_key, message)
+        else:
+            self.discard(subscription_key, message)
+
+    def fast_reject(self, subscription, message):
+        """
+        Reject the message if it is known invalid, acking it if it was quarantined before
+
+        :return: whether the message was rejected
+        """
+        entry = self.get(subscription.key, message)
+        if entry is None:
+            return False
+        reason, quarantined = entry
+        FAST_REJECTS.labels(subscription.subscription_name, reason).inc()
+        if quarantined:
+            metrics.MESSAGES_ACKED.labels(subscription.subscription_name).inc()
+            message.ack()
+        self._count_reject()
+        return True
+
+    def _count_reject(self):
+        with self._lock:
+            self._unlogged += 1
+            if monotonic() < self._next_log:
+                return
+            rejected, self._unlogged = self._unlogged, 0
+            self._next_log = monotonic() + self._log_interval
+        logger.warning('Rejected known invalid Pub/Sub Messages', rejected=rejected)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+reject_cache = RejectCache()
@@ -0,0 +1,79 @@
+import os
+import random
+from time import perf_counter
+
+from app import metrics
+
+STAGE_TIMING_SAMPLE_RATE = float(os.getenv("STAGE_TIMING_SAMPLE_RATE", "0"))
+
+STAGE_DURATION = metrics.Histogram('pubsub_stage_duration_seconds',
+                                   'Time spent in each stage of handling a sampled message',
+                                   ['subscription', 'stage'],
+                                   buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+                                            0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0))
+
+
+class StageTimer:
+    """
+    Times the consecutive stages of handling a single message. Each mark attributes the time since the previous
+    mark to the named stage, so a stage marked more than once (e.g. logging) accumulates.
+    """
+    sampled = True
+
+    def __init__(self, subscription_name):
+        self.subscription_name = subscription_name
+        self.timings = {}
+        self._last = perf_counter()
+
+    def mark(self, stage):
+        now = perf_counter()
+        self.timings[stage] = self.timings.get(stage, 0) + now - self._last
+        self._last = now
+
+    def record(self, log):
+        """
+        Observe the stage timings in the stage duration histogram and log them as a single compact line
+        """
+        for stage, duration in self.timings.items():
+            STAGE_DURATION.labels(self.subscription_name, stage).observe(duration)
+        log.info('Message stage timings', stage_timings_us={stage: int(duration * 1000000)
+                                                            for stage, duration in self.timings.items()})
+
+    def observe(self, stage, duration):
+        """
+        Observe a stage which ends after the timings were recorded, e.g. acking once rabbitmq confirms the publish
+        """
+        STAGE_DURATION.labels(self.subscription_name, stage).observe(duration)
+
+
+class _NullTimer:
+    """
+    Stands in for a StageTimer on the messages which are not sampled, doing nothing
+    """
+    sampled = False
+
+    def mark(self, stage):
+        pass
+
+    def record(self, log):
+        pass
+
+    def observe(self, stage, duration):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+def is_sampled(sample_rate=None):
+    sample_rate = STAGE_TIMING_SAMPLE_RATE if sample_rate is None else sample_rate
+    return sample_rate > 0 and random.random() < sample_rate
+
+
+def start_timer(subscription_name, sample_rate=None):
+    """
+    :param subscription_name: The subscription the message was received on
+    :param sample_rate: The share of messages to time, defaults to STAGE_TIMING_SAMPLE_RATE
+    :return: a StageTimer if this message is sampled, else a timer which does nothing
+    """
+    return StageTimer(subscription_name) if is_sampled(sample_rate) else NULL_TIMER
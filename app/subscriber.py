@@ -1,262 +1,325 @@
-import json
 import logging
 import os
-from datetime import datetime, timezone
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from time import monotonic
 
+from google.api_core.exceptions import DeadlineExceeded, GoogleAPICallError
 from google.cloud.pubsub_v1 import SubscriberClient
+from google.cloud.pubsub_v1.types import FlowControl
 from google.cloud.pubsub_v1.subscriber.message import Message
-from rfc3339 import parse_datetime
 from structlog import wrap_logger
 
-from app.rabbit_helper import send_message_to_rabbitmq
-
-SUBSCRIPTION_NAME = os.getenv("SUBSCRIPTION_NAME", "rm-receipt-subscription")
-OFFLINE_SUBSCRIPTION_NAME = os.getenv("OFFLINE_SUBSCRIPTION_NAME", "rm-offline-receipt-subscription")
-PPO_UNDELIVERED_SUBSCRIPTION_NAME = os.getenv("PPO_UNDELIVERED_SUBSCRIPTION_NAME", "rm-ppo-undelivered-subscription")
-QM_UNDELIVERED_SUBSCRIPTION_NAME = os.getenv("QM_UNDELIVERED_SUBSCRIPTION_NAME", "rm-qm-undelivered-subscription")
-SUBSCRIPTION_PROJECT_ID = os.getenv("SUBSCRIPTION_PROJECT_ID")
-OFFLINE_SUBSCRIPTION_PROJECT_ID = os.getenv("OFFLINE_SUBSCRIPTION_PROJECT_ID")
-PPO_UNDELIVERED_SUBSCRIPTION_PROJECT_ID = os.getenv("PPO_UNDELIVERED_SUBSCRIPTION_PROJECT_ID")
-QM_UNDELIVERED_SUBSCRIPTION_PROJECT_ID = os.getenv("QM_UNDELIVERED_SUBSCRIPTION_PROJECT_ID")
-UNDELIVERED_MAIL_ROUTING_KEY = os.getenv("UNDELIVERED_MAIL_ROUTING_KEY", "event.fulfilment.undelivered")
+from app import json_codec, metrics
+from app.backpressure import backpressure
+from app.dedup import dedup_cache, dedup_key
+from app.executor import create_scheduler
+from app.publisher import publish_message, publisher
+from app.pulled_message import PulledMessage
+from app.quarantine import quarantine_message
+from app.reject_cache import reject_cache
+from app.stage_timing import start_timer
+from app.subscription_config import Subscription
+from app.translators import TRANSLATORS, InvalidMessage
+
+# outcomes of process_message
+PUBLISHED, DUPLICATE, QUARANTINED, INVALID = 'published', 'duplicate', 'quarantined', 'invalid'
+
+PULL_BATCH_SIZE = int(os.getenv("PULL_BATCH_SIZE", "1000"))
+PULL_CONCURRENT_BATCHES = int(os.getenv("PULL_CONCURRENT_BATCHES", "4"))
+PULL_TIMEOUT = float(os.getenv("PULL_TIMEOUT", "30"))
+PULL_SETTLE_TIMEOUT = float(os.getenv("PULL_SETTLE_TIMEOUT", "60"))
+PULL_ACK_DEADLINE = int(os.getenv("PULL_ACK_DEADLINE", "60"))
+PULL_RETRY_DELAY = float(os.getenv("PULL_RETRY_DELAY", "1"))
+PULL_RETRY_MAX_DELAY = 60
+MIN_ACK_DEADLINE = 10  # seconds, Pub/Sub's minimum and default subscription ack deadline
+LEASE_RENEWAL_MARGIN = 5  # seconds before a lease expires to extend it
 
 logger = wrap_logger(logging.getLogger(__name__))
 client = SubscriberClient()
+publisher.add_settle_listener(dedup_cache.on_settled)
 
 
-def eq_receipt_to_case(message: Message):
+def process_message(subscription: Subscription, message: Message):
     """
-    Callback for handling new pubsub messages which attempts to publish a receipt to the events exchange
+    Callback for handling new pubsub messages which translates them with the subscription's translator and
+    publishes the result to the events exchange. The message is acked or nacked asynchronously once rabbitmq
+    confirms or rejects the publish.
+    A message translating to an event which has already been published is acked straight away, see app.dedup.
+    While rabbitmq is pushing back the callback waits before processing the message, see app.backpressure.
+    An invalid message is quarantined and acked if a quarantine is configured, see app.quarantine. Redeliveries and
+    resends of it are then rejected before they are decoded or logged, see app.reject_cache.
 
     NB: any exceptions raised by this callback should nack the message by the future manager
+    :param subscription: the registered Subscription the message was received on
     :param message: a GCP pubsub subscriber Message
+    :return: the outcome, PUBLISHED if the message was handed to the publisher to be acked or nacked once rabbitmq
+             confirms or rejects it, QUARANTINED if it was quarantined, which may also be waiting for a confirm,
+             else DUPLICATE or INVALID if it was settled (or left to be redelivered) already
     """
-    log = logger.bind(message_id=message.message_id,
-                      subscription_name=SUBSCRIPTION_NAME,
-                      subscription_project=SUBSCRIPTION_PROJECT_ID)
-    try:
-        if message.attributes['eventType'] != 'OBJECT_FINALIZE':  # only forward on object creation
-            log.error('Unknown Pub/Sub Message eventType', eventType=message.attributes['eventType'])
-            return
-        bucket_name, object_name = message.attributes['bucketId'], message.attributes['objectId']
-    except KeyError as e:
-        log.error('Pub/Sub Message missing required attribute', missing_attribute=e.args[0])
-        return
-
-    log = log.bind(bucket_name=bucket_name, object_name=object_name)
-    log.info('Pub/Sub Message received for processing')
-
-    payload = validate_eq_receipt(message.data, log, ['timeCreated'], ['tx_id', 'questionnaire_id'])
-    if not payload:
-        return  # Failed validation
-
-    metadata = payload['metadata']
-    tx_id, questionnaire_id, case_id = metadata['tx_id'], metadata['questionnaire_id'], metadata.get('case_id')
-    time_obj_created = parse_datetime(payload['timeCreated']).isoformat()
-
-    log = log.bind(questionnaire_id=questionnaire_id, created=time_obj_created, tx_id=tx_id, case_id=case_id)
-
-    receipt_message = {
-        'event': {
-            'type': 'RESPONSE_RECEIVED',
-            'source': 'RECEIPT_SERVICE',
-            'channel': 'EQ',
-            'dateTime': time_obj_created,
-            'transactionId': tx_id
-        },
-        'payload': {
-            'response': {
-                'caseId': case_id,
-                'questionnaireId': questionnaire_id,
-                'unreceipt': False
-            }
-        }
-    }
-
-    send_message_to_rabbitmq(json.dumps(receipt_message))
-    message.ack()
-
-    log.info('Message processing complete')
-
-
-def offline_receipt_to_case(message: Message):
-    log = logger.bind(message_id=message.message_id,
-                      subscription_name=OFFLINE_SUBSCRIPTION_NAME,
-                      subscription_project=OFFLINE_SUBSCRIPTION_PROJECT_ID)
-
-    log.info('Pub/Sub Message received for processing')
-
-    payload = validate_offline_receipt(message.data, log, ['transactionId', 'questionnaireId', 'channel'])
-    if not payload:
-        return  # Failed validation
-
-    tx_id, questionnaire_id, channel = payload['transactionId'], payload['questionnaireId'], payload['channel']
-    time_obj_created = datetime.strptime(payload['dateTime'], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc).isoformat()
-
-    log = log.bind(questionnaire_id=questionnaire_id, created=time_obj_created, tx_id=tx_id, channel=channel)
-
-    receipt_message = {
-        'event': {
-            'type': 'RESPONSE_RECEIVED',
-            'source': 'RECEIPT_SERVICE',
-            'channel': channel,
-            'dateTime': time_obj_created,
-            'transactionId': tx_id
-        },
-        'payload': {
-            'response': {
-                'questionnaireId': questionnaire_id,
-                'unreceipt': payload.get('unreceipt', False)
-            }
-        }
-    }
-
-    send_message_to_rabbitmq(json.dumps(receipt_message))
-    message.ack()
-
-    log.info('Message processing complete')
-
-
-def ppo_undelivered_mail_to_case(message: Message):
-    log = logger.bind(message_id=message.message_id,
-                      subscription_name=PPO_UNDELIVERED_SUBSCRIPTION_NAME,
-                      subscription_project=PPO_UNDELIVERED_SUBSCRIPTION_PROJECT_ID)
-
-    log.debug('Pub/Sub Message received for processing')
-
-    payload = validate_offline_receipt(message.data, log, ['transactionId', 'caseRef', 'productCode'])
-    if not payload:
-        return  # Failed validation
-
-    tx_id, case_ref, product_code = payload['transactionId'], payload['caseRef'], payload['productCode']
-    date_time = datetime.strptime(payload['dateTime'], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc).isoformat()
-
-    log = log.bind(case_ref=case_ref, created=date_time, product_code=product_code, tx_id=tx_id)
-
-    receipt_message = {
-        'event': {
-            'type': 'UNDELIVERED_MAIL_REPORTED',
-            'source': 'RECEIPT_SERVICE',
-            'channel': 'PPO',
-            'dateTime': date_time,
-            'transactionId': tx_id
-        },
-        'payload': {
-            'fulfilmentInformation': {
-                'caseRef': case_ref,
-                'fulfilmentCode': product_code
-            }
-        }
-    }
-
-    send_message_to_rabbitmq(json.dumps(receipt_message), routing_key=UNDELIVERED_MAIL_ROUTING_KEY)
-    message.ack()
-
-    log.debug('Message processing complete')
-
-
-def qm_undelivered_mail_to_case(message: Message):
-    log = logger.bind(message_id=message.message_id,
-                      subscription_name=QM_UNDELIVERED_SUBSCRIPTION_NAME,
-                      subscription_project=QM_UNDELIVERED_SUBSCRIPTION_PROJECT_ID)
-
-    log.debug('Pub/Sub Message received for processing')
-
-    payload = validate_offline_receipt(message.data, log, ['transactionId', 'questionnaireId'])
-    if not payload:
-        return  # Failed validation
-
-    tx_id, questionnaire_id = payload['transactionId'], payload['questionnaireId']
-    date_time = datetime.strptime(payload['dateTime'], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc).isoformat()
-
-    log = log.bind(questionnaire_id=questionnaire_id, created=date_time, tx_id=tx_id)
-
-    receipt_message = {
-        'event': {
-            'type': 'UNDELIVERED_MAIL_REPORTED',
-            'source': 'RECEIPT_SERVICE',
-            'channel': 'QM',
-            'dateTime': date_time,
-            'transactionId': tx_id
-        },
-        'payload': {
-            'fulfilmentInformation': {
-                'questionnaireId': questionnaire_id
-            }
-        }
-    }
-
-    send_message_to_rabbitmq(json.dumps(receipt_message), routing_key=UNDELIVERED_MAIL_ROUTING_KEY)
-    message.ack()
-
-    log.debug('Message processing complete')
-
-
-def validate_offline_receipt(message_data, log, expected_keys, date_time_key='dateTime'):
+    if backpressure.paused:
+        backpressure.wait_until_clear()
+
+    subscription_name = subscription.subscription_name
+    started = monotonic()
+    metrics.MESSAGES_RECEIVED.labels(subscription_name).inc()
+    if reject_cache.fast_reject(subscription, message):
+        return INVALID
+    metrics.HANDLERS_IN_FLIGHT.labels(subscription_name).inc()
+    timer = start_timer(subscription_name)
     try:
-        payload = json.loads(message_data)  # parse metadata as JSON payload
-        for expected_key in expected_keys:
-            if expected_key not in payload:
-                log.error('Pub/Sub Message missing required data', missing_json_key=expected_key)
-                return None
-
-        datetime.strptime(payload[date_time_key], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc).isoformat()
-
-        return payload
-    except (TypeError, json.JSONDecodeError):
-        log.error('Pub/Sub Message data not JSON')
-        return None
-    except KeyError as e:
-        log.error('Pub/Sub Message missing required data', missing_json_key=e.args[0])
-        return None
-    except ValueError:
-        log.error('Pub/Sub Message has invalid datetime string')
-        return None
-
-
-def validate_eq_receipt(message_data, log, expected_keys, expected_metadata_keys, date_time_key='timeCreated'):
-    try:
-        payload = json.loads(message_data)  # parse metadata as JSON payload
-        if 'metadata' not in payload:
-            log.error('Pub/Sub Message missing required data', missing_json_key='metadata')
-            return None
-
-        for expected_key in expected_keys:
-            if expected_key not in payload:
-                log.error('Pub/Sub Message missing required data', missing_json_key=expected_key)
-                return None
-
-        for expected_metadata_key in expected_metadata_keys:
-            if expected_metadata_key not in payload['metadata']:
-                log.error('Pub/Sub Message missing required data', missing_json_key=expected_metadata_key)
-                return None
-
-        parse_datetime(payload[date_time_key]).isoformat()
-
-        return payload
-    except (TypeError, json.JSONDecodeError):
-        log.error('Pub/Sub Message data not JSON')
-        return None
-    except KeyError as e:
-        log.error('Pub/Sub Message missing required data', missing_json_key=e.args[0])
-        return None
-    except ValueError:
-        log.error('Pub/Sub Message has invalid datetime string')
-        return None
-
-
-def setup_subscription(subscription_name=SUBSCRIPTION_NAME,
-                       subscription_project_id=SUBSCRIPTION_PROJECT_ID,
-                       callback=eq_receipt_to_case):
+        log = logger.bind(message_id=message.message_id,
+                          subscription_name=subscription_name,
+                          subscription_project=subscription.subscription_project_id)
+        getattr(log, subscription.log_level)('Pub/Sub Message received for processing')
+        timer.mark('log')
+
+        try:
+            event_message, log = TRANSLATORS[subscription.translator](message, log, timer)
+        except InvalidMessage as e:
+            metrics.VALIDATION_FAILURES.labels(subscription_name, e.reason).inc()
+            reject_cache.add(subscription.key, message, e.reason)  # marked quarantined once the message is acked
+            quarantined = quarantine_message(subscription, message, e.reason, log)
+            timer.record(log)
+            return QUARANTINED if quarantined else INVALID  # Failed validation
+
+        key = dedup_key(event_message)
+        if dedup_cache.is_duplicate(key):
+            getattr(log, subscription.log_level)('Duplicate of an already published message, acking')
+            metrics.MESSAGES_ACKED.labels(subscription_name).inc()
+            message.ack()
+            timer.record(log)
+            return DUPLICATE
+        dedup_cache.track(message, key)
+
+        try:
+            body = json_codec.dumps(event_message)
+            timer.mark('serialise')
+            publish_message(message, body, routing_key=subscription.routing_key, subscription_name=subscription_name,
+                            timer=timer)
+        except Exception:
+            dedup_cache.untrack(message)
+            raise
+        timer.mark('publish')
+
+        getattr(log, subscription.log_level)('Message processing complete')
+        timer.mark('log')
+        timer.record(log)
+        return PUBLISHED
+    finally:
+        metrics.HANDLERS_IN_FLIGHT.labels(subscription_name).dec()
+        metrics.HANDLER_DURATION.labels(subscription_name).observe(monotonic() - started)
+
+
+def setup_subscription(subscription_name,
+                       subscription_project_id,
+                       callback,
+                       flow_control=None,
+                       scheduler=None):
     """
     Create a subscriber thread which handles new messages through a callback
 
     :param subscription_name: The name of the pubsub subscription
     :param subscription_project_id: GCP project where subscription should already exist
     :param callback: The callback to use upon receipt of a new message from the subscription
+    :param flow_control: FlowControl settings bounding outstanding messages, defaults to the library defaults
+    :param scheduler: The scheduler to run callbacks on, see app.executor.create_scheduler, defaults to the
+                      library's shared default scheduler
     :return: a StreamingPullFuture for managing the callback thread
     """
+    flow_control = flow_control or FlowControl()
     subscription_path = client.subscription_path(subscription_project_id, subscription_name)
-    subscriber_future = client.subscribe(subscription_path, callback)
-    logger.info('Listening for Pub/Sub Messages', subscription_path=subscription_path)
+    subscriber_future = client.subscribe(subscription_path, callback, flow_control=flow_control, scheduler=scheduler)
+    logger.info('Listening for Pub/Sub Messages', subscription_path=subscription_path,
+                max_messages=flow_control.max_messages, max_bytes=flow_control.max_bytes,
+                max_lease_duration=flow_control.max_lease_duration)
     return subscriber_future
+
+
+def setup_subscriptions(subscriptions):
+    """
+    Subscribe to every registered subscription, each with its own flow control settings and callback thread pool
+
+    :param subscriptions: the Subscriptions to listen on, see app.subscription_config.load_subscriptions
+    :return: a list of StreamingPullFutures for managing the callback threads
+    """
+    return [setup_subscription(subscription_name=subscription.subscription_name,
+                               subscription_project_id=subscription.subscription_project_id,
+                               callback=partial(process_message, subscription),
+                               flow_control=subscription.flow_control,
+                               scheduler=create_scheduler(subscription.subscription_name,
+                                                          subscription.executor_threads))
+            for subscription in subscriptions]
+
+
+class PullBatch:
+    """
+    Records the ack IDs of a batch of pulled messages as they are acked or nacked, so the whole batch can be
+    acknowledged in one request once its published messages are settled
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.pulled_at = None
+        self.outcomes = Counter()  # process_message outcome: count
+        self.published = []
+        self.quarantined = []  # ack IDs of invalid messages acked once quarantined, perhaps once rabbitmq confirms it
+        self.acked = []
+        self.nacked = []
+        self.settled_at = {}  # ack ID: monotonic time it was acked or nacked
+        self.message_ids = {}  # ack ID: message ID
+        self.duplicates = []  # ack IDs of messages acked as duplicates
+        self._condition = threading.Condition()
+
+    def ack(self, ack_id):
+        self._settle(ack_id, self.acked)
+
+    def nack(self, ack_id):
+        self._settle(ack_id, self.nacked)
+
+    def _settle(self, ack_id, outcome):
+        with self._condition:
+            outcome.append(ack_id)
+            self.settled_at[ack_id] = monotonic()
+            self._condition.notify_all()
+
+    def wait_until_settled(self, ack_ids, timeout=None):
+        """
+        :return: whether all of the ack IDs were settled within the timeout
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: all(ack_id in self.settled_at for ack_id in ack_ids), timeout)
+
+    def unsettled(self, ack_ids):
+        with self._condition:
+            return [ack_id for ack_id in ack_ids if ack_id not in self.settled_at]
+
+    def confirmed(self):
+        """
+        :return: the ack IDs of the published messages which rabbitmq confirmed
+        """
+        acked = set(self.acked)
+        return [ack_id for ack_id in self.published if ack_id in acked]
+
+
+def pull_batch(subscription: Subscription, subscription_path, batch_size=PULL_BATCH_SIZE, timeout=PULL_TIMEOUT):
+    """
+    Pull up to `batch_size` messages with a synchronous pull and handle each of them with process_message, so the
+    batch is translated and published together. Once rabbitmq has confirmed the published messages, every acked
+    message is acknowledged in one request and every nacked one is sent for redelivery in another.
+
+    Invalid messages which are not quarantined are left to be redelivered when their ack deadline expires, as in
+    the streaming mode. So are published and quarantined messages which rabbitmq has not confirmed within
+    PULL_SETTLE_TIMEOUT, whose ack deadlines are extended while waiting, see _wait_until_settled.
+
+    :return: the PullBatch of the messages pulled, empty if there were none
+    :raises: GoogleAPICallError if a pull, acknowledge or modify ack deadline request fails
+    """
+    batch = PullBatch()
+    try:
+        response = client.pull(subscription=subscription_path, max_messages=batch_size, timeout=timeout)
+    except DeadlineExceeded:
+        return batch  # nothing to pull
+    batch.size = len(response.received_messages)
+    batch.pulled_at = monotonic()
+
+    for received_message in response.received_messages:
+        message = PulledMessage(received_message, batch)
+        batch.message_ids[message.ack_id] = message.message_id
+        try:
+            outcome = process_message(subscription, message)
+        except Exception as e:
+            logger.error('Failed to process pulled message, nacking', message_id=message.message_id, error=repr(e))
+            message.nack()
+            continue
+        batch.outcomes[outcome] += 1
+        if outcome == PUBLISHED:
+            batch.published.append(message.ack_id)
+        elif outcome == QUARANTINED:
+            batch.quarantined.append(message.ack_id)
+        elif outcome == DUPLICATE:
+            batch.duplicates.append(message.ack_id)
+
+    if not _wait_until_settled(batch, subscription_path, PULL_SETTLE_TIMEOUT):
+        logger.warning('Timed out waiting for rabbitmq to confirm pulled messages, leaving them to be redelivered',
+                       subscription_path=subscription_path)
+    acked, nacked = list(batch.acked), list(batch.nacked)
+    if acked:
+        client.acknowledge(subscription=subscription_path, ack_ids=acked)
+    if nacked:
+        client.modify_ack_deadline(subscription=subscription_path, ack_ids=nacked, ack_deadline_seconds=0)
+    return batch
+
+
+def _wait_until_settled(batch, subscription_path, timeout):
+    """
+    Wait for rabbitmq to confirm or reject the batch's published and quarantined messages. Pulled messages are not
+    leased as streaming pull leases them, so the ack deadlines of those still unsettled are extended to
+    PULL_ACK_DEADLINE before they could expire, assuming the minimum subscription ack deadline at first.
+
+    :return: whether all of them were settled within the timeout
+    """
+    settle_deadline = monotonic() + timeout
+    lease_expires = batch.pulled_at + MIN_ACK_DEADLINE
+    publishing = batch.published + batch.quarantined
+    while True:
+        renew_at = lease_expires - LEASE_RENEWAL_MARGIN
+        if batch.wait_until_settled(publishing, max(min(settle_deadline, renew_at) - monotonic(), 0)):
+            return True
+        if monotonic() >= settle_deadline:
+            return False
+        unsettled = batch.unsettled(publishing)
+        if unsettled:
+            client.modify_ack_deadline(subscription=subscription_path, ack_ids=unsettled,
+                                       ack_deadline_seconds=PULL_ACK_DEADLINE)
+        lease_expires = monotonic() + PULL_ACK_DEADLINE
+
+
+def _pull_batches(subscription, subscription_path, batch_size, stopped):
+    """
+    Pull batches until stopped, retrying failed requests with exponential backoff as streaming pull does
+    """
+    retry_delay = PULL_RETRY_DELAY
+    while not stopped.is_set():
+        try:
+            pull_batch(subscription, subscription_path, batch_size)
+        except GoogleAPICallError as e:
+            logger.error('Pub/Sub request failed while pulling a batch, retrying', subscription_path=subscription_path,
+                         retry_delay=retry_delay, error=repr(e))
+            stopped.wait(retry_delay)
+            retry_delay = min(retry_delay * 2, PULL_RETRY_MAX_DELAY)
+            continue
+        retry_delay = PULL_RETRY_DELAY
+
+
+def setup_batch_subscription(subscription: Subscription, batch_size=PULL_BATCH_SIZE,
+                             concurrent_batches=PULL_CONCURRENT_BATCHES, stopped=None):
+    """
+    An alternative to setup_subscription for draining large backlogs, which repeatedly pulls and handles batches of
+    messages with synchronous pull, see pull_batch, on `concurrent_batches` threads
+
+    :param subscription: the registered Subscription to pull from
+    :param batch_size: the most messages to pull in each batch
+    :param concurrent_batches: the most batches to handle at once
+    :param stopped: an Event which stops the pulling once set
+    :return: a list of Futures for managing the pulling threads
+    """
+    stopped = stopped or threading.Event()
+    subscription_path = client.subscription_path(subscription.subscription_project_id, subscription.subscription_name)
+    executor = ThreadPoolExecutor(max_workers=concurrent_batches,
+                                  thread_name_prefix=f'{subscription.subscription_name}-pull')
+    logger.info('Pulling batches of Pub/Sub Messages', subscription_path=subscription_path, batch_size=batch_size,
+                concurrent_batches=concurrent_batches)
+    return [executor.submit(_pull_batches, subscription, subscription_path, batch_size, stopped)
+            for _ in range(concurrent_batches)]
+
+
+def setup_batch_subscriptions(subscriptions):
+    """
+    Pull batches from every registered subscription, see setup_batch_subscription
+
+    :return: a list of Futures for managing the pulling threads
+    """
+    return [future for subscription in subscriptions for future in setup_batch_subscription(subscription)]
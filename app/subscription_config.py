@@ -0,0 +1,109 @@
+import json
+import os
+from collections import OrderedDict, namedtuple
+
+from google.cloud.pubsub_v1.types import FlowControl
+
+from app.executor import DEFAULT_EXECUTOR_THREADS
+from app.rabbit_helper import RABBIT_ROUTE
+from app.translators import TRANSLATORS
+
+SUBSCRIPTIONS_CONFIG_FILE = os.getenv("SUBSCRIPTIONS_CONFIG_FILE")
+ENABLED_SUBSCRIPTIONS = os.getenv("ENABLED_SUBSCRIPTIONS")
+UNDELIVERED_MAIL_ROUTING_KEY = os.getenv("UNDELIVERED_MAIL_ROUTING_KEY", "event.fulfilment.undelivered")
+
+FLOW_CONTROL_SETTINGS = {'max_messages': int, 'max_bytes': int, 'max_lease_duration': float}
+
+Subscription = namedtuple('Subscription', ['key', 'subscription_name', 'subscription_project_id', 'translator',
+                                           'routing_key', 'log_level', 'flow_control', 'executor_threads'])
+
+
+def _default_subscriptions():
+    """
+    The built in subscriptions, configured from the environment variables the service has always used
+    """
+    return OrderedDict([
+        ('eq_receipt', {
+            'env_prefix': 'SUBSCRIPTION',
+            'subscription_name': os.getenv("SUBSCRIPTION_NAME", "rm-receipt-subscription"),
+            'subscription_project_id': os.getenv("SUBSCRIPTION_PROJECT_ID"),
+            'translator': 'eq_receipt',
+            'routing_key': RABBIT_ROUTE,
+            'log_level': 'info',
+        }),
+        ('offline_receipt', {
+            'env_prefix': 'OFFLINE_SUBSCRIPTION',
+            'subscription_name': os.getenv("OFFLINE_SUBSCRIPTION_NAME", "rm-offline-receipt-subscription"),
+            'subscription_project_id': os.getenv("OFFLINE_SUBSCRIPTION_PROJECT_ID"),
+            'translator': 'offline_receipt',
+            'routing_key': RABBIT_ROUTE,
+            'log_level': 'info',
+        }),
+        ('ppo_undelivered', {
+            'env_prefix': 'PPO_UNDELIVERED_SUBSCRIPTION',
+            'subscription_name': os.getenv("PPO_UNDELIVERED_SUBSCRIPTION_NAME", "rm-ppo-undelivered-subscription"),
+            'subscription_project_id': os.getenv("PPO_UNDELIVERED_SUBSCRIPTION_PROJECT_ID"),
+            'translator': 'ppo_undelivered_mail',
+            'routing_key': UNDELIVERED_MAIL_ROUTING_KEY,
+            'log_level': 'debug',
+        }),
+        ('qm_undelivered', {
+            'env_prefix': 'QM_UNDELIVERED_SUBSCRIPTION',
+            'subscription_name': os.getenv("QM_UNDELIVERED_SUBSCRIPTION_NAME", "rm-qm-undelivered-subscription"),
+            'subscription_project_id': os.getenv("QM_UNDELIVERED_SUBSCRIPTION_PROJECT_ID"),
+            'translator': 'qm_undelivered_mail',
+            'routing_key': UNDELIVERED_MAIL_ROUTING_KEY,
+            'log_level': 'debug',
+        }),
+    ])
+
+
+def load_subscriptions(config_file=SUBSCRIPTIONS_CONFIG_FILE, enabled=ENABLED_SUBSCRIPTIONS):
+    """
+    Build the subscription registry.
+
+    The built in subscriptions are merged with an optional JSON config file keyed by subscription key, which can
+    override any setting of a built in subscription or declare a new one, e.g.
+    `{"eq_receipt": {"max_messages": 500, "executor_threads": 20}}`. Flow control and executor settings can then be
+    overridden per subscription by the `<env_prefix>_MAX_MESSAGES`, `<env_prefix>_MAX_BYTES`,
+    `<env_prefix>_MAX_LEASE_DURATION` and `<env_prefix>_EXECUTOR_THREADS` environment variables.
+
+    :param config_file: Path to the JSON subscriptions config file
+    :param enabled: Comma separated keys of the subscriptions to run, defaults to all of them
+    :return: an OrderedDict of Subscription, keyed by subscription key
+    :raises: ValueError for an unknown enabled subscription, or a subscription with an unknown translator
+    """
+    settings = _default_subscriptions()
+    if config_file:
+        with open(config_file) as f:
+            for key, overrides in json.load(f).items():
+                settings.setdefault(key, {}).update(overrides)
+
+    enabled_keys = [key.strip() for key in enabled.split(',')] if enabled else list(settings)
+    unknown_keys = set(enabled_keys) - set(settings)
+    if unknown_keys:
+        raise ValueError(f'Unknown subscriptions enabled: {", ".join(sorted(unknown_keys))}')
+
+    return OrderedDict((key, _build_subscription(key, settings[key])) for key in enabled_keys)
+
+
+def _build_subscription(key, settings):
+    if settings.get('translator') not in TRANSLATORS:
+        raise ValueError(f'Unknown translator {settings.get("translator")!r} for subscription {key}, expected one '
+                         f'of {", ".join(TRANSLATORS)}')
+    env_prefix = settings.get('env_prefix', key.upper())
+    for setting in list(FLOW_CONTROL_SETTINGS) + ['executor_threads']:
+        env_value = os.getenv(f'{env_prefix}_{setting.upper()}')
+        if env_value:
+            settings[setting] = env_value
+
+    flow_control = FlowControl()._replace(**{setting: FLOW_CONTROL_SETTINGS[setting](settings[setting])
+                                             for setting in FLOW_CONTROL_SETTINGS if setting in settings})
+    return Subscription(key=key,
+                        subscription_name=settings['subscription_name'],
+                        subscription_project_id=settings.get('subscription_project_id'),
+                        translator=settings['translator'],
+                        routing_key=settings.get('routing_key', RABBIT_ROUTE),
+                        log_level=settings.get('log_level', 'info'),
+                        flow_control=flow_control,
+                        executor_threads=int(settings.get('executor_threads', DEFAULT_EXECUTOR_THREADS)))
@@ -0,0 +1,205 @@
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+from contextlib import contextmanager, suppress
+from time import monotonic, sleep
+
+from structlog import wrap_logger
+
+from app import metrics
+from app.readiness import Readiness
+
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "1"))
+WORKER_RESTART_DELAY = float(os.getenv("WORKER_RESTART_DELAY", "5"))
+WORKER_METRICS_INTERVAL = float(os.getenv("WORKER_METRICS_INTERVAL", "5"))
+WORKER_STOP_TIMEOUT = 30
+
+WORKER_RESTARTS = metrics.Counter('supervisor_worker_restarts_total', 'Worker processes restarted after exiting')
+WORKERS_READY = metrics.Gauge('supervisor_workers_ready', 'Worker processes running with their readiness file')
+
+logger = wrap_logger(logging.getLogger(__name__))
+
+
+def worker_readiness_file(readiness_file, index):
+    return f'{readiness_file}.worker-{index}'
+
+
+def _run_worker(worker_main, metrics_queue, index, metrics_interval):
+    """
+    Entry point of a worker process, running the service with its own Pub/Sub streams and rabbitmq connections and
+    reporting its metrics to the supervisor
+    """
+    def report_metrics():
+        while True:
+            metrics_queue.put((index, metrics.render_metrics()))
+            sleep(metrics_interval)
+
+    threading.Thread(target=report_metrics, name='worker-metrics', daemon=True).start()
+    worker_main()
+
+
+@contextmanager
+def _environment(variables):
+    """
+    Set environment variables for the duration of the context, to be inherited by worker processes started in it
+    """
+    previous = {name: os.environ.get(name) for name in variables}
+    os.environ.update(variables)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+
+
+class Supervisor:
+    """
+    Runs the service in `worker_count` worker processes, so message handling is spread over every core rather than
+    serialised by the GIL. Each worker has its own Pub/Sub streams and rabbitmq connections. Pub/Sub shares out the
+    messages between every stream on a subscription.
+
+    Workers are started with the `spawn` method rather than forked, as the gRPC library the Pub/Sub client is built
+    on is not fork safe. A worker which exits is restarted after `restart_delay` seconds. The readiness file is
+    present while every worker is running and has created its own readiness file. The workers' metrics are reported
+    to the supervisor, which serves them combined. The counters and histograms last reported by a worker which has
+    exited are kept, so the combined counters do not go backwards when it is restarted.
+
+    Workers are configured by the same environment as the supervisor, except that they run as single processes with
+    their own readiness files, do not serve metrics, and each journal to their own subdirectory of OUTBOX_DIR.
+
+    :param worker_main: the function run by each worker, e.g. run.main
+    """
+
+    def __init__(self, worker_main, worker_count, readiness_file, restart_delay=WORKER_RESTART_DELAY,
+                 metrics_interval=WORKER_METRICS_INTERVAL):
+        self._context = multiprocessing.get_context('spawn')
+        self._metrics_queue = self._context.Queue()
+        self._readiness_file = readiness_file
+        self._readiness = Readiness(readiness_file)
+        self._ready = False
+        self._restart_delay = restart_delay
+        self._metrics_interval = metrics_interval
+        self._worker_main = worker_main
+        self._workers = [None] * worker_count
+        self._restart_at = [None] * worker_count
+        self._metrics_snapshots = {}
+        self._retired_metrics = ''
+        self._stopped = threading.Event()
+
+    def worker_environment(self, index):
+        environment = {
+            'WORKER_PROCESSES': '1',
+            'READINESS_FILE_PATH': worker_readiness_file(self._readiness_file, index),
+            'METRICS_PORT': '0',  # served by the supervisor
+        }
+        if os.getenv('OUTBOX_DIR'):
+            environment['OUTBOX_DIR'] = os.path.join(os.environ['OUTBOX_DIR'], f'worker-{index}')
+        return environment
+
+    def start_worker(self, index):
+        with suppress(FileNotFoundError):
+            os.remove(worker_readiness_file(self._readiness_file, index))  # left behind if the worker was killed
+        self.collect_metrics()
+        snapshot = self._metrics_snapshots.pop(index, None)
+        if snapshot:
+            self._retired_metrics = metrics.combine_metrics([self._retired_metrics, metrics.drop_gauges(snapshot)])
+        worker = self._context.Process(target=_run_worker, name=f'worker-{index}',
+                                       args=(self._worker_main, self._metrics_queue, index, self._metrics_interval))
+        with _environment(self.worker_environment(index)):
+            worker.start()
+        self._workers[index] = worker
+        self._restart_at[index] = None
+        logger.info('Started worker process', worker=index, pid=worker.pid)
+
+    def check_workers(self):
+        """
+        Restart workers which have exited, once their restart delay has passed
+        """
+        for index, worker in enumerate(self._workers):
+            if worker.is_alive():
+                continue
+            if self._restart_at[index] is None:
+                logger.error('Worker process exited, restarting', worker=index, pid=worker.pid,
+                             exitcode=worker.exitcode, restart_delay=self._restart_delay)
+                self._restart_at[index] = monotonic() + self._restart_delay
+            elif monotonic() >= self._restart_at[index]:
+                WORKER_RESTARTS.labels().inc()
+                self.start_worker(index)
+
+    def collect_metrics(self):
+        while True:
+            try:
+                index, text = self._metrics_queue.get_nowait()
+            except queue.Empty:
+                return
+            self._metrics_snapshots[index] = text
+
+    def update_readiness(self):
+        """
+        Hold the readiness file while every worker is running and ready
+        """
+        ready = [worker.is_alive() and os.path.exists(worker_readiness_file(self._readiness_file, index))
+                 for index, worker in enumerate(self._workers)]
+        WORKERS_READY.labels().set(sum(ready))
+        if all(ready) and not self._ready:
+            self._readiness.__enter__()
+            self._ready = True
+        elif not all(ready) and self._ready:
+            logger.warning('Not all worker processes are ready', ready=sum(ready), workers=len(ready))
+            self._readiness.__exit__(None, None, None)
+            self._ready = False
+
+    def render_metrics(self):
+        """
+        :return: the supervisor's metrics combined with the last metrics reported by each worker, and the counters and
+        histograms of the workers which have been restarted
+        """
+        return metrics.combine_metrics([metrics.render_metrics(), self._retired_metrics]
+                                       + list(self._metrics_snapshots.values()))
+
+    def run(self, check_interval=1):
+        """
+        Start the workers and supervise them until stopped, e.g. by SIGTERM
+        """
+        for index in range(len(self._workers)):
+            self.start_worker(index)
+        try:
+            while not self._stopped.wait(check_interval):
+                self.check_workers()
+                self.collect_metrics()
+                self.update_readiness()
+        finally:
+            self.stop_workers()
+
+    def stop(self, *_args):
+        self._stopped.set()
+
+    def stop_workers(self):
+        if self._ready:
+            self._readiness.__exit__(None, None, None)
+            self._ready = False
+        for worker in self._workers:
+            if worker and worker.is_alive():
+                worker.terminate()
+        for worker in self._workers:
+            if worker:
+                worker.join(WORKER_STOP_TIMEOUT)
+        logger.info('Stopped worker processes')
+
+
+def run_supervisor(worker_main, worker_count, readiness_file, metrics_port=metrics.METRICS_PORT):
+    """
+    Run the service in worker processes until the supervisor is terminated
+    """
+    supervisor = Supervisor(worker_main, worker_count, readiness_file)
+    signal.signal(signal.SIGTERM, supervisor.stop)
+    if metrics_port:
+        metrics.start_metrics_server(metrics_port, render=supervisor.render_metrics)
+    logger.info('Supervising worker processes', workers=worker_count)
+    supervisor.run()
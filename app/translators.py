@@ -0,0 +1,209 @@
+from google.cloud.pubsub_v1.subscriber.message import Message
+
+from app import json_codec
+from app.date_parsing import normalise_offline_datetime, normalise_rfc3339_datetime
+from app.stage_timing import NULL_TIMER
+
+
+class InvalidMessage(Exception):
+    """
+    Raised by the translators when a message fails validation, once the failure has been logged
+
+    :param reason: a short machine readable cause of the failure, e.g. `not_json`
+    """
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+def translate_eq_receipt(message: Message, log, timer=NULL_TIMER):
+    try:
+        if message.attributes['eventType'] != 'OBJECT_FINALIZE':  # only forward on object creation
+            log.error('Unknown Pub/Sub Message eventType', eventType=message.attributes['eventType'])
+            raise InvalidMessage('unknown_event_type')
+        bucket_name, object_name = message.attributes['bucketId'], message.attributes['objectId']
+    except KeyError as e:
+        log.error('Pub/Sub Message missing required attribute', missing_attribute=e.args[0])
+        raise InvalidMessage('missing_attribute')
+
+    timer.mark('validate')
+    log = log.bind(bucket_name=bucket_name, object_name=object_name)
+
+    payload, time_obj_created = validate_eq_receipt(message.data, log, ['timeCreated'], ['tx_id', 'questionnaire_id'],
+                                                    timer=timer)
+    metadata = payload['metadata']
+    tx_id, questionnaire_id, case_id = metadata['tx_id'], metadata['questionnaire_id'], metadata.get('case_id')
+
+    log = log.bind(questionnaire_id=questionnaire_id, created=time_obj_created, tx_id=tx_id, case_id=case_id)
+
+    receipt_message = {
+        'event': {
+            'type': 'RESPONSE_RECEIVED',
+            'source': 'RECEIPT_SERVICE',
+            'channel': 'EQ',
+            'dateTime': time_obj_created,
+            'transactionId': tx_id
+        },
+        'payload': {
+            'response': {
+                'caseId': case_id,
+                'questionnaireId': questionnaire_id,
+                'unreceipt': False
+            }
+        }
+    }
+    timer.mark('build')
+    return receipt_message, log
+
+
+def translate_offline_receipt(message: Message, log, timer=NULL_TIMER):
+    payload, time_obj_created = validate_offline_receipt(message.data, log,
+                                                         ['transactionId', 'questionnaireId', 'channel'], timer=timer)
+    tx_id, questionnaire_id, channel = payload['transactionId'], payload['questionnaireId'], payload['channel']
+
+    log = log.bind(questionnaire_id=questionnaire_id, created=time_obj_created, tx_id=tx_id, channel=channel)
+
+    receipt_message = {
+        'event': {
+            'type': 'RESPONSE_RECEIVED',
+            'source': 'RECEIPT_SERVICE',
+            'channel': channel,
+            'dateTime': time_obj_created,
+            'transactionId': tx_id
+        },
+        'payload': {
+            'response': {
+                'questionnaireId': questionnaire_id,
+                'unreceipt': payload.get('unreceipt', False)
+            }
+        }
+    }
+    timer.mark('build')
+    return receipt_message, log
+
+
+def translate_ppo_undelivered_mail(message: Message, log, timer=NULL_TIMER):
+    payload, date_time = validate_offline_receipt(message.data, log, ['transactionId', 'caseRef', 'productCode'],
+                                                  timer=timer)
+    tx_id, case_ref, product_code = payload['transactionId'], payload['caseRef'], payload['productCode']
+
+    log = log.bind(case_ref=case_ref, created=date_time, product_code=product_code, tx_id=tx_id)
+
+    undelivered_message = {
+        'event': {
+            'type': 'UNDELIVERED_MAIL_REPORTED',
+            'source': 'RECEIPT_SERVICE',
+            'channel': 'PPO',
+            'dateTime': date_time,
+            'transactionId': tx_id
+        },
+        'payload': {
+            'fulfilmentInformation': {
+                'caseRef': case_ref,
+                'fulfilmentCode': product_code
+            }
+        }
+    }
+    timer.mark('build')
+    return undelivered_message, log
+
+
+def translate_qm_undelivered_mail(message: Message, log, timer=NULL_TIMER):
+    payload, date_time = validate_offline_receipt(message.data, log, ['transactionId', 'questionnaireId'], timer=timer)
+    tx_id, questionnaire_id = payload['transactionId'], payload['questionnaireId']
+
+    log = log.bind(questionnaire_id=questionnaire_id, created=date_time, tx_id=tx_id)
+
+    undelivered_message = {
+        'event': {
+            'type': 'UNDELIVERED_MAIL_REPORTED',
+            'source': 'RECEIPT_SERVICE',
+            'channel': 'QM',
+            'dateTime': date_time,
+            'transactionId': tx_id
+        },
+        'payload': {
+            'fulfilmentInformation': {
+                'questionnaireId': questionnaire_id
+            }
+        }
+    }
+    timer.mark('build')
+    return undelivered_message, log
+
+
+TRANSLATORS = {
+    'eq_receipt': translate_eq_receipt,
+    'offline_receipt': translate_offline_receipt,
+    'ppo_undelivered_mail': translate_ppo_undelivered_mail,
+    'qm_undelivered_mail': translate_qm_undelivered_mail,
+}
+
+
+def validate_offline_receipt(message_data, log, expected_keys, date_time_key='dateTime', timer=NULL_TIMER):
+    """
+    :return: the parsed payload and its normalised ISO 8601 datetime
+    :raises: InvalidMessage if the message is invalid
+    """
+    try:
+        payload = json_codec.loads(message_data)  # parse metadata as JSON payload
+        timer.mark('decode')
+        for expected_key in expected_keys:
+            if expected_key not in payload:
+                log.error('Pub/Sub Message missing required data', missing_json_key=expected_key)
+                raise InvalidMessage('missing_data')
+        timer.mark('validate')
+
+        date_time = normalise_offline_datetime(payload[date_time_key])
+        timer.mark('datetime')
+
+        return payload, date_time
+    except (TypeError, json_codec.JSONDecodeError):
+        log.error('Pub/Sub Message data not JSON')
+        raise InvalidMessage('not_json')
+    except KeyError as e:
+        log.error('Pub/Sub Message missing required data', missing_json_key=e.args[0])
+        raise InvalidMessage('missing_data')
+    except ValueError:
+        log.error('Pub/Sub Message has invalid datetime string')
+        raise InvalidMessage('invalid_datetime')
+
+
+def validate_eq_receipt(message_data, log, expected_keys, expected_metadata_keys, date_time_key='timeCreated',
+                        timer=NULL_TIMER):
+    """
+    :return: the parsed payload and its normalised ISO 8601 datetime
+    :raises: InvalidMessage if the message is invalid
+    """
+    try:
+        payload = json_codec.loads(message_data)  # parse metadata as JSON payload
+        timer.mark('decode')
+        if 'metadata' not in payload:
+            log.error('Pub/Sub Message missing required data', missing_json_key='metadata')
+            raise InvalidMessage('missing_data')
+
+        for expected_key in expected_keys:
+            if expected_key not in payload:
+                log.error('Pub/Sub Message missing required data', missing_json_key=expected_key)
+                raise InvalidMessage('missing_data')
+
+        for expected_metadata_key in expected_metadata_keys:
+            if expected_metadata_key not in payload['metadata']:
+                log.error('Pub/Sub Message missing required data', missing_json_key=expected_metadata_key)
+                raise InvalidMessage('missing_data')
+        timer.mark('validate')
+
+        date_time = normalise_rfc3339_datetime(payload[date_time_key])
+        timer.mark('datetime')
+
+        return payload, date_time
+    except (TypeError, json_codec.JSONDecodeError):
+        log.error('Pub/Sub Message data not JSON')
+        raise InvalidMessage('not_json')
+    except KeyError as e:
+        log.error('Pub/Sub Message missing required data', missing_json_key=e.args[0])
+        raise InvalidMessage('missing_data')
+    except ValueError:
+        log.error('Pub/Sub Message has invalid datetime string')
+        raise InvalidMessage('invalid_datetime')
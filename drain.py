@@ -0,0 +1,195 @@
+"""
+Drain the backlog of one or more subscriptions as fast as possible, e.g. after an outage, then report on it.
+
+Usage:
+    python drain.py SUBSCRIPTION [SUBSCRIPTION ...] [--deadline SECONDS] [--concurrency N] [--batch-size N]
+
+SUBSCRIPTION is a key of the subscription registry, e.g. `eq_receipt`, or a Pub/Sub subscription name. Messages are
+pulled and handled in batches as in the batch pull mode of run.py, until pulls find every subscription empty or the
+deadline passes. The counts of processed, failed and duplicate messages, the sustained msgs/s and the latency from
+pulling a message to rabbitmq confirming it are printed at the end.
+
+Invalid messages which are not quarantined are redelivered until the subscription's dead letter policy, if any,
+moves them aside. Each is counted as failed once and its redeliveries do not keep the drain going.
+
+Exit status is 0 once the backlog is drained, 1 if any message failed or a Pub/Sub request failed, 2 for bad
+arguments and 3 if the deadline passed before the backlog was drained.
+"""
+from app.helpers import use_max_throughput_settings
+
+use_max_throughput_settings(PUBLISH_BATCH_MAX_MESSAGES='1000')  # before the app modules read them
+
+import argparse  # noqa: E402
+import logging  # noqa: E402
+import os  # noqa: E402
+import sys  # noqa: E402
+import threading  # noqa: E402
+from collections import Counter, OrderedDict  # noqa: E402
+from concurrent.futures import ThreadPoolExecutor  # noqa: E402
+from time import monotonic, sleep  # noqa: E402
+
+from structlog import wrap_logger  # noqa: E402
+
+from app.app_logging import logger_initial_config  # noqa: E402
+from app.dedup import init_dedup_index  # noqa: E402
+from app.helpers import percentile, select_subscriptions  # noqa: E402
+from app.publisher import init_publisher, publisher  # noqa: E402
+from app.subscriber import PULL_BATCH_SIZE, PULL_TIMEOUT, client, pull_batch  # noqa: E402
+from app.subscription_config import load_subscriptions  # noqa: E402
+
+EXIT_DRAINED, EXIT_FAILURES, EXIT_USAGE, EXIT_DEADLINE = 0, 1, 2, 3
+MAX_CONSECUTIVE_ERRORS = 5  # failed Pub/Sub requests in a row before a draining thread gives up
+ERROR_RETRY_DELAY = 1  # seconds, doubling after each failed request in a row
+
+logger = wrap_logger(logging.getLogger(__name__))
+
+
+class DrainReport:
+    """
+    Totals the outcomes of the pulled batches of each subscription, and the latency of each processed message.
+
+    Messages which fail, e.g. invalid messages which are not quarantined, are redelivered until they are processed
+    or the subscription's dead letter policy moves them aside. Each is counted as failed once, by message ID, and
+    its redeliveries are counted separately.
+    """
+
+    def __init__(self, subscription_keys):
+        self.counts = OrderedDict((key, Counter()) for key in subscription_keys)
+        self.failed = {key: set() for key in self.counts}  # IDs of messages which failed and were not processed since
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    def add_batch(self, subscription_key, batch):
+        """
+        :return: whether the batch had any messages other than redeliveries of failed ones
+        """
+        confirmed = batch.confirmed()
+        settled = set(confirmed).union(batch.duplicates)
+        settled_ids = {batch.message_ids[ack_id] for ack_id in settled}
+        failed_ids = {message_id for ack_id, message_id in batch.message_ids.items() if ack_id not in settled}
+        with self._lock:
+            counts, failed = self.counts[subscription_key], self.failed[subscription_key]
+            redelivered = len(failed_ids & failed)
+            failed -= settled_ids
+            failed |= failed_ids  # invalid, rejected or not confirmed
+            counts['pulled'] += batch.size
+            counts['processed'] += len(confirmed)
+            counts['duplicates'] += len(batch.duplicates)
+            counts['redelivered'] += redelivered
+            counts['failed'] = len(failed)
+            self.latencies.extend(batch.settled_at[ack_id] - batch.pulled_at for ack_id in confirmed)
+        return batch.size > redelivered
+
+    def add_error(self, subscription_key):
+        with self._lock:
+            self.counts[subscription_key]['errors'] += 1
+
+    def total(self, name):
+        return sum(counts[name] for counts in self.counts.values())
+
+
+def drain_subscription(subscription, report, deadline, batch_size, empty_pulls):
+    """
+    Pull and handle batches until `empty_pulls` pulls in a row find nothing but redeliveries of failed messages, or
+    the deadline passes. Failed Pub/Sub requests are counted as errors and retried, up to MAX_CONSECUTIVE_ERRORS in a
+    row.
+
+    :return: whether the subscription was drained before the deadline
+    """
+    subscription_path = client.subscription_path(subscription.subscription_project_id, subscription.subscription_name)
+    empty = errors = 0
+    while empty < empty_pulls:
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            return False
+        try:
+            batch = pull_batch(subscription, subscription_path, batch_size, timeout=min(PULL_TIMEOUT, remaining))
+        except Exception as e:
+            report.add_error(subscription.key)
+            errors += 1
+            logger.error('Failed to drain a batch', subscription=subscription.key, errors=errors, error=repr(e))
+            if errors >= MAX_CONSECUTIVE_ERRORS:
+                return False
+            sleep(min(ERROR_RETRY_DELAY * 2 ** (errors - 1), max(deadline - monotonic(), 0)))
+            continue
+        errors = 0
+        empty = 0 if report.add_batch(subscription.key, batch) else empty + 1
+    return True
+
+
+def drain(subscriptions, deadline_seconds, concurrency, batch_size=PULL_BATCH_SIZE, empty_pulls=2):
+    """
+    Drain the subscriptions, each on `concurrency` pulling threads
+
+    :return: the DrainReport, and whether every subscription was drained before the deadline
+    """
+    report = DrainReport(subscription.key for subscription in subscriptions)
+    deadline = monotonic() + deadline_seconds
+    with ThreadPoolExecutor(max_workers=len(subscriptions) * concurrency, thread_name_prefix='drain') as executor:
+        futures = [executor.submit(drain_subscription, subscription, report, deadline, batch_size, empty_pulls)
+                   for subscription in subscriptions for _ in range(concurrency)]
+        drained = all([future.result() for future in futures])
+    return report, drained
+
+
+REPORT_COLUMNS = ('pulled', 'processed', 'duplicates', 'failed', 'redelivered', 'errors')
+
+
+def print_report(report, elapsed, drained):
+    print(f"{'subscription':<18}" + ''.join(f'{column:>12}' for column in REPORT_COLUMNS))
+    for key, counts in report.counts.items():
+        print(f'{key:<18}' + ''.join(f'{counts[column]:>12}' for column in REPORT_COLUMNS))
+    print(f"{'total':<18}" + ''.join(f'{report.total(column):>12}' for column in REPORT_COLUMNS))
+
+    print(f'Elapsed {elapsed:.1f}s, {report.total("pulled") / elapsed:.1f} msgs/s')
+    latencies = sorted(report.latencies)
+    if latencies:
+        print('Latency from pull to rabbitmq confirm: ' + ', '.join(
+            f'{label} {percentile(latencies, fraction) * 1000:.1f}ms'
+            for label, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1))))
+    print('Backlog drained' if drained else 'Deadline passed before the backlog was drained')
+
+
+def exit_status(report, drained):
+    if report.total('failed') or report.total('errors'):
+        return EXIT_FAILURES
+    return EXIT_DRAINED if drained else EXIT_DEADLINE
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Drain the backlog of subscriptions and report on it')
+    parser.add_argument('subscriptions', nargs='+', help='subscription keys or Pub/Sub subscription names')
+    parser.add_argument('--deadline', type=float, default=3600, help='seconds to drain for at most')
+    parser.add_argument('--concurrency', type=int, default=8, help='batches handled at once per subscription')
+    parser.add_argument('--batch-size', type=int, default=PULL_BATCH_SIZE, help='messages per pull')
+    parser.add_argument('--empty-pulls', type=int, default=2,
+                        help='pulls in a row finding nothing before a subscription is treated as drained')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    logger_initial_config(service_name='census-rm-pubsub-drain', log_level=os.getenv('LOG_LEVEL', 'INFO'))
+
+    try:
+        subscriptions = select_subscriptions(load_subscriptions(enabled=None), args.subscriptions)
+    except KeyError as e:
+        print(f'Unknown subscription {e}', file=sys.stderr)
+        sys.exit(EXIT_USAGE)
+
+    init_dedup_index()
+    init_publisher()
+
+    started = monotonic()
+    try:
+        report, drained = drain(subscriptions, args.deadline, args.concurrency, args.batch_size, args.empty_pulls)
+    finally:
+        publisher.stop(timeout=10)
+    elapsed = monotonic() - started
+
+    print_report(report, elapsed, drained)
+    sys.exit(exit_status(report, drained))
+
+
+if __name__ == '__main__':
+    main()
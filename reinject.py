@@ -0,0 +1,144 @@
+"""
+Re-inject quarantined messages, once fixed, by translating them and publishing the events to rabbitmq.
+
+Usage:
+    python reinject.py QUARANTINE_FILE [--remaining-file PATH] [--dry-run]
+
+QUARANTINE_FILE is a JSON Lines file of quarantine records, as written to $QUARANTINE_DIR/quarantine.jsonl, with
+the `data` or `attributes` of each record corrected. The events are published through a confirm publisher, and a
+record only counts as re-injected once rabbitmq confirms its event. Records which still fail validation, or whose
+event rabbitmq did not confirm, are written to the remaining file, so they can be fixed or retried.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+
+from structlog import wrap_logger
+
+from app import json_codec
+from app.app_logging import logger_initial_config
+from app.helpers import ConfirmBatch
+from app.publisher import RABBIT_CONNECT_TIMEOUT, ConfirmPublisher, max_batch_size
+from app.quarantine import record_data
+from app.stage_timing import NULL_TIMER
+from app.translators import TRANSLATORS, InvalidMessage
+
+UNCONFIRMED = 'unconfirmed'  # the reason given to remaining records whose event rabbitmq did not confirm
+
+logger = wrap_logger(logging.getLogger(__name__))
+
+
+class ReinjectedMessage:
+    """
+    Stands in for the Pub/Sub message of a quarantine record, so it can be translated as one and the confirm
+    publisher can ack or nack it
+    """
+
+    def __init__(self, record):
+        self.message_id = record['message_id']
+        self.attributes = record.get('attributes', {})
+        self.data = record_data(record)
+        self.batch = None  # set once the message is published
+        self.acked = False
+
+    def ack(self):
+        self.acked = True
+        self.batch.settle(True)
+
+    def nack(self):
+        self.batch.settle(False)
+
+
+def reinject(records, confirm_publisher=None, dry_run=False):
+    """
+    :param records: quarantine records
+    :param confirm_publisher: a started ConfirmPublisher to publish the events with, unless a dry run
+    :param dry_run: translate the records without publishing them
+    :return: the records which still fail validation, or whose event rabbitmq did not confirm
+    """
+    remaining, translated = [], []
+    for record in records:
+        message = ReinjectedMessage(record)
+        log = logger.bind(message_id=record['message_id'], subscription=record['subscription'])
+        try:
+            event_message, log = TRANSLATORS[record['translator']](message, log)
+        except InvalidMessage as e:
+            remaining.append(dict(record, reason=e.reason))
+            continue
+        translated.append((record, message, json_codec.dumps(event_message), log))
+
+    if not dry_run:
+        _publish_confirmed(translated, confirm_publisher)
+    for record, message, _, log in translated:
+        if dry_run or message.acked:
+            log.info('Re-injected quarantined message', dry_run=dry_run)
+        else:
+            log.error('Rabbitmq did not confirm re-injected message')
+            remaining.append(dict(record, reason=UNCONFIRMED))
+    return remaining
+
+
+def _publish_confirmed(translated, confirm_publisher):
+    """
+    Publish the translated events and wait for rabbitmq to confirm or reject every one of them
+    """
+    batch = ConfirmBatch(len(translated))
+    publish_batch_size = max_batch_size(len(translated), confirm_publisher)
+    for start in range(0, len(translated), publish_batch_size):
+        publish_batch = []
+        for record, message, body, _ in translated[start:start + publish_batch_size]:
+            message.batch = batch
+            publish_batch.append((message, body, record['routing_key'], record['subscription'], NULL_TIMER))
+        confirm_publisher.publish_batch(publish_batch)
+    batch.settled.wait()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Re-inject fixed quarantined messages')
+    parser.add_argument('quarantine_file')
+    parser.add_argument('--remaining-file', help='where to write records which are still invalid, '
+                                                 'defaults to QUARANTINE_FILE.remaining')
+    parser.add_argument('--dry-run', action='store_true', help='validate and translate without publishing')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    logger_initial_config(service_name="census-rm-pubsub-reinject", log_level=os.getenv("LOG_LEVEL", "INFO"))
+
+    with open(args.quarantine_file) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+
+    confirm_publisher = None
+    if not args.dry_run:
+        confirm_publisher = ConfirmPublisher()
+        confirm_publisher.start()
+    try:
+        if confirm_publisher and not confirm_publisher.wait_until_ready(RABBIT_CONNECT_TIMEOUT):
+            print(f'Could not connect to rabbitmq in {RABBIT_CONNECT_TIMEOUT}s', file=sys.stderr)
+            sys.exit(1)
+        remaining = reinject(records, confirm_publisher, args.dry_run)
+    finally:
+        if confirm_publisher:
+            confirm_publisher.stop(timeout=10)
+
+    remaining_file = args.remaining_file or args.quarantine_file + '.remaining'
+    if remaining:
+        with open(remaining_file, 'w') as f:
+            f.writelines(json.dumps(record) + '\n' for record in remaining)
+
+    print(f'Re-injected {len(records) - len(remaining)} of {len(records)} quarantined messages'
+          + (' (dry run)' if args.dry_run else ''))
+    unconfirmed = sum(record['reason'] == UNCONFIRMED for record in remaining)
+    if unconfirmed:
+        print(f'{unconfirmed} messages were not confirmed by rabbitmq, written to {remaining_file} to retry')
+    if len(remaining) > unconfirmed:
+        print(f'{len(remaining) - unconfirmed} messages are still invalid, written to {remaining_file}')
+    if remaining:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
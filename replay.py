@@ -0,0 +1,381 @@
+"""
+Replay an export of Pub/Sub messages into rabbitmq, e.g. to reprocess a day of EQ or offline receipts.
+
+Usage:
+    python replay.py EXPORT_FILE --subscription SUBSCRIPTION [--rate MSGS_PER_SECOND] [--publishers N]
+                     [--start-offset BYTES] [--checkpoint-file PATH] [--invalid-file PATH] [--base64] [--dry-run]
+
+EXPORT_FILE is a JSON Lines file with the `data` and `attributes` of a Pub/Sub message on each line, and optionally
+its `message_id`. Quarantine files have this layout too. `data` is the message data as a string, or base64 encoded
+with --base64. SUBSCRIPTION is a key of the subscription registry, e.g. `eq_receipt`, or a Pub/Sub subscription
+name, and picks the translator and routing key, as for messages received on that subscription.
+
+The file is memory mapped and streamed rather than read into memory. Each record is validated and translated as
+app.subscriber does, and published through a pool of confirm publishers. The byte offset the file has been
+replayed up to is written to the checkpoint file, by default EXPORT_FILE.checkpoint, once rabbitmq has confirmed
+every record before it, and a rerun resumes from there. Records which fail validation are written to the invalid
+file, by default EXPORT_FILE.invalid, as quarantine records which can be fixed and re-injected with reinject.py.
+
+A dry run only validates and translates the records, without connecting to rabbitmq or moving the checkpoint.
+
+Exit status is 0 once every record is replayed, 1 if any record is invalid or was not confirmed by rabbitmq, and 2
+for bad arguments.
+"""
+from app.helpers import use_max_throughput_settings
+
+use_max_throughput_settings()  # before the app modules read them
+
+import argparse  # noqa: E402
+import base64  # noqa: E402
+import json  # noqa: E402
+import logging  # noqa: E402
+import mmap  # noqa: E402
+import os  # noqa: E402
+import sys  # noqa: E402
+from collections import Counter, deque  # noqa: E402
+from itertools import cycle  # noqa: E402
+from time import monotonic, sleep  # noqa: E402
+
+from structlog import wrap_logger  # noqa: E402
+
+from app import json_codec  # noqa: E402
+from app.app_logging import logger_initial_config  # noqa: E402
+from app.helpers import ConfirmBatch, select_subscriptions, write_checkpoint  # noqa: E402
+from app.publisher import RABBIT_CONNECT_TIMEOUT, ConfirmPublisher, max_batch_size  # noqa: E402
+from app.quarantine import quarantine_record  # noqa: E402
+from app.stage_timing import NULL_TIMER  # noqa: E402
+from app.subscription_config import load_subscriptions  # noqa: E402
+from app.translators import TRANSLATORS, InvalidMessage  # noqa: E402
+
+EXIT_REPLAYED, EXIT_FAILURES, EXIT_USAGE = 0, 1, 2
+
+REPLAY_CHUNK_SIZE = 5000  # records confirmed before the checkpoint moves
+REPLAY_PUBLISH_BATCH_SIZE = 500  # records handed to a publisher at once
+REPLAY_CHUNKS_IN_FLIGHT = 2  # chunks published before waiting for the oldest to be confirmed
+
+logger = wrap_logger(logging.getLogger(__name__))
+
+
+class ReplayedMessage:
+    """
+    Stands in for a Pub/Sub message when an exported record is replayed, so it can be translated as one and the
+    confirm publisher can ack or nack it
+    """
+    __slots__ = ('message_id', 'data', 'attributes', 'chunk')
+
+    def __init__(self, message_id, data, attributes):
+        self.message_id = message_id
+        self.data = data
+        self.attributes = attributes
+        self.chunk = None  # set once the message's chunk is published
+
+    def ack(self):
+        self.chunk.settle(True)
+
+    def nack(self):
+        self.chunk.settle(False)
+
+
+class _ReplayChunk(ConfirmBatch):
+
+    def __init__(self, size, end_offset):
+        super().__init__(size)
+        self.end_offset = end_offset
+
+
+class RateLimiter:
+    """
+    Paces records to at most `rate` a second on average, from when the limiter was created, so time lost to a slow
+    publish is made up rather than the rate drifting. A rate of 0 is unlimited.
+    """
+
+    def __init__(self, rate):
+        self._interval = 1 / rate if rate else 0
+        self._started = monotonic()
+        self._count = 0
+
+    def wait(self, count=1):
+        """
+        Wait until the next `count` records are due
+        """
+        if not self._interval:
+            return
+        delay = self._started + self._count * self._interval - monotonic()
+        self._count += count
+        if delay > 0:
+            sleep(delay)
+
+
+def read_checkpoint(path):
+    """
+    :return: the byte offset of the export replayed up to, 0 if there is no checkpoint
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)['offset']
+    except FileNotFoundError:
+        return 0
+
+
+def read_lines(export, offset):
+    """
+    :param export: the memory mapped export file
+    :return: an iterator of (offset, line, end offset) for each line from `offset` on, skipping blank lines
+    """
+    size = len(export)
+    while offset < size:
+        end = export.find(b'\n', offset)
+        end = size if end == -1 else end + 1
+        line = export[offset:end]
+        if line.strip():
+            yield offset, line, end
+        offset = end
+
+
+def parse_record(line, offset, base64_data=False):
+    """
+    :return: a ReplayedMessage of the exported record
+    :raises: ValueError if the line or its attributes are not a JSON object, or its data is not valid base64
+    """
+    record = json.loads(line)
+    if not isinstance(record, dict):
+        raise ValueError('Exported record is not a JSON object')
+    attributes = record.get('attributes') or {}
+    if not isinstance(attributes, dict):
+        raise ValueError('Exported record attributes are not a JSON object')
+    data = record.get('data')
+    if isinstance(data, str):
+        data = base64.b64decode(data, validate=True) if base64_data else data.encode('utf-8', 'surrogateescape')
+    elif data is not None:
+        data = json_codec.dumps(data)  # exported already parsed
+    message_id = record.get('message_id') or record.get('messageId') or f'offset-{offset}'
+    return ReplayedMessage(message_id, data, attributes)
+
+
+class Replay:
+    """
+    Replays an export into rabbitmq, or validates it in a dry run, counting the outcome of every record.
+
+    The export is read in chunks of `chunk_size` records. Each chunk's valid records are handed to the publishers in
+    turn and the checkpoint moves to the end of a chunk once rabbitmq has confirmed all of them. Up to
+    REPLAY_CHUNKS_IN_FLIGHT chunks are published before waiting on the oldest, so reading and translating the next
+    chunk overlaps with waiting for confirms. Replaying stops at the first chunk which is not fully confirmed.
+
+    :param publishers: started ConfirmPublishers, None for a dry run
+    :param invalid_file: a file object to write quarantine records of invalid records to, or None
+    :param checkpoint_file: the path to write the checkpoint to, or None
+    """
+
+    def __init__(self, subscription, publishers=None, rate=0, chunk_size=REPLAY_CHUNK_SIZE, base64_data=False,
+                 invalid_file=None, checkpoint_file=None, publish_batch_size=REPLAY_PUBLISH_BATCH_SIZE):
+        self._subscription = subscription
+        self._translate = TRANSLATORS[subscription.translator]
+        self._publishers = cycle(publishers) if publishers else None
+        self._limiter = RateLimiter(rate)
+        self._chunk_size = chunk_size
+        self._base64_data = base64_data
+        self._invalid_file = invalid_file
+        self._checkpoint_file = checkpoint_file
+        if publishers:
+            publish_batch_size = max_batch_size(publish_batch_size, *publishers)
+        # small enough batches for the rate limiter to pace smoothly, at most 50ms worth
+        self._publish_batch_size = max(1, min(publish_batch_size, int(rate / 20))) if rate else publish_batch_size
+        self._log = logger.bind(subscription=subscription.key)
+        self.counts = Counter()
+        self.offset = 0
+
+    def run(self, export, offset=0):
+        """
+        Replay the memory mapped export from the byte offset
+
+        :return: whether every record after the offset was replayed, or validated in a dry run
+        """
+        self.offset = offset
+        in_flight = deque()
+        lines = read_lines(export, offset)
+        while True:
+            chunk_lines = [line for _, line in zip(range(self._chunk_size), lines)]
+            if not chunk_lines:
+                break
+            in_flight.append(self._replay_chunk(chunk_lines))
+            if len(in_flight) >= REPLAY_CHUNKS_IN_FLIGHT and not self._confirm(in_flight.popleft()):
+                in_flight.clear()
+                break
+        while in_flight:
+            if not self._confirm(in_flight.popleft()):
+                break
+        return not self.counts['invalid'] and not self.counts['failed']
+
+    def _replay_chunk(self, chunk_lines):
+        valid = []
+        for offset, line, _ in chunk_lines:
+            self.counts['records'] += 1
+            message = self._translate_record(offset, line)
+            if message is not None:
+                valid.append(message)
+        end_offset = chunk_lines[-1][2]
+        if self._publishers is None:
+            return _ReplayChunk(0, end_offset)  # nothing to confirm in a dry run
+        chunk = _ReplayChunk(len(valid), end_offset)
+
+        routing_key, subscription_name = self._subscription.routing_key, self._subscription.subscription_name
+        for start in range(0, len(valid), self._publish_batch_size):
+            batch = valid[start:start + self._publish_batch_size]
+            self._limiter.wait(len(batch))
+            for message, _ in batch:
+                message.chunk = chunk
+            next(self._publishers).publish_batch([(message, body, routing_key, subscription_name, NULL_TIMER)
+                                                  for message, body in batch])
+        return chunk
+
+    def _translate_record(self, offset, line):
+        """
+        :return: the (ReplayedMessage, event body) of a valid record, or None if it is invalid
+        """
+        log = self._log.bind(offset=offset)
+        try:
+            message = parse_record(line, offset, self._base64_data)
+        except ValueError as e:
+            log.error('Exported record is malformed', error=repr(e))
+            self._record_invalid(ReplayedMessage(f'offset-{offset}', line.rstrip(b'\n'), {}), 'malformed')
+            return None
+        try:
+            event_message, _ = self._translate(message, log.bind(message_id=message.message_id))
+        except InvalidMessage as e:
+            self._record_invalid(message, e.reason)
+            return None
+        self.counts['valid'] += 1
+        return message, json_codec.dumps(event_message)
+
+    def _record_invalid(self, message, reason):
+        self.counts['invalid'] += 1
+        if self._invalid_file:
+            self._invalid_file.write(json.dumps(quarantine_record(self._subscription, message, reason)) + '\n')
+
+    def _confirm(self, chunk):
+        """
+        Wait for rabbitmq to confirm a published chunk, then move the checkpoint past it
+
+        :return: whether every record in the chunk was confirmed
+        """
+        chunk.settled.wait()
+        if not chunk.all_acked:
+            self.counts['failed'] += chunk.size
+            self._log.error('Rabbitmq did not confirm replayed records, stopping at the checkpoint',
+                            offset=self.offset)
+            return False
+        if self._publishers is not None:
+            self.counts['published'] += chunk.size
+            if self._checkpoint_file:
+                write_checkpoint(self._checkpoint_file, {'offset': chunk.end_offset})
+        self.offset = chunk.end_offset
+        return True
+
+
+def start_publishers(count, timeout=RABBIT_CONNECT_TIMEOUT):
+    """
+    :return: `count` ConfirmPublishers, each with its own connection and confirmed channel
+    :raises: RuntimeError if any of them cannot connect to rabbitmq in time
+    """
+    publishers = [ConfirmPublisher() for _ in range(count)]
+    for confirm_publisher in publishers:
+        confirm_publisher.start()
+    for confirm_publisher in publishers:
+        if not confirm_publisher.wait_until_ready(timeout):
+            stop_publishers(publishers)
+            raise RuntimeError(f'Could not connect to rabbitmq in {timeout}s')
+    return publishers
+
+
+def stop_publishers(publishers):
+    for confirm_publisher in publishers:
+        confirm_publisher.stop(timeout=10)
+
+
+def replay_export(args, subscription, publishers):
+    """
+    :return: the finished Replay, and whether every record was replayed
+    """
+    checkpoint_file = None if args.dry_run else args.checkpoint_file or args.export_file + '.checkpoint'
+    if args.start_offset is not None:
+        offset = args.start_offset
+    else:
+        offset = read_checkpoint(checkpoint_file) if checkpoint_file else 0
+    invalid_path = args.invalid_file or args.export_file + '.invalid'
+
+    # resuming appends to the invalid records found before the checkpoint
+    with open(invalid_path, 'a' if offset else 'w') as invalid_file:
+        replay = Replay(subscription, publishers, rate=args.rate, chunk_size=args.chunk_size,
+                        base64_data=args.base64, invalid_file=invalid_file, checkpoint_file=checkpoint_file)
+        replayed = True
+        if os.path.getsize(args.export_file):  # an empty file cannot be memory mapped
+            with open(args.export_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as export:
+                if hasattr(export, 'madvise'):
+                    export.madvise(mmap.MADV_SEQUENTIAL)
+                replayed = replay.run(export, offset)
+    if not os.path.getsize(invalid_path):
+        os.remove(invalid_path)
+    return replay, replayed
+
+
+def print_report(replay, elapsed, dry_run, invalid_file):
+    counts = replay.counts
+    action = 'Validated' if dry_run else 'Replayed'
+    print(f"{action} {counts['records']} records in {elapsed:.1f}s, {counts['records'] / elapsed:.1f} records/s: "
+          f"{counts['valid']} valid, {counts['invalid']} invalid"
+          + ('' if dry_run else f", {counts['published']} published, {counts['failed']} not confirmed"))
+    if counts['invalid']:
+        print(f"{counts['invalid']} invalid records written to {invalid_file}")
+    if counts['failed']:
+        print(f'Stopped at offset {replay.offset}, rerun to resume from the checkpoint')
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Replay an export of Pub/Sub messages into rabbitmq')
+    parser.add_argument('export_file')
+    parser.add_argument('--subscription', required=True,
+                        help='subscription key or Pub/Sub subscription name to translate and route the records as')
+    parser.add_argument('--rate', type=float, default=0, help='records published per second at most, 0 for no limit')
+    parser.add_argument('--publishers', type=int, default=2, help='confirm publishers, each with its own connection')
+    parser.add_argument('--chunk-size', type=int, default=REPLAY_CHUNK_SIZE,
+                        help='records confirmed before the checkpoint moves')
+    parser.add_argument('--start-offset', type=int, help='byte offset to start from, instead of the checkpoint')
+    parser.add_argument('--checkpoint-file', help='defaults to EXPORT_FILE.checkpoint')
+    parser.add_argument('--invalid-file', help='where to write invalid records, defaults to EXPORT_FILE.invalid')
+    parser.add_argument('--base64', action='store_true', help='the data of each record is base64 encoded')
+    parser.add_argument('--dry-run', action='store_true', help='validate and translate without publishing')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    logger_initial_config(service_name='census-rm-pubsub-replay', log_level=os.getenv('LOG_LEVEL', 'INFO'))
+
+    try:
+        subscription, = select_subscriptions(load_subscriptions(enabled=None), [args.subscription])
+    except KeyError as e:
+        print(f'Unknown subscription {e}', file=sys.stderr)
+        sys.exit(EXIT_USAGE)
+    if not os.path.isfile(args.export_file):
+        print(f'No export file {args.export_file}', file=sys.stderr)
+        sys.exit(EXIT_USAGE)
+
+    try:
+        publishers = None if args.dry_run else start_publishers(args.publishers)
+    except RuntimeError as e:
+        print(e, file=sys.stderr)
+        sys.exit(EXIT_FAILURES)
+    started = monotonic()
+    try:
+        replay, replayed = replay_export(args, subscription, publishers)
+    finally:
+        if publishers:
+            stop_publishers(publishers)
+    elapsed = monotonic() - started
+
+    print_report(replay, elapsed, args.dry_run, args.invalid_file or args.export_file + '.invalid')
+    sys.exit(EXIT_REPLAYED if replayed else EXIT_FAILURES)
+
+
+if __name__ == '__main__':
+    main()
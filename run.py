@@ -5,12 +5,18 @@ from time import sleep
 from structlog import wrap_logger
 
 from app.app_logging import logger_initial_config
-from app.rabbit_helper import init_rabbitmq
+from app.async_engine import run_async_engine
+from app.dedup import init_dedup_index
+from app.executor import executor_stats
+from app.metrics import METRICS_PORT, start_metrics_server
+from app.outbox import init_outbox
+from app.publisher import init_publisher
 from app.readiness import Readiness
-from app.subscriber import setup_subscription, OFFLINE_SUBSCRIPTION_NAME, offline_receipt_to_case, \
-    OFFLINE_SUBSCRIPTION_PROJECT_ID, PPO_UNDELIVERED_SUBSCRIPTION_NAME, PPO_UNDELIVERED_SUBSCRIPTION_PROJECT_ID, \
-    ppo_undelivered_mail_to_case, QM_UNDELIVERED_SUBSCRIPTION_NAME, QM_UNDELIVERED_SUBSCRIPTION_PROJECT_ID, \
-    qm_undelivered_mail_to_case
+from app.subscriber import client, setup_batch_subscriptions, setup_subscriptions
+from app.subscription_config import load_subscriptions
+from app.supervisor import WORKER_PROCESSES, run_supervisor
+
+RUN_MODE = os.getenv("RUN_MODE", "threaded")
 
 logger = wrap_logger(logging.getLogger(__name__))
 
@@ -21,25 +27,47 @@ def main():
     """
     logger_initial_config(service_name="census-rm-pubsub", log_level=os.getenv("LOG_LEVEL", "INFO"))
 
-    init_rabbitmq()  # test the connection to the rabbitmq cluster
+    readiness_file = os.getenv('READINESS_FILE_PATH', os.path.join(os.getcwd(), 'pubsub-ready'))
+    if WORKER_PROCESSES > 1:
+        run_supervisor(main, WORKER_PROCESSES, readiness_file)  # each worker process runs main itself
+        return
+
+    subscriptions = load_subscriptions()
+    logger.info('Loaded subscription config', subscriptions=list(subscriptions))
+
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+
+    init_dedup_index()  # restore the published transaction IDs from before a restart, when configured
+    readiness = Readiness(readiness_file)
+
+    if RUN_MODE == 'asyncio':
+        logger.info('Running subscriptions on the asyncio engine')
+        run_async_engine(subscriptions.values(), client, readiness)
+    elif RUN_MODE == 'batch_pull':
+        run_threaded(subscriptions, readiness, setup=setup_batch_subscriptions)
+    else:
+        run_threaded(subscriptions, readiness)
+
+
+def run_threaded(subscriptions, readiness, setup=setup_subscriptions):
+    """
+    Run the subscriptions on streaming pull callback threads, or on batch pulling threads, publishing with the
+    threaded confirm publisher
+    """
+    init_outbox()  # journal messages while rabbitmq is unavailable, when configured
+    init_publisher()  # connect the confirm publisher to the rabbitmq cluster
 
-    futures = [setup_subscription(),
-               setup_subscription(subscription_name=OFFLINE_SUBSCRIPTION_NAME, callback=offline_receipt_to_case,
-                                  subscription_project_id=OFFLINE_SUBSCRIPTION_PROJECT_ID),
-               setup_subscription(subscription_name=PPO_UNDELIVERED_SUBSCRIPTION_NAME,
-                                  callback=ppo_undelivered_mail_to_case,
-                                  subscription_project_id=PPO_UNDELIVERED_SUBSCRIPTION_PROJECT_ID),
-               setup_subscription(subscription_name=QM_UNDELIVERED_SUBSCRIPTION_NAME,
-                                  callback=qm_undelivered_mail_to_case,
-                                  subscription_project_id=QM_UNDELIVERED_SUBSCRIPTION_PROJECT_ID)]
-    with Readiness(os.getenv('READINESS_FILE_PATH',
-                             os.path.join(os.getcwd(), 'pubsub-ready'))):  # Indicate ready after successful setup
+    futures = setup(subscriptions.values())
+    with readiness:  # Indicate ready after successful setup
 
         while True:
             sleep(10)
             for future in futures:
                 if not future.running():
                     raise future.exception(timeout=0) or RuntimeError('Thread exited unexpectedly')
+            for subscription_name, stats in executor_stats().items():
+                logger.info('Subscription executor stats', subscription_name=subscription_name, **stats)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,230 @@
+"""
+In-process throughput and latency benchmark for the subscriber callbacks.
+
+Drives synthetic Pub/Sub messages for every built in subscription, including a share of invalid ones, through
+app.subscriber.process_message against a fake publisher and reports msgs/s and p50/p99 per message latency. Every
+message is unique, and the caches are warmed up on messages of their own, so none of the measured messages are
+fast rejected or deduplicated.
+With `--engine asyncio` the messages are handled by app.async_engine instead, `--concurrency` at a time.
+
+Usage:
+    python -m test.benchmark.benchmark_subscriber                   # run and print results
+    python -m test.benchmark.benchmark_subscriber --engine asyncio  # run the asyncio engine, compared to threaded
+    python -m test.benchmark.benchmark_subscriber --save-baseline   # run and store results as the baseline
+    python -m test.benchmark.benchmark_subscriber --compare         # run and fail on regression against baseline
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import uuid
+from time import perf_counter
+from unittest.mock import patch
+
+os.environ.setdefault('PUBSUB_EMULATOR_HOST', 'localhost:8539')  # the subscriber client needs no credentials
+
+from google.cloud.pubsub_v1 import types  # noqa: E402
+from google.cloud.pubsub_v1.subscriber.message import Message  # noqa: E402
+
+from app.app_logging import logger_initial_config  # noqa: E402
+from app.async_engine import AsyncEngine  # noqa: E402
+from app.helpers import percentile  # noqa: E402
+from app.subscriber import process_message  # noqa: E402
+from app.subscription_config import load_subscriptions  # noqa: E402
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+class _DiscardQueue:
+    """
+    Stands in for the streaming pull manager's request queue, which acks and nacks are put on
+    """
+
+    def put(self, _request):
+        pass
+
+
+def build_message(data, attributes=None):
+    pubsub_message = types.PubsubMessage(data=data, attributes=attributes or {}, message_id=str(uuid.uuid4()))
+    return Message(getattr(pubsub_message, '_pb', pubsub_message), str(uuid.uuid4()), 0, _DiscardQueue())
+
+
+def eq_receipt(valid):
+    data = {'timeCreated': '2008-08-24T00:00:00Z',
+            'metadata': {'tx_id': str(uuid.uuid4()), 'questionnaire_id': '0120000000001000',
+                         'case_id': str(uuid.uuid4())}}
+    if not valid:
+        del data['metadata']['questionnaire_id']
+    return build_message(json.dumps(data).encode(), {'eventType': 'OBJECT_FINALIZE', 'bucketId': 'eq-bucket',
+                                                     'objectId': data['metadata']['tx_id']})
+
+
+def offline_receipt(valid):
+    data = {'dateTime': '2008-08-24T00:00:00', 'transactionId': str(uuid.uuid4()),
+            'questionnaireId': '0120000000001000', 'channel': 'PQRS'}
+    return build_message(json.dumps(data).encode() if valid else f'not json {uuid.uuid4()}'.encode())
+
+
+def ppo_undelivered(valid):
+    data = {'dateTime': '2008-08-24T00:00:00' if valid else 'garbage', 'transactionId': str(uuid.uuid4()),
+            'caseRef': 12345678, 'productCode': 'P_OR_H1', 'channel': 'PPO', 'type': 'UNDELIVERED_MAIL_REPORTED'}
+    return build_message(json.dumps(data).encode())
+
+
+def qm_undelivered(valid):
+    data = {'dateTime': '2008-08-24T00:00:00', 'transactionId': str(uuid.uuid4()),
+            'questionnaireId': '0120000000001000'}
+    if not valid:
+        del data['transactionId']
+    return build_message(json.dumps(data).encode())
+
+
+MESSAGE_FACTORIES = {
+    'eq_receipt': eq_receipt,
+    'offline_receipt': offline_receipt,
+    'ppo_undelivered': ppo_undelivered,
+    'qm_undelivered': qm_undelivered,
+}
+
+
+def fake_publish_message(message, _body, routing_key=None, subscription_name=None, timer=None):
+    message.ack()  # as if rabbitmq had confirmed the publish
+
+
+async def fake_async_publish(_body, _routing_key):
+    pass  # as if rabbitmq had confirmed the publish
+
+
+def build_messages(subscription, message_count, invalid_ratio):
+    invalid_every = int(1 / invalid_ratio) if invalid_ratio else 0
+    factory = MESSAGE_FACTORIES[subscription.key]
+    return [factory(valid=not (invalid_every and i % invalid_every == 0)) for i in range(message_count)]
+
+
+def summarise(latencies, elapsed):
+    latencies.sort()
+    return {
+        'messages': len(latencies),
+        'msgs_per_second': round(len(latencies) / elapsed, 1),
+        'p50_us': round(percentile(latencies, 0.5) * 1000000, 1),
+        'p99_us': round(percentile(latencies, 0.99) * 1000000, 1),
+    }
+
+
+def benchmark_subscription(subscription, message_count, invalid_ratio):
+    for message in build_messages(subscription, min(100, message_count), invalid_ratio):  # warm up caches
+        process_message(subscription, message)
+    messages = build_messages(subscription, message_count, invalid_ratio)
+
+    latencies = []
+    start = perf_counter()
+    for message in messages:
+        message_start = perf_counter()
+        process_message(subscription, message)
+        latencies.append(perf_counter() - message_start)
+    return summarise(latencies, perf_counter() - start)
+
+
+async def benchmark_async_subscription(engine, subscription, message_count, invalid_ratio, concurrency):
+    for message in build_messages(subscription, min(100, message_count), invalid_ratio):  # warm up caches
+        await engine.handle(subscription, message)
+    messages = build_messages(subscription, message_count, invalid_ratio)
+
+    latencies = []
+
+    async def handle(message):
+        message_start = perf_counter()
+        await engine.handle(subscription, message)
+        latencies.append(perf_counter() - message_start)
+
+    start = perf_counter()
+    for i in range(0, message_count, concurrency):
+        await asyncio.gather(*(handle(message) for message in messages[i:i + concurrency]))
+    return summarise(latencies, perf_counter() - start)
+
+
+def run_benchmarks(message_count, invalid_ratio, engine='threaded', concurrency=100):
+    logger_initial_config(service_name='census-rm-pubsub-benchmark', log_level=os.getenv('LOG_LEVEL', 'INFO'))
+    devnull = open(os.devnull, 'w')
+    for handler in logging.getLogger().handlers:
+        handler.stream = devnull  # keep the cost of rendering log lines, without the terminal
+
+    subscriptions = load_subscriptions(config_file=None, enabled=None)
+    if engine == 'asyncio':
+        async_engine = AsyncEngine(subscriptions.values(), fake_async_publish, client=None)
+        loop = asyncio.get_event_loop()
+        return {key: loop.run_until_complete(benchmark_async_subscription(async_engine, subscription, message_count,
+                                                                          invalid_ratio, concurrency))
+                for key, subscription in subscriptions.items()}
+    with patch('app.subscriber.publish_message', fake_publish_message):
+        return {key: benchmark_subscription(subscription, message_count, invalid_ratio)
+                for key, subscription in subscriptions.items()}
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+    :return: a list of regressions, where throughput dropped or p99 latency rose by more than the tolerance
+    """
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        if result['msgs_per_second'] < baseline[key]['msgs_per_second'] * (1 - tolerance):
+            regressions.append(f"{key}: {result['msgs_per_second']} msgs/s, baseline "
+                               f"{baseline[key]['msgs_per_second']} msgs/s")
+        if result['p99_us'] > baseline[key]['p99_us'] * (1 + tolerance):
+            regressions.append(f"{key}: p99 {result['p99_us']}us, baseline {baseline[key]['p99_us']}us")
+    return regressions
+
+
+def print_results(results, baseline=None):
+    print(f"{'subscription':<18}{'msgs/s':>12}{'p50 (us)':>12}{'p99 (us)':>12}{'baseline msgs/s':>18}")
+    for key, result in results.items():
+        baseline_throughput = baseline.get(key, {}).get('msgs_per_second', '-') if baseline else '-'
+        print(f"{key:<18}{result['msgs_per_second']:>12}{result['p50_us']:>12}{result['p99_us']:>12}"
+              f"{baseline_throughput:>18}")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark the subscriber callbacks')
+    parser.add_argument('--messages', type=int, default=20000, help='messages per subscription')
+    parser.add_argument('--invalid-ratio', type=float, default=0.05, help='share of invalid messages')
+    parser.add_argument('--engine', choices=['threaded', 'asyncio'], default='threaded')
+    parser.add_argument('--concurrency', type=int, default=100, help='messages handled at once by the asyncio engine')
+    parser.add_argument('--baseline-file', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--compare', action='store_true', help='exit non zero on regression against baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed regression, as a fraction')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    results = run_benchmarks(args.messages, args.invalid_ratio, args.engine, args.concurrency)
+
+    baseline = None
+    if os.path.exists(args.baseline_file):
+        with open(args.baseline_file) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.save_baseline:
+        with open(args.baseline_file, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+        print(f'Baseline saved to {args.baseline_file}')
+
+    if args.compare:
+        if baseline is None:
+            sys.exit(f'No baseline found at {args.baseline_file}')
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print('Performance regressions against baseline:', *regressions, sep='\n  ')
+            sys.exit(1)
+        print('No performance regressions against baseline')
+
+
+if __name__ == '__main__':
+    main()
@@ -52,7 +52,7 @@ class CensusRMPubSubComponentTest(TestCase):
         assert self.queue_declare_result.method.message_count == 1, "Expected 1 message to be on rabbitmq queue"
 
         case_msg = self.get_msg_body_from_rabbit(RABBIT_TEST_QUEUE)
-        assert expected_msg == case_msg, "RabbitMQ message text incorrect"
+        assert json.loads(expected_msg) == json.loads(case_msg), "RabbitMQ message text incorrect"
 
     def test_offline_e2e_with_successful_msg(self):
         self.purge_rabbit_queues()
@@ -80,7 +80,7 @@ class CensusRMPubSubComponentTest(TestCase):
         assert self.queue_declare_result.method.message_count == 1, "Expected 1 message to be on rabbitmq queue"
 
         case_msg = self.get_msg_body_from_rabbit(RABBIT_TEST_QUEUE)
-        assert expected_msg == case_msg, "RabbitMQ message text incorrect"
+        assert json.loads(expected_msg) == json.loads(case_msg), "RabbitMQ message text incorrect"
 
     def test_e2e_with_no_case_id(self):
         self.purge_rabbit_queues()
@@ -109,7 +109,7 @@ class CensusRMPubSubComponentTest(TestCase):
         assert self.queue_declare_result.method.message_count == 1, "Expected 1 message to be on rabbitmq queue"
 
         actual_msg_body_str = self.get_msg_body_from_rabbit(RABBIT_TEST_QUEUE)
-        assert expected_msg == actual_msg_body_str, "RabbitMQ message text incorrect"
+        assert json.loads(expected_msg) == json.loads(actual_msg_body_str), "RabbitMQ message text incorrect"
 
     def purge_rabbit_queues(self):
         self.init_rabbitmq()
@@ -0,0 +1,174 @@
+"""
+High rate load generator for the Pub/Sub emulator, publishing a configurable mix of the four message types the
+service subscribes to, with optional duplicate and malformed messages, from multiple worker processes.
+
+Usage:
+    python test/scripts/load_generator.py --rate 2000 --duration 60 --workers 4 \
+        --mix eq=0.7,offline=0.2,ppo=0.05,qm=0.05 --duplicate-ratio 0.01 --malformed-ratio 0.001
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from multiprocessing import Pool
+
+from google.cloud import pubsub_v1
+
+# (topic project, topic name) for each message type, as set up by test/component/setup_pubsub.sh
+TOPICS = {
+    'eq': ('project', 'eq-submission-topic'),
+    'offline': ('offline-project', 'offline-receipt-topic'),
+    'ppo': ('ppo-undelivered-project', 'ppo-undelivered-mail-topic'),
+    'qm': ('qm-undelivered-project', 'qm-undelivered-mail-topic'),
+}
+
+
+def eq_message(padding):
+    tx_id = str(uuid.uuid4())
+    data = {'timeCreated': '2008-08-24T00:00:00Z',
+            'metadata': {'tx_id': tx_id, 'questionnaire_id': str(random.randint(10 ** 15, 10 ** 16 - 1)),
+                         'case_id': str(uuid.uuid4())},
+            'padding': padding}
+    return json.dumps(data).encode(), {'eventType': 'OBJECT_FINALIZE', 'bucketId': 'eq-bucket', 'objectId': tx_id}
+
+
+def offline_message(padding):
+    data = {'dateTime': '2008-08-24T00:00:00', 'transactionId': str(uuid.uuid4()),
+            'questionnaireId': str(random.randint(10 ** 15, 10 ** 16 - 1)), 'channel': 'PQRS', 'padding': padding}
+    return json.dumps(data).encode(), {}
+
+
+def ppo_message(padding):
+    data = {'dateTime': '2008-08-24T00:00:00', 'transactionId': str(uuid.uuid4()),
+            'caseRef': random.randint(10 ** 7, 10 ** 8 - 1), 'productCode': 'P_OR_H1', 'channel': 'PPO',
+            'type': 'UNDELIVERED_MAIL_REPORTED', 'padding': padding}
+    return json.dumps(data).encode(), {}
+
+
+def qm_message(padding):
+    data = {'dateTime': '2008-08-24T00:00:00', 'transactionId': str(uuid.uuid4()),
+            'questionnaireId': str(random.randint(10 ** 15, 10 ** 16 - 1)), 'padding': padding}
+    return json.dumps(data).encode(), {}
+
+
+def malformed_message(message_type):
+    malformed = random.choice([b'not json', b'{}', json.dumps({'dateTime': 'garbage'}).encode()])
+    attributes = {'eventType': 'OBJECT_FINALIZE', 'bucketId': 'eq-bucket', 'objectId': 'malformed'}
+    return malformed, attributes if message_type == 'eq' else {}
+
+
+MESSAGE_FACTORIES = {'eq': eq_message, 'offline': offline_message, 'ppo': ppo_message, 'qm': qm_message}
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        message_type, weight = part.split('=')
+        if message_type not in TOPICS:
+            raise argparse.ArgumentTypeError(f'Unknown message type {message_type}, expected one of {list(TOPICS)}')
+        weights[message_type] = float(weight)
+    return weights
+
+
+def run_worker(worker_args):
+    """
+    Publish at this worker's share of the rate until the duration is up
+
+    :return: (published, failed, duplicates, malformed) counts
+    """
+    (emulator_host, rate, duration, mix, payload_size, duplicate_ratio, malformed_ratio, seed) = worker_args
+    os.environ['PUBSUB_EMULATOR_HOST'] = emulator_host
+    random.seed(seed)
+
+    batch_settings = pubsub_v1.types.BatchSettings(max_messages=500, max_latency=0.01)
+    publisher = pubsub_v1.PublisherClient(batch_settings=batch_settings)
+    topic_paths = {message_type: publisher.topic_path(*TOPICS[message_type]) for message_type in mix}
+    message_types, weights = list(mix), list(mix.values())
+    padding = 'x' * payload_size
+    recent = {message_type: deque(maxlen=1000) for message_type in mix}
+
+    counts = {'published': 0, 'failed': 0}
+    counts_lock = threading.Lock()
+
+    def on_published(future):
+        with counts_lock:
+            counts['failed' if future.exception() else 'published'] += 1
+
+    duplicates = malformed = sent = 0
+    futures = []
+    start = time.monotonic()
+    while True:
+        scheduled = start + sent / rate
+        now = time.monotonic()
+        if scheduled - start >= duration:
+            break
+        if scheduled > now:
+            time.sleep(scheduled - now)
+
+        message_type = random.choices(message_types, weights)[0]
+        roll = random.random()
+        if roll < malformed_ratio:
+            data, attributes = malformed_message(message_type)
+            malformed += 1
+        elif roll < malformed_ratio + duplicate_ratio and recent[message_type]:
+            data, attributes = random.choice(recent[message_type])
+            duplicates += 1
+        else:
+            data, attributes = MESSAGE_FACTORIES[message_type](padding)
+            recent[message_type].append((data, attributes))
+
+        future = publisher.publish(topic_paths[message_type], data=data, **attributes)
+        future.add_done_callback(on_published)
+        futures.append(future)
+        sent += 1
+
+    for future in futures:
+        try:
+            future.result(timeout=60)
+        except Exception:
+            pass  # already counted as failed by the done callback
+
+    return counts['published'], counts['failed'], duplicates, malformed
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Publish load to the Pub/Sub emulator')
+    parser.add_argument('--emulator-host', default=os.getenv('PUBSUB_EMULATOR_HOST', 'localhost:8539'))
+    parser.add_argument('--rate', type=float, default=1000, help='target messages per second, across all workers')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to publish for')
+    parser.add_argument('--workers', type=int, default=2, help='publishing processes')
+    parser.add_argument('--mix', type=parse_mix, default='eq=0.7,offline=0.2,ppo=0.05,qm=0.05',
+                        help='relative weights of each message type, e.g. eq=0.7,offline=0.2,ppo=0.05,qm=0.05')
+    parser.add_argument('--payload-size', type=int, default=0, help='bytes of padding to add to each payload')
+    parser.add_argument('--duplicate-ratio', type=float, default=0, help='share of messages which are resends')
+    parser.add_argument('--malformed-ratio', type=float, default=0, help='share of messages which are invalid')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    worker_rate = args.rate / args.workers
+    worker_args = [(args.emulator_host, worker_rate, args.duration, args.mix, args.payload_size,
+                    args.duplicate_ratio, args.malformed_ratio, seed) for seed in range(args.workers)]
+
+    print(f'Publishing {args.rate} msgs/s for {args.duration}s from {args.workers} workers to {args.emulator_host}')
+    start = time.monotonic()
+    with Pool(args.workers) as pool:
+        results = pool.map(run_worker, worker_args)
+    elapsed = time.monotonic() - start
+
+    published, failed, duplicates, malformed = (sum(counts) for counts in zip(*results))
+    print(f'Published {published} messages ({duplicates} duplicates, {malformed} malformed), {failed} failed')
+    print(f'Achieved publish rate: {published / elapsed:.1f} msgs/s over {elapsed:.1f}s '
+          f'(target {args.rate} msgs/s)')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
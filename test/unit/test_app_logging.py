@@ -0,0 +1,88 @@
+import io
+import json
+import logging
+import queue
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+
+from structlog.exceptions import DropEvent
+
+from app.app_logging import (LOG_LINES_DROPPED, DroppingQueueHandler, logger_initial_config, orjson_serializer,
+                             sample_success_lines, start_log_queue, stop_log_queue)
+from app.json_codec import orjson
+
+
+class AppLoggingTestCase(TestCase):
+
+    def test_success_lines_are_dropped_outside_the_sample(self):
+        sampler = sample_success_lines(0)
+
+        with self.assertRaises(DropEvent):
+            sampler(None, 'info', {'event': 'Message processing complete'})
+
+    def test_success_lines_are_kept_inside_the_sample(self):
+        sampler = sample_success_lines(1)
+        event_dict = {'event': 'Message processing complete'}
+
+        assert sampler(None, 'info', event_dict) is event_dict
+
+    def test_other_lines_are_always_kept(self):
+        sampler = sample_success_lines(0)
+        event_dict = {'event': 'Pub/Sub Message data not JSON'}
+
+        assert sampler(None, 'error', event_dict) is event_dict
+
+    @skipUnless(orjson, 'orjson is not installed')
+    def test_orjson_serializer_renders_json(self):
+        rendered = orjson_serializer({'event': 'test', 'caseRef': 2 ** 70, 'unserialisable': object})
+
+        assert json.loads(rendered)['caseRef'] == 2 ** 70
+        assert json.loads(rendered)['unserialisable'] == repr(object)
+
+    def test_high_throughput_profile_caches_loggers(self):
+        with patch('app.app_logging.configure') as mock_configure, patch('app.app_logging.logging'):
+            logger_initial_config(profile='high_throughput')
+
+        assert mock_configure.call_args[1]['cache_logger_on_first_use'] is True
+
+    def test_standard_profile_does_not_cache_loggers(self):
+        with patch('app.app_logging.configure') as mock_configure, patch('app.app_logging.logging'):
+            logger_initial_config(profile='standard')
+
+        assert 'cache_logger_on_first_use' not in mock_configure.call_args[1]
+
+
+class LogQueueTestCase(TestCase):
+
+    def setUp(self):
+        self.root_handlers = logging.getLogger().handlers
+
+    def tearDown(self):
+        stop_log_queue()
+        logging.getLogger().handlers = self.root_handlers
+
+    def test_records_are_dropped_and_counted_when_queue_is_full(self):
+        log_queue = queue.Queue(maxsize=1)
+        handler = DroppingQueueHandler(log_queue)
+        dropped_before = LOG_LINES_DROPPED.labels().get()
+
+        for i in range(3):
+            handler.handle(logging.makeLogRecord({'msg': f'line {i}'}))
+
+        assert log_queue.qsize() == 1
+        assert LOG_LINES_DROPPED.labels().get() == dropped_before + 2
+
+    def test_queued_records_are_written_on_stop(self):
+        stream = io.StringIO()
+        target = logging.StreamHandler(stream)
+        target.setFormatter(logging.Formatter('%(message)s'))
+        start_log_queue(target, queue_size=100)
+
+        test_logger = logging.getLogger('test.log_queue')
+        test_logger.propagate = True
+        for i in range(10):
+            test_logger.warning('line %d', i)
+        stop_log_queue()
+
+        assert stream.getvalue().splitlines()[:10] == [f'line {i}' for i in range(10)]
+        assert logging.getLogger().handlers == [target]
@@ -0,0 +1,178 @@
+import asyncio
+import json
+from time import monotonic
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from google.api_core.exceptions import ServiceUnavailable
+
+from app.async_engine import AckBatcher, AsyncEngine
+from app.pulled_message import PulledMessage
+from app.dedup import DedupCache
+from app.reject_cache import RejectCache
+from app.subscription_config import load_subscriptions
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def received_message(ack_id, data, attributes=None):
+    return SimpleNamespace(ack_id=ack_id, message=SimpleNamespace(message_id=f'message-{ack_id}', data=data,
+                                                                  attributes=attributes or {}))
+
+
+def offline_receipt(transaction_id='tx-1'):
+    return json.dumps({'transactionId': transaction_id, 'questionnaireId': '0120000000001000', 'channel': 'PQRS',
+                       'dateTime': '2008-08-24T00:00:00'}).encode()
+
+
+class AsyncEngineTestCase(TestCase):
+
+    def setUp(self):
+        self.subscription = load_subscriptions(config_file=None, enabled='offline_receipt')['offline_receipt']
+        self.published = []
+        self.client = MagicMock()
+        self.acks = MagicMock()
+
+        for name, cache in (('dedup_cache', DedupCache(max_size=10)), ('reject_cache', RejectCache(max_size=10))):
+            patcher = patch(f'app.async_engine.{name}', cache)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def publish(self, body, routing_key):
+        self.published.append((json.loads(body), routing_key))
+
+    async def fail_to_publish(self, body, routing_key):
+        raise ConnectionError('Channel closed')
+
+    def test_valid_message_is_acked_once_published(self):
+        engine = AsyncEngine([self.subscription], self.publish, self.client)
+
+        run(engine.handle(self.subscription, PulledMessage(received_message('1', offline_receipt()), self.acks)))
+
+        (event_message, routing_key), = self.published
+        assert event_message['event']['transactionId'] == 'tx-1'
+        assert routing_key == self.subscription.routing_key
+        self.acks.ack.assert_called_once_with('1')
+
+    def test_duplicate_message_is_acked_without_publishing(self):
+        engine = AsyncEngine([self.subscription], self.publish, self.client)
+
+        run(engine.handle(self.subscription, PulledMessage(received_message('1', offline_receipt()), self.acks)))
+        run(engine.handle(self.subscription, PulledMessage(received_message('2', offline_receipt()), self.acks)))
+
+        assert len(self.published) == 1
+        assert [ack_call[0][0] for ack_call in self.acks.ack.call_args_list] == ['1', '2']
+
+    def test_message_is_nacked_when_publish_fails(self):
+        engine = AsyncEngine([self.subscription], self.fail_to_publish, self.client)
+
+        run(engine.handle(self.subscription, PulledMessage(received_message('1', offline_receipt()), self.acks)))
+
+        self.acks.nack.assert_called_once_with('1')
+        self.acks.ack.assert_not_called()
+
+    def test_invalid_message_is_not_published_or_acked(self):
+        engine = AsyncEngine([self.subscription], self.publish, self.client)
+
+        with patch('app.quarantine.quarantine_store', None):
+            run(engine.handle(self.subscription, PulledMessage(received_message('1', b'not json'), self.acks)))
+
+        assert not self.published
+        self.acks.ack.assert_not_called()
+        self.acks.nack.assert_not_called()
+
+    def test_pulled_messages_are_handled_and_acked_in_one_request(self):
+        self.client.pull.return_value = SimpleNamespace(received_messages=[
+            received_message('1', offline_receipt('tx-1')), received_message('2', offline_receipt('tx-2'))])
+        engine = AsyncEngine([self.subscription], self.publish, self.client, max_messages=10)
+
+        async def pull_once():
+            acks = AckBatcher(self.client, 'subscription-path', engine._executor)
+            await engine.pull(self.subscription, 'subscription-path', acks, asyncio.Semaphore(10))
+            await asyncio.gather(*engine._tasks)
+            await acks.flush()
+
+        run(pull_once())
+
+        assert self.client.pull.call_args[1]['max_messages'] == 10
+        assert len(self.published) == 2
+        self.client.acknowledge.assert_called_once_with(subscription='subscription-path', ack_ids=['1', '2'])
+        self.client.modify_ack_deadline.assert_not_called()
+
+    def test_messages_waiting_for_capacity_are_leased_until_settled(self):
+        self.client.pull.return_value = SimpleNamespace(received_messages=[
+            received_message('1', offline_receipt('tx-1')), received_message('2', offline_receipt('tx-2'))])
+        engine = AsyncEngine([self.subscription], self.publish, self.client, max_messages=10)
+
+        async def pull_with_capacity_for_one():
+            acks = AckBatcher(self.client, 'subscription-path', engine._executor)
+            capacity = asyncio.Semaphore(1)
+            await capacity.acquire()
+            pull = asyncio.ensure_future(engine.pull(self.subscription, 'subscription-path', acks, capacity))
+            await asyncio.sleep(0.1)  # pulled, waiting for capacity
+            with patch('app.async_engine.monotonic', return_value=monotonic() + 10):
+                await acks.extend_leases()
+            capacity.release()
+            await pull
+            await asyncio.gather(*engine._tasks)
+            await acks.extend_leases()
+
+        run(pull_with_capacity_for_one())
+
+        self.client.modify_ack_deadline.assert_called_once_with(subscription='subscription-path',
+                                                                ack_ids=['1', '2'], ack_deadline_seconds=60)
+
+    def test_leases_are_not_extended_past_the_max_lease_duration(self):
+        acks = AckBatcher(self.client, 'subscription-path', None, max_lease_duration=30)
+        acks.lease(['1'], monotonic() - 30)
+
+        run(acks.extend_leases())
+
+        self.client.modify_ack_deadline.assert_not_called()
+
+    def test_failed_pulls_are_retried_with_backoff(self):
+        self.client.pull.side_effect = [ServiceUnavailable('Unavailable'), ServiceUnavailable('Unavailable'),
+                                        RuntimeError('Stopped')]
+        engine = AsyncEngine([self.subscription], self.publish, self.client)
+
+        with patch('app.async_engine.PULL_RETRY_DELAY', 0.01), patch('app.async_engine.logger') as mock_logger:
+            with self.assertRaises(RuntimeError):
+                run(engine._pull_loop(self.subscription))
+
+        assert [call[1]['retry_delay'] for call in mock_logger.error.call_args_list] == [0.01, 0.02]
+
+    def test_nacks_are_sent_for_immediate_redelivery(self):
+        acks = AckBatcher(self.client, 'subscription-path', None)
+        acks.nack('1')
+
+        run(acks.flush())
+
+        self.client.modify_ack_deadline.assert_called_once_with(subscription='subscription-path', ack_ids=['1'],
+                                                                ack_deadline_seconds=0)
+        self.client.acknowledge.assert_not_called()
+
+    def test_batcher_keeps_running_when_an_ack_request_fails(self):
+        self.client.acknowledge.side_effect = [ConnectionError('Unavailable'), None]
+        acks = AckBatcher(self.client, 'subscription-path', None, max_latency_ms=1)
+
+        async def ack_twice():
+            task = asyncio.ensure_future(acks.run())
+            acks.ack('1')
+            await asyncio.sleep(0.05)
+            acks.ack('2')
+            await asyncio.sleep(0.05)
+            assert not task.done(), 'Expected the ack task to survive a failed request'
+            task.cancel()
+
+        with patch('app.async_engine.logger') as mock_logger:
+            run(ack_twice())
+
+        assert [call[1]['ack_ids'] for call in self.client.acknowledge.call_args_list] == [['1'], ['2']]
+        mock_logger.error.assert_called_once()
@@ -0,0 +1,91 @@
+import threading
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from pika.spec import Basic
+
+from app.backpressure import CONNECTION_BLOCKED, PUBLISH_LATENCY, Backpressure
+
+
+class BackpressureTestCase(TestCase):
+
+    def setUp(self):
+        self.backpressure = Backpressure(latency_threshold_ms=100, smoothing=0.5)
+
+    def test_paused_while_connection_is_blocked(self):
+        self.backpressure.on_connection_blocked(MagicMock(), MagicMock())
+
+        assert self.backpressure.paused
+        assert not self.backpressure.wait_until_clear(timeout=0)
+
+        self.backpressure.on_connection_unblocked(MagicMock(), MagicMock())
+
+        assert not self.backpressure.paused
+
+    def test_paused_while_disconnected(self):
+        self.backpressure.on_disconnected()
+
+        assert self.backpressure.paused
+
+        self.backpressure.on_connected()
+
+        assert not self.backpressure.paused
+
+    def test_paused_while_smoothed_publish_latency_is_over_threshold(self):
+        self.backpressure.observe_publish_latency(0.05)
+        assert not self.backpressure.paused
+
+        self.backpressure.observe_publish_latency(0.2)
+        assert self.backpressure.paused
+
+        self.backpressure.observe_publish_latency(0.01)
+        assert not self.backpressure.paused
+
+    def test_resumes_once_all_publishes_are_confirmed(self):
+        self.backpressure.observe_publish_latency(1)
+
+        self.backpressure.on_publishes_confirmed()
+
+        assert not self.backpressure.paused
+        self.backpressure.observe_publish_latency(0.01)
+        assert not self.backpressure.paused
+
+    def test_paused_until_every_cause_clears(self):
+        self.backpressure.set_cause(CONNECTION_BLOCKED, True)
+        self.backpressure.set_cause(PUBLISH_LATENCY, True)
+
+        self.backpressure.set_cause(CONNECTION_BLOCKED, False)
+        assert self.backpressure.paused
+
+        self.backpressure.set_cause(PUBLISH_LATENCY, False)
+        assert not self.backpressure.paused
+
+    def test_waiting_callbacks_are_released_when_cleared(self):
+        self.backpressure.on_connection_blocked()
+        released = threading.Event()
+        waiter = threading.Thread(target=lambda: self.backpressure.wait_until_clear() and released.set())
+        waiter.start()
+
+        assert not released.wait(0.05)
+        self.backpressure.on_connection_unblocked()
+
+        assert released.wait(5)
+        waiter.join()
+
+    def test_publisher_reports_slow_confirms(self):
+        from app.publisher import ConfirmPublisher
+
+        publisher = ConfirmPublisher(exchange_name='test-exchange', max_in_flight=10)
+        publisher._on_confirm_select_ok(MagicMock(), None)
+        frame = MagicMock()
+        frame.method = Basic.Ack(delivery_tag=1)
+
+        with patch('app.publisher.backpressure', self.backpressure), \
+                patch('app.publisher.monotonic', side_effect=[0, 0, 0.5]):
+            publisher._capacity.acquire()
+            publisher._publish(MagicMock(), 'body', 'test.route', 'test-subscription')
+            publisher._capacity.acquire()
+            publisher._publish(MagicMock(), 'body', 'test.route', 'test-subscription')
+            publisher._on_delivery_confirmation(frame)
+
+            assert self.backpressure.paused
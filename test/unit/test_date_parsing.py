@@ -0,0 +1,61 @@
+from datetime import datetime, timezone
+from unittest import TestCase
+
+from pytest import raises
+from rfc3339 import parse_datetime
+
+from app.date_parsing import normalise_offline_datetime, normalise_rfc3339_datetime
+
+
+class DateParsingTestCase(TestCase):
+
+    def test_offline_datetime_matches_strptime(self):
+        for date_time in ['2008-08-24T00:00:00', '2019-12-31T23:59:59', '2020-02-29T12:30:45', '2008-8-24T0:0:0']:
+            expected = datetime.strptime(date_time, '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc).isoformat()
+            assert normalise_offline_datetime(date_time) == expected
+
+    def test_invalid_offline_datetime(self):
+        for date_time in ['I am a garbage dateTime', '2019-02-29T00:00:00', '2008-08-24T24:00:00',
+                          '2008-08-24T00:00:00Z', '2008-08-24 00:00:00', '']:
+            with raises(ValueError):
+                normalise_offline_datetime(date_time)
+
+    def test_malformed_fields_are_not_sliced(self):
+        for date_time in ['+008-08-24T00:00:00', '2008-08-24T 0:00:00', '20_8-08-24T00:00:00', '2008-+8-24T00:00:00']:
+            with raises(ValueError):
+                normalise_offline_datetime(date_time)
+            for suffix in ('Z', '.1Z', '.+1Z', '. 1Z'):
+                with raises(ValueError):
+                    normalise_rfc3339_datetime(date_time + suffix)
+
+    def test_non_ascii_digits_are_left_to_the_full_parsers(self):
+        date_time = '\uff12\uff10\uff10\uff18-08-24T00:00:00'  # full width digits
+
+        assert normalise_offline_datetime(date_time) == datetime.strptime(
+            date_time, '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc).isoformat()
+        assert normalise_rfc3339_datetime(date_time + 'Z') == parse_datetime(date_time + 'Z').isoformat()
+
+    def test_rfc3339_datetime_matches_rfc3339_parser(self):
+        for date_time in ['2008-08-24T00:00:00Z', '2008-08-24T00:00:00.123Z', '2008-08-24T00:00:00.123456789Z',
+                          '2008-08-24T01:00:00+01:00', '2008-08-24t00:00:00z', '2008-08-24T00:00:11.25-0123']:
+            assert normalise_rfc3339_datetime(date_time) == parse_datetime(date_time).isoformat()
+
+    def test_invalid_rfc3339_datetime(self):
+        for date_time in ['123', '2008-08-24T00:00:00', '2008-08-24T24:00:00Z', '2008-08-24T00:00:00.Z', '']:
+            with raises(ValueError):
+                normalise_rfc3339_datetime(date_time)
+
+    def test_non_string_datetime_raises_type_error(self):
+        for normalise in (normalise_offline_datetime, normalise_rfc3339_datetime):
+            with raises(TypeError):
+                normalise(None)
+            with raises(TypeError):
+                normalise(['2008-08-24T00:00:00Z'])
+
+    def test_repeated_datetimes_are_cached(self):
+        normalise_offline_datetime.cache_clear()
+
+        normalise_offline_datetime('2008-08-24T00:00:00')
+        normalise_offline_datetime('2008-08-24T00:00:00')
+
+        assert normalise_offline_datetime.cache_info().hits == 1
@@ -0,0 +1,72 @@
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from app.dedup import DEDUP_EVICTIONS, DedupCache, dedup_key
+
+
+class DedupCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.cache = DedupCache(max_size=2, ttl=60)
+
+    def test_key_is_event_type_and_transaction_id(self):
+        event_message = {'event': {'type': 'RESPONSE_RECEIVED', 'transactionId': 'tx-1'}, 'payload': {}}
+
+        assert dedup_key(event_message) == ('RESPONSE_RECEIVED', 'tx-1')
+
+    def test_added_key_is_a_duplicate(self):
+        assert not self.cache.is_duplicate('a')
+
+        self.cache.add('a')
+
+        assert self.cache.is_duplicate('a')
+
+    def test_least_recently_seen_key_is_evicted(self):
+        evictions_before = DEDUP_EVICTIONS.labels('size').get()
+        self.cache.add('a')
+        self.cache.add('b')
+        self.cache.is_duplicate('a')
+
+        self.cache.add('c')
+
+        assert self.cache.is_duplicate('a')
+        assert not self.cache.is_duplicate('b')
+        assert len(self.cache) == 2
+        assert DEDUP_EVICTIONS.labels('size').get() == evictions_before + 1
+
+    def test_key_expires_after_ttl(self):
+        with patch('app.dedup.monotonic', return_value=100):
+            self.cache.add('a')
+        with patch('app.dedup.monotonic', return_value=161):
+            assert not self.cache.is_duplicate('a')
+        assert len(self.cache) == 0
+
+    def test_tracked_key_is_only_added_when_publish_is_confirmed(self):
+        acked_message, nacked_message = MagicMock(), MagicMock()
+        self.cache.track(acked_message, 'acked')
+        self.cache.track(nacked_message, 'nacked')
+
+        assert not self.cache.is_duplicate('acked')
+        self.cache.on_settled(acked_message, acked=True)
+        self.cache.on_settled(nacked_message, acked=False)
+
+        assert self.cache.is_duplicate('acked')
+        assert not self.cache.is_duplicate('nacked')
+        assert not self.cache._pending
+
+    def test_tracked_messages_are_bounded(self):
+        messages = [MagicMock(message_id=str(i)) for i in range(3)]
+        for i, message in enumerate(messages):
+            self.cache.track(message, i)
+
+        self.cache.on_settled(messages[0], acked=True)  # forgotten when the third was tracked
+
+        assert list(self.cache._pending) == ['1', '2']
+        assert not self.cache.is_duplicate(0)
+
+    def test_disabled_cache_never_finds_duplicates(self):
+        cache = DedupCache(max_size=0)
+
+        cache.add('a')
+
+        assert not cache.is_duplicate('a')
@@ -0,0 +1,63 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from app.dedup import DedupCache
+from app.dedup_index import DedupIndex
+
+
+class DedupIndexTestCase(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'dedup.db')
+        self.index = DedupIndex(self.path, ttl=60, compact_interval=60)
+        self.index.start()
+
+    def tearDown(self):
+        self.index.stop(timeout=5)
+        shutil.rmtree(self.directory)
+
+    def restart(self, **kwargs):
+        self.index.stop(timeout=5)
+        self.index = DedupIndex(self.path, **kwargs)
+        self.index.start()
+
+    def test_keys_survive_a_restart(self):
+        self.index.add(('RESPONSE_RECEIVED', 'tx-1'))
+
+        self.restart(ttl=60)
+
+        assert self.index.contains(('RESPONSE_RECEIVED', 'tx-1'))
+        assert not self.index.contains(('UNDELIVERED_MAIL_REPORTED', 'tx-1'))
+
+    def test_expired_keys_are_not_found_and_are_compacted(self):
+        with patch('app.dedup_index.time', return_value=1000):
+            self.index.add(('RESPONSE_RECEIVED', 'tx-1'))
+        self.restart(ttl=60)
+
+        assert not self.index.contains(('RESPONSE_RECEIVED', 'tx-1'))
+        with sqlite3.connect(self.path) as connection:
+            assert connection.execute('SELECT COUNT(*) FROM published').fetchone()[0] == 0
+
+    def test_oldest_keys_are_deleted_to_fit_disk_budget(self):
+        for i in range(5000):
+            with patch('app.dedup_index.time', return_value=10 ** 10 + i):
+                self.index.add(('RESPONSE_RECEIVED', f'transaction-{i:08}'))
+
+        self.restart(ttl=10 ** 10, max_bytes=64 * 1024)
+
+        assert DedupIndex.size_bytes(self.index._read_connection) <= 64 * 1024
+        with patch('app.dedup_index.time', return_value=10 ** 10 + 5000):
+            assert self.index.contains(('RESPONSE_RECEIVED', 'transaction-00004999'))
+            assert not self.index.contains(('RESPONSE_RECEIVED', 'transaction-00000000'))
+
+    def test_cache_finds_duplicates_in_index_after_restart(self):
+        DedupCache(max_size=10, index=self.index).add(('RESPONSE_RECEIVED', 'tx-1'))
+
+        self.restart(ttl=60)
+
+        assert DedupCache(max_size=10, index=self.index).is_duplicate(('RESPONSE_RECEIVED', 'tx-1'))
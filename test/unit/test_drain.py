@@ -0,0 +1,134 @@
+from collections import Counter
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import patch
+
+from app.subscriber import DUPLICATE, PUBLISHED, PullBatch
+from app.subscription_config import load_subscriptions
+from drain import (EXIT_DEADLINE, EXIT_DRAINED, EXIT_FAILURES, MAX_CONSECUTIVE_ERRORS, DrainReport, drain,
+                   exit_status, select_subscriptions)
+
+
+def pulled_batch(published=0, duplicates=0, nacked=0, invalid=0, message_id_prefix=''):
+    batch = PullBatch()
+    batch.size = published + duplicates + invalid
+    batch.pulled_at = 100.0
+    batch.outcomes = Counter({PUBLISHED: published, DUPLICATE: duplicates})
+    for i in range(published):
+        batch.published.append(f'published-{i}')
+        if i < published - nacked:
+            batch.ack(f'published-{i}')
+        else:
+            batch.nack(f'published-{i}')
+    for i in range(duplicates):
+        batch.duplicates.append(f'duplicate-{i}')
+        batch.ack(f'duplicate-{i}')
+    for ack_id in batch.published + batch.duplicates + [f'invalid-{i}' for i in range(invalid)]:
+        batch.message_ids[ack_id] = message_id_prefix + ack_id
+    return batch
+
+
+class DrainTestCase(TestCase):
+
+    def setUp(self):
+        self.subscriptions = load_subscriptions(config_file=None, enabled=None)
+
+    def test_subscriptions_are_selected_by_key_or_name(self):
+        selected = select_subscriptions(self.subscriptions,
+                                        ['eq_receipt', self.subscriptions['qm_undelivered'].subscription_name])
+
+        assert [subscription.key for subscription in selected] == ['eq_receipt', 'qm_undelivered']
+        with self.assertRaises(KeyError):
+            select_subscriptions(self.subscriptions, ['unknown'])
+
+    def test_report_counts_outcomes_and_latencies(self):
+        report = DrainReport(['eq_receipt'])
+
+        with patch('app.subscriber.monotonic', return_value=100.5):
+            batch = pulled_batch(published=3, duplicates=2, nacked=1, invalid=1)
+        report.add_batch('eq_receipt', batch)
+
+        assert report.counts['eq_receipt'] == Counter(pulled=6, processed=2, duplicates=2, failed=2, redelivered=0)
+        assert report.latencies == [0.5, 0.5]
+
+    def test_drain_pulls_until_subscriptions_are_empty(self):
+        batches = {'eq_receipt': [pulled_batch(published=2), pulled_batch(), pulled_batch()],
+                   'offline_receipt': [pulled_batch(duplicates=1), pulled_batch(), pulled_batch()]}
+        subscriptions = [self.subscriptions['eq_receipt'], self.subscriptions['offline_receipt']]
+
+        def pull(subscription, _subscription_path, _batch_size, timeout=None):
+            return batches[subscription.key].pop(0)
+
+        with patch('drain.pull_batch', side_effect=pull), patch('drain.client'):
+            report, drained = drain(subscriptions, deadline_seconds=60, concurrency=1, empty_pulls=2)
+
+        assert drained
+        assert report.total('processed') == 2
+        assert report.total('duplicates') == 1
+        assert exit_status(report, drained) == EXIT_DRAINED
+
+    def test_drain_stops_at_the_deadline(self):
+        with patch('drain.pull_batch', return_value=pulled_batch(published=1)) as mock_pull_batch, \
+                patch('drain.client'):
+            report, drained = drain([self.subscriptions['eq_receipt']], deadline_seconds=0, concurrency=1)
+
+        mock_pull_batch.assert_not_called()
+        assert not drained
+        assert exit_status(report, drained) == EXIT_DEADLINE
+
+    def test_failures_take_precedence_in_exit_status(self):
+        report = DrainReport(['eq_receipt'])
+        report.add_batch('eq_receipt', pulled_batch(published=1, nacked=1))
+
+        assert exit_status(report, drained=False) == EXIT_FAILURES
+        assert exit_status(SimpleNamespace(total=lambda _name: 0), drained=True) == EXIT_DRAINED
+
+    def test_redelivered_failures_are_counted_once_and_do_not_keep_the_drain_going(self):
+        batches = [pulled_batch(published=1, invalid=1), pulled_batch(invalid=1), pulled_batch(invalid=1)]
+
+        with patch('drain.pull_batch', side_effect=lambda *_args, **_kwargs: batches.pop(0)), patch('drain.client'):
+            report, drained = drain([self.subscriptions['eq_receipt']], deadline_seconds=60, concurrency=1,
+                                    empty_pulls=2)
+
+        assert drained
+        assert not batches
+        assert report.counts['eq_receipt'] == Counter(pulled=4, processed=1, failed=1, redelivered=2)
+        assert exit_status(report, drained) == EXIT_FAILURES
+
+    def test_nacked_message_is_no_longer_failed_once_processed(self):
+        report = DrainReport(['eq_receipt'])
+
+        report.add_batch('eq_receipt', pulled_batch(published=1, nacked=1))
+        report.add_batch('eq_receipt', pulled_batch(published=1))
+
+        assert report.total('failed') == 0
+        assert report.total('redelivered') == 0
+
+    def test_failed_requests_are_counted_and_retried(self):
+        from google.api_core.exceptions import ServiceUnavailable
+
+        results = [ServiceUnavailable('Try again'), pulled_batch(published=1), pulled_batch(), pulled_batch()]
+
+        def pull(*_args, **_kwargs):
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        with patch('drain.pull_batch', side_effect=pull), patch('drain.client'), patch('drain.sleep') as mock_sleep:
+            report, drained = drain([self.subscriptions['eq_receipt']], deadline_seconds=60, concurrency=1)
+
+        assert drained
+        mock_sleep.assert_called_once()
+        assert report.total('errors') == 1
+        assert report.total('processed') == 1
+        assert exit_status(report, drained) == EXIT_FAILURES
+
+    def test_draining_thread_gives_up_after_repeated_errors(self):
+        with patch('drain.pull_batch', side_effect=RuntimeError('Broken')), patch('drain.client'), \
+                patch('drain.sleep'):
+            report, drained = drain([self.subscriptions['eq_receipt']], deadline_seconds=60, concurrency=2)
+
+        assert not drained
+        assert report.total('errors') == 2 * MAX_CONSECUTIVE_ERRORS
+        assert exit_status(report, drained) == EXIT_FAILURES
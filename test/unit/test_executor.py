@@ -0,0 +1,83 @@
+import threading
+from unittest import TestCase
+
+from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
+
+from app.executor import SubscriptionExecutor, create_scheduler, executor_stats
+from app.metrics import render_metrics
+
+
+class SubscriptionExecutorTestCase(TestCase):
+
+    def setUp(self):
+        self.executor = SubscriptionExecutor('test-subscription', max_workers=2)
+        self.release = threading.Event()
+        self.started = threading.Semaphore(0)
+
+    def tearDown(self):
+        self.release.set()
+        self.executor.shutdown(wait=True)
+
+    def block(self, _message):
+        self.started.release()
+        self.release.wait(5)
+
+    def test_stats_report_utilisation_and_queue_depth(self):
+        for message in range(5):
+            self.executor.submit(self.block, message)
+        for _ in range(2):
+            assert self.started.acquire(timeout=5)
+
+        stats = self.executor.stats()
+
+        assert stats == {'max_workers': 2, 'active_workers': 2, 'utilisation': 1.0, 'queue_depth': 3}
+
+    def test_idle_executor_stats(self):
+        self.executor.submit(lambda message: message, 'message').result(timeout=5)
+
+        assert self.executor.stats() == {'max_workers': 2, 'active_workers': 0, 'utilisation': 0.0,
+                                         'queue_depth': 0}
+
+    def test_queued_work_keeps_message_as_first_arg(self):
+        self.executor.submit(self.block, 'first')
+        self.executor.submit(self.block, 'second')
+        for _ in range(2):
+            assert self.started.acquire(timeout=5)
+        self.executor.submit(self.block, 'queued message')
+
+        work_item = self.executor._work_queue.get_nowait()
+
+        assert work_item.args[0] == 'queued message'
+
+
+class CreateSchedulerTestCase(TestCase):
+
+    def test_create_scheduler_registers_sized_executor(self):
+        scheduler = create_scheduler('test-scheduler-subscription', max_workers=3)
+
+        assert isinstance(scheduler, ThreadScheduler)
+        assert executor_stats()['test-scheduler-subscription']['max_workers'] == 3
+        scheduler.shutdown()
+
+    def test_executor_stats_are_exported_as_gauges(self):
+        scheduler = create_scheduler('test-gauge-subscription', max_workers=2)
+        release, started = threading.Event(), threading.Semaphore(0)
+
+        def block(_message):
+            started.release()
+            release.wait(5)
+
+        try:
+            for message in range(3):
+                scheduler.schedule(block, message)
+            for _ in range(2):
+                assert started.acquire(timeout=5)
+
+            lines = render_metrics().splitlines()
+        finally:
+            release.set()
+            scheduler.shutdown()
+
+        assert 'pubsub_executor_threads{subscription="test-gauge-subscription"} 2.0' in lines
+        assert 'pubsub_executor_active_threads{subscription="test-gauge-subscription"} 2.0' in lines
+        assert 'pubsub_executor_queue_depth{subscription="test-gauge-subscription"} 1.0' in lines
@@ -0,0 +1,36 @@
+import json
+from unittest import TestCase
+
+from pytest import raises
+
+from app import json_codec
+
+
+class JsonCodecTestCase(TestCase):
+    codecs = [(json_codec._json_loads, json_codec._json_dumps)]
+    if json_codec.orjson:
+        codecs.append((json_codec._orjson_loads, json_codec._orjson_dumps))
+
+    def test_round_trip_to_bytes(self):
+        document = {'event': {'type': 'RESPONSE_RECEIVED', 'caseRef': 12345, 'unreceipt': False, 'caseId': None},
+                    'name': 'café'}
+        for loads, dumps in self.codecs:
+            body = dumps(document)
+            assert isinstance(body, bytes)
+            assert json.loads(body) == document
+            assert loads(body) == document
+            assert loads(body.decode('utf-8')) == document
+
+    def test_invalid_json_raises_decode_error(self):
+        for loads, _ in self.codecs:
+            with raises(json_codec.JSONDecodeError):
+                loads(b'{"not": json')
+
+    def test_non_bytes_data_is_rejected(self):
+        for loads, _ in self.codecs:
+            with raises((TypeError, json_codec.JSONDecodeError)):
+                loads(None)
+
+    def test_integers_beyond_64_bits_are_encoded(self):
+        for _, dumps in self.codecs:
+            assert json.loads(dumps({'caseRef': 2 ** 70})) == {'caseRef': 2 ** 70}
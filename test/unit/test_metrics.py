@@ -0,0 +1,114 @@
+from unittest import TestCase
+from urllib.request import urlopen
+
+from app.metrics import (Counter, Gauge, Histogram, combine_metrics, drop_gauges, registry, render_metrics,
+                         start_metrics_server)
+
+
+class MetricsTestCase(TestCase):
+
+    def tearDown(self):
+        for metric in list(registry):
+            if metric.name.startswith('test_'):
+                registry.remove(metric)
+
+    def test_counter_renders_per_label_values(self):
+        counter = Counter('test_counter_total', 'A test counter', ['subscription', 'reason'])
+
+        counter.labels('sub-a', 'not_json').inc()
+        counter.labels('sub-a', 'not_json').inc()
+        counter.labels('sub-b', 'missing_data').inc(3)
+
+        lines = counter.render()
+        assert lines[:2] == ['# HELP test_counter_total A test counter', '# TYPE test_counter_total counter']
+        assert 'test_counter_total{subscription="sub-a",reason="not_json"} 2.0' in lines
+        assert 'test_counter_total{subscription="sub-b",reason="missing_data"} 3.0' in lines
+
+    def test_gauge_goes_up_and_down(self):
+        gauge = Gauge('test_gauge', 'A test gauge', ['subscription'])
+
+        gauge.labels('sub-a').inc()
+        gauge.labels('sub-a').inc()
+        gauge.labels('sub-a').dec()
+
+        assert 'test_gauge{subscription="sub-a"} 1.0' in gauge.render()
+
+    def test_gauge_reads_its_function_when_rendered(self):
+        gauge = Gauge('test_function_gauge', 'A test gauge', ['subscription'])
+        queued = []
+        gauge.labels('sub-a').set_function(lambda: len(queued))
+
+        queued.extend(['message-1', 'message-2'])
+
+        assert 'test_function_gauge{subscription="sub-a"} 2.0' in gauge.render()
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram('test_seconds', 'A test histogram', ['subscription'], buckets=(0.1, 1))
+
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.labels('sub-a').observe(value)
+
+        lines = histogram.render()
+        assert 'test_seconds_bucket{subscription="sub-a",le="0.1"} 2' in lines
+        assert 'test_seconds_bucket{subscription="sub-a",le="1"} 3' in lines
+        assert 'test_seconds_bucket{subscription="sub-a",le="+Inf"} 4' in lines
+        assert 'test_seconds_count{subscription="sub-a"} 4' in lines
+        assert 'test_seconds_sum{subscription="sub-a"} 2.65' in lines
+
+    def test_label_values_are_escaped(self):
+        counter = Counter('test_escaped_total', 'A test counter', ['subscription'])
+
+        counter.labels('a "quoted" name').inc()
+
+        assert 'test_escaped_total{subscription="a \\"quoted\\" name"} 1.0' in counter.render()
+
+    def test_metrics_are_served_over_http(self):
+        Counter('test_served_total', 'A test counter').labels().inc()
+
+        server = start_metrics_server(port=0, address='127.0.0.1')
+        try:
+            with urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics') as response:
+                body = response.read().decode('utf-8')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        assert 'test_served_total 1.0' in body
+        assert body == render_metrics()
+
+    def test_metrics_of_processes_are_summed(self):
+        counter = Counter('test_combined_total', 'A test counter', ['subscription'])
+        histogram = Histogram('test_combined_seconds', 'A test histogram', buckets=(1,))
+        counter.labels('sub-a').inc()
+        histogram.labels().observe(0.5)
+        first_process = '\n'.join(counter.render() + histogram.render())
+        counter.labels('sub-a').inc()
+        counter.labels('sub-b').inc()
+        histogram.labels().observe(2)
+        second_process = '\n'.join(counter.render() + histogram.render())
+
+        lines = combine_metrics([first_process, second_process]).splitlines()
+
+        assert lines == [
+            '# HELP test_combined_total A test counter',
+            '# TYPE test_combined_total counter',
+            'test_combined_total{subscription="sub-a"} 3.0',
+            'test_combined_total{subscription="sub-b"} 1.0',
+            '# HELP test_combined_seconds A test histogram',
+            '# TYPE test_combined_seconds histogram',
+            'test_combined_seconds_bucket{le="1"} 2.0',
+            'test_combined_seconds_bucket{le="+Inf"} 3.0',
+            'test_combined_seconds_count 3.0',
+            'test_combined_seconds_sum 3.0',
+        ]
+
+    def test_gauges_are_dropped(self):
+        counter = Counter('test_dropped_total', 'A test counter')
+        gauge = Gauge('test_dropped_in_flight', 'A test gauge')
+        counter.labels().inc()
+        gauge.labels().inc()
+
+        lines = drop_gauges('\n'.join(gauge.render() + counter.render())).splitlines()
+
+        assert lines == ['# HELP test_dropped_total A test counter', '# TYPE test_dropped_total counter',
+                         'test_dropped_total 1.0']
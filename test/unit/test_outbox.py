@@ -0,0 +1,201 @@
+import os
+import queue
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from pika.spec import Basic
+
+from app.outbox import OutboxDrainer, OutboxJournal, list_segments, segment_path
+
+
+class FakeConfirmPublisher:
+    max_in_flight = 1000
+
+    def __init__(self, acked=True):
+        self.acked = acked
+        self.published = []
+
+    def publish_batch(self, batch, journal=True):
+        for message, body, routing_key, subscription_name, _timer in batch:
+            self.published.append((body, routing_key, subscription_name))
+            message.ack() if self.acked else message.nack()
+
+    def wait_until_ready(self, _timeout=None):
+        return True
+
+
+class ConfirmingIOLoop:
+    """
+    Runs a confirm publisher's callbacks on its own thread, with the broker confirming every publish straight away
+    """
+
+    def __init__(self, confirm_publisher):
+        self._confirm_publisher = confirm_publisher
+        self._callbacks = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add_callback_threadsafe(self, callback):
+        self._callbacks.put(callback)
+
+    def stop(self):
+        self._callbacks.put(None)
+        self._thread.join(5)
+
+    def _run(self):
+        for callback in iter(self._callbacks.get, None):
+            callback()
+            frame = MagicMock()
+            frame.method = Basic.Ack(delivery_tag=self._confirm_publisher._delivery_tag, multiple=True)
+            self._confirm_publisher._on_delivery_confirmation(frame)
+
+
+class OutboxTestCase(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal = OutboxJournal(self.directory, segment_bytes=1024, max_messages=10, max_latency_ms=1)
+        self.journal.start()
+
+    def tearDown(self):
+        self.journal.stop(timeout=5)
+        shutil.rmtree(self.directory)
+
+    def journal_messages(self, count):
+        callbacks = [MagicMock() for _ in range(count)]
+        for i, callback in enumerate(callbacks):
+            self.journal.append(f'{{"message": {i}}}'.encode(), 'test.route', 'test-subscription', callback)
+        self.journal.stop(timeout=5)
+        return callbacks
+
+    def test_messages_are_acked_once_journalled(self):
+        callbacks = self.journal_messages(3)
+
+        for callback in callbacks:
+            callback.assert_called_once_with(True)
+        with open(segment_path(self.directory, 0), 'rb') as f:
+            assert f.read().splitlines() == [f'test.route\ttest-subscription\t{{"message": {i}}}'.encode()
+                                             for i in range(3)]
+
+    def test_journal_rolls_over_to_new_segments(self):
+        for _ in range(5):
+            self.journal_messages(20)
+            self.journal.start()
+
+        assert len(list_segments(self.directory)) > 1
+
+    def test_drainer_publishes_journal_and_deletes_drained_segments(self):
+        self.journal_messages(100)
+        self.journal.start()  # journal now appends to a new segment
+        publisher = FakeConfirmPublisher()
+        drainer = OutboxDrainer(self.journal, publisher, batch_size=10)
+
+        assert drainer.drain()
+
+        assert [body for body, _, _ in publisher.published] == [f'{{"message": {i}}}'.encode() for i in range(100)]
+        assert publisher.published[0][1:] == ('test.route', 'test-subscription')
+        assert list_segments(self.directory) == [self.journal.active_segment]
+        assert drainer.read_checkpoint() == (self.journal.active_segment, 0)
+
+    def test_drainer_resumes_from_checkpoint(self):
+        self.journal_messages(5)
+        self.journal.start()
+        drainer = OutboxDrainer(self.journal, FakeConfirmPublisher())
+        with open(segment_path(self.directory, 0), 'rb') as f:
+            drainer.write_checkpoint(0, len(f.readline()) * 3)
+        publisher = FakeConfirmPublisher()
+
+        OutboxDrainer(self.journal, publisher).drain()
+
+        assert [body for body, _, _ in publisher.published] == [b'{"message": 3}', b'{"message": 4}']
+
+    def test_checkpoint_does_not_move_when_rabbitmq_nacks(self):
+        self.journal_messages(5)
+        self.journal.start()
+        drainer = OutboxDrainer(self.journal, FakeConfirmPublisher(acked=False))
+
+        assert not drainer.drain()
+
+        assert drainer.read_checkpoint() == (0, 0)
+        assert os.path.exists(segment_path(self.directory, 0))
+
+    def test_publisher_journals_messages_while_disconnected(self):
+        from app.publisher import ConfirmPublisher
+
+        confirm_publisher = ConfirmPublisher(exchange_name='test-exchange', max_in_flight=10)
+        confirm_publisher.outbox = self.journal
+        message = MagicMock()
+
+        confirm_publisher._capacity.acquire()
+        confirm_publisher._publish(message, b'{"message": 0}', 'test.route', 'test-subscription')
+        self.journal.stop(timeout=5)
+
+        message.ack.assert_called_once()
+        message.nack.assert_not_called()
+        assert confirm_publisher._capacity.acquire(blocking=False), 'Expected in flight capacity to be released'
+
+    def test_drained_records_are_not_journalled_again_when_the_channel_drops(self):
+        from app.publisher import ConfirmPublisher
+
+        self.journal_messages(5)
+        self.journal.start()
+        journal_size = os.path.getsize(segment_path(self.directory, 0))
+        confirm_publisher = ConfirmPublisher(exchange_name='test-exchange', max_in_flight=10)
+        confirm_publisher.outbox = self.journal
+        confirm_publisher._on_confirm_select_ok(MagicMock(), None)
+
+        def drop_channel_then_run(callback):
+            confirm_publisher._on_disconnect()
+            callback()
+
+        confirm_publisher._ioloop = MagicMock(add_callback_threadsafe=drop_channel_then_run)
+        drainer = OutboxDrainer(self.journal, confirm_publisher, batch_size=2)
+
+        assert not drainer.drain()
+        self.journal.stop(timeout=5)
+
+        assert drainer.read_checkpoint() == (0, 0)
+        assert os.path.getsize(segment_path(self.directory, 0)) == journal_size
+        assert os.path.getsize(segment_path(self.directory, self.journal.active_segment)) == 0
+
+    def test_drainer_stops_when_the_publisher_disconnects(self):
+        self.journal_messages(5)
+        self.journal.start()
+        publisher = FakeConfirmPublisher()
+        publisher.wait_until_ready = MagicMock(side_effect=[True, False])
+        drainer = OutboxDrainer(self.journal, publisher, batch_size=2)
+
+        assert not drainer.drain()
+
+        assert len(publisher.published) == 2
+        assert drainer.read_checkpoint()[1] > 0
+
+    def test_drainer_and_batcher_publish_concurrently_beyond_the_in_flight_limit(self):
+        from app.publisher import ConfirmPublisher, PublishBatcher
+
+        self.journal_messages(50)
+        self.journal.start()
+        confirm_publisher = ConfirmPublisher(exchange_name='test-exchange', max_in_flight=5)
+        confirm_publisher._on_confirm_select_ok(MagicMock(), None)
+        confirm_publisher._ioloop = ConfirmingIOLoop(confirm_publisher)
+        batcher = PublishBatcher(confirm_publisher, max_messages=20, max_latency_ms=50)
+        batcher._max_messages = 20  # as if unclamped, to batch beyond the in flight limit
+        drainer = OutboxDrainer(self.journal, confirm_publisher, batch_size=40)
+        messages = [MagicMock() for _ in range(50)]
+
+        batcher.start()
+        for message in messages:
+            batcher.submit(message, b'{}', 'test.route')
+        drain_thread = threading.Thread(target=lambda: self.assertTrue(drainer.drain()))
+        drain_thread.start()
+        drain_thread.join(10)
+        batcher.stop(timeout=10)
+        confirm_publisher._ioloop.stop()
+
+        assert not drain_thread.is_alive(), 'Expected the drainer to finish rather than deadlock'
+        for message in messages:
+            message.ack.assert_called_once()
+        assert drainer.read_checkpoint()[0] == self.journal.active_segment
@@ -0,0 +1,296 @@
+import threading
+from unittest import TestCase
+from unittest.mock import ANY, MagicMock, patch
+
+from pika.exceptions import ChannelWrongStateError
+from pika.spec import Basic
+
+from app.stage_timing import NULL_TIMER
+
+
+class ConfirmPublisherTestCase(TestCase):
+
+    def setUp(self):
+        from app.publisher import ConfirmPublisher
+
+        from app.backpressure import Backpressure
+
+        self.backpressure = Backpressure()
+        backpressure_patcher = patch('app.publisher.backpressure', self.backpressure)
+        backpressure_patcher.start()
+        self.addCleanup(backpressure_patcher.stop)
+        self.publisher = ConfirmPublisher(exchange_name='test-exchange', max_in_flight=10)
+        self.channel = MagicMock()
+        self.publisher._on_confirm_select_ok(self.channel, None)
+
+    @staticmethod
+    def confirmation(method_class, delivery_tag, multiple=False):
+        frame = MagicMock()
+        frame.method = method_class(delivery_tag=delivery_tag, multiple=multiple)
+        return frame
+
+    def publish(self, count):
+        messages = [MagicMock() for _ in range(count)]
+        for message in messages:
+            self.publisher._capacity.acquire()
+            self.publisher._publish(message, 'body', 'test.route', 'test-subscription')
+        return messages
+
+    def test_publish_hands_message_to_io_thread(self):
+        message = MagicMock()
+        self.publisher._ioloop = MagicMock()
+
+        self.publisher.publish(message, 'body', 'test.route')
+
+        self.publisher._ioloop.add_callback_threadsafe.assert_called_once()
+        message.ack.assert_not_called()
+
+    def test_message_is_acked_when_broker_confirms(self):
+        message, = self.publish(1)
+
+        self.channel.basic_publish.assert_called_once_with('test-exchange', 'test.route', 'body',
+                                                           self.publisher._properties)
+        message.ack.assert_not_called()
+
+        self.publisher._on_delivery_confirmation(self.confirmation(Basic.Ack, 1))
+
+        message.ack.assert_called_once()
+        message.nack.assert_not_called()
+
+    def test_multiple_confirm_acks_all_messages_up_to_delivery_tag(self):
+        first, second, third = self.publish(3)
+
+        self.publisher._on_delivery_confirmation(self.confirmation(Basic.Ack, 2, multiple=True))
+
+        first.ack.assert_called_once()
+        second.ack.assert_called_once()
+        third.ack.assert_not_called()
+        assert list(self.publisher._unconfirmed) == [3]
+
+    def test_message_is_nacked_when_broker_rejects(self):
+        first, second = self.publish(2)
+
+        self.publisher._on_delivery_confirmation(self.confirmation(Basic.Nack, 2))
+
+        first.nack.assert_not_called()
+        second.nack.assert_called_once()
+        second.ack.assert_not_called()
+
+    def test_unconfirmed_messages_are_nacked_on_disconnect(self):
+        messages = self.publish(3)
+
+        self.publisher._on_disconnect()
+
+        for message in messages:
+            message.nack.assert_called_once()
+        assert not self.publisher._unconfirmed
+        assert not self.publisher._ready.is_set()
+
+    def test_callbacks_are_paused_while_disconnected(self):
+        self.publisher._on_disconnect()
+
+        assert self.backpressure.paused
+
+        self.publisher._on_confirm_select_ok(self.channel, None)
+
+        assert not self.backpressure.paused
+
+    def test_callbacks_are_not_paused_while_disconnected_with_an_outbox(self):
+        self.publisher.outbox = MagicMock()
+
+        self.publisher._on_disconnect()
+
+        assert not self.backpressure.paused
+
+    def test_message_is_nacked_when_not_connected(self):
+        self.publisher._on_disconnect()
+
+        message, = self.publish(1)
+
+        message.nack.assert_called_once()
+        self.channel.basic_publish.assert_not_called()
+
+    def test_message_is_nacked_when_publish_fails(self):
+        self.channel.basic_publish.side_effect = ChannelWrongStateError
+
+        message, = self.publish(1)
+
+        message.nack.assert_called_once()
+        assert not self.publisher._unconfirmed
+
+    def test_capacity_is_released_when_messages_are_settled(self):
+        self.publish(10)
+        assert not self.publisher._capacity.acquire(blocking=False), 'Expected in flight limit to be reached'
+
+        self.publisher._on_delivery_confirmation(self.confirmation(Basic.Ack, 10, multiple=True))
+
+        assert self.publisher._capacity.acquire(blocking=False), 'Expected in flight capacity to be released'
+
+    def test_settle_listeners_are_told_before_message_is_acked(self):
+        listener = MagicMock()
+        self.publisher.add_settle_listener(listener)
+        message, = self.publish(1)
+        message.ack.side_effect = lambda: listener.assert_called_once_with(message, True)
+
+        self.publisher._on_delivery_confirmation(self.confirmation(Basic.Ack, 1))
+
+        message.ack.assert_called_once()
+
+    def test_ack_stage_is_timed_on_the_messages_own_timer(self):
+        sampled = MagicMock(sampled=True)
+        message = MagicMock()
+        self.publisher._capacity.acquire()
+        self.publisher._publish(message, 'body', 'test.route', 'test-subscription', sampled)
+        unsampled, = self.publish(1)
+
+        self.publisher._on_delivery_confirmation(self.confirmation(Basic.Ack, 2, multiple=True))
+
+        sampled.observe.assert_called_once_with('ack', ANY)
+        message.ack.assert_called_once()
+        unsampled.ack.assert_called_once()
+
+    def test_publish_batch_wakes_io_thread_once(self):
+        self.publisher._ioloop = MagicMock()
+        batch = [(MagicMock(), 'body', 'test.route', 'test-subscription', NULL_TIMER) for _ in range(3)]
+
+        self.publisher.publish_batch(batch)
+
+        self.publisher._ioloop.add_callback_threadsafe.assert_called_once()
+        callback = self.publisher._ioloop.add_callback_threadsafe.call_args[0][0]
+        callback()
+        assert self.channel.basic_publish.call_count == 3
+        assert list(self.publisher._unconfirmed) == [1, 2, 3]
+
+    def test_publish_batch_hands_over_messages_with_capacity_before_waiting(self):
+        self.publisher._ioloop = MagicMock()
+        held = self.publish(8)  # two permits left
+        batch = [(MagicMock(), 'body', 'test.route', 'test-subscription', NULL_TIMER) for _ in range(3)]
+        publishing = threading.Thread(target=self.publisher.publish_batch, args=(batch,))
+
+        publishing.start()
+        publishing.join(0.1)
+        assert publishing.is_alive(), 'Expected publish_batch to wait for capacity'
+        handed_over = self.publisher._ioloop.add_callback_threadsafe.call_args[0][0]
+        assert handed_over.args[0] == batch[:2]
+
+        self.publisher._on_delivery_confirmation(self.confirmation(Basic.Ack, 1))
+        publishing.join(5)
+        assert not publishing.is_alive()
+        assert self.publisher._ioloop.add_callback_threadsafe.call_args[0][0].args[0] == batch[2:]
+        held[0].ack.assert_called_once()
+
+
+class PublisherPoolTestCase(TestCase):
+
+    def setUp(self):
+        from app.backpressure import Backpressure
+        from app.publisher import PublisherPool
+
+        self.backpressure = Backpressure()
+        backpressure_patcher = patch('app.publisher.backpressure', self.backpressure)
+        backpressure_patcher.start()
+        self.addCleanup(backpressure_patcher.stop)
+        self.pool = PublisherPool(size=2, exchange_name='test-exchange', max_in_flight=10)
+        self.first, self.second = self.pool.publishers
+        for confirm_publisher in self.pool.publishers:
+            confirm_publisher._ioloop = MagicMock(add_callback_threadsafe=lambda callback: callback())
+
+    def test_batches_are_spread_over_connected_publishers(self):
+        for confirm_publisher in self.pool.publishers:
+            confirm_publisher._on_confirm_select_ok(MagicMock(), None)
+
+        for _ in range(4):
+            self.pool.publish_batch([(MagicMock(), 'body', 'test.route', 'test-subscription', NULL_TIMER)])
+
+        assert list(self.first._unconfirmed) == [1, 2]
+        assert list(self.second._unconfirmed) == [1, 2]
+
+    def test_disconnected_publishers_are_skipped(self):
+        self.second._on_confirm_select_ok(MagicMock(), None)
+
+        for _ in range(2):
+            self.pool.publish_batch([(MagicMock(), 'body', 'test.route', 'test-subscription', NULL_TIMER)])
+
+        assert self.pool.wait_until_ready(0)
+        assert list(self.second._unconfirmed) == [1, 2]
+
+    def test_callbacks_are_held_once_every_publisher_is_disconnected(self):
+        for confirm_publisher in self.pool.publishers:
+            confirm_publisher._on_confirm_select_ok(MagicMock(), None)
+
+        self.first._on_disconnect()
+        assert not self.backpressure.paused
+
+        self.second._on_disconnect()
+        assert self.backpressure.paused
+        assert not self.pool.wait_until_ready(0)
+
+        self.first._on_confirm_select_ok(MagicMock(), None)
+        assert not self.backpressure.paused
+
+    def test_settle_listeners_and_outbox_are_shared(self):
+        listener, outbox = MagicMock(), MagicMock()
+
+        self.pool.add_settle_listener(listener)
+        self.pool.outbox = outbox
+
+        for confirm_publisher in self.pool.publishers:
+            assert confirm_publisher._settle_listeners == [listener]
+            assert confirm_publisher.outbox is outbox
+
+
+class PublishBatcherTestCase(TestCase):
+
+    def setUp(self):
+        from app.publisher import PublishBatcher
+
+        self.confirm_publisher = MagicMock(max_in_flight=1000)
+        self.batcher = PublishBatcher(self.confirm_publisher, max_messages=3, max_bytes=10, max_latency_ms=5,
+                                      queue_size=10)
+
+    def test_batch_is_bounded_by_message_count(self):
+        for i in range(5):
+            self.batcher.submit(i, 'a')
+
+        batch, stopping = self.batcher._next_batch()
+
+        assert [message for message, _, _, _, _ in batch] == [0, 1, 2]
+        assert not stopping
+
+    def test_batch_is_bounded_by_bytes(self):
+        self.batcher.submit(0, 'aaaaaa')
+        self.batcher.submit(1, 'bbbbbb')
+        self.batcher.submit(2, 'c')
+
+        batch, _ = self.batcher._next_batch()
+
+        assert [message for message, _, _, _, _ in batch] == [0, 1]
+
+    def test_partial_batch_is_released_after_max_latency(self):
+        self.batcher.submit(0, 'a', 'test.route')
+
+        batch, stopping = self.batcher._next_batch()
+
+        assert batch == [(0, 'a', 'test.route', None, NULL_TIMER)]
+        assert not stopping
+
+    def test_queued_messages_are_published_on_stop(self):
+        self.batcher.start()
+        self.batcher.submit(0, 'a')
+        self.batcher.submit(1, 'b')
+        self.batcher.stop(timeout=5)
+
+        published = [message for call in self.confirm_publisher.publish_batch.call_args_list
+                     for message, _, _, _, _ in call[0][0]]
+        assert published == [0, 1]
+
+    def test_batches_are_clamped_to_the_in_flight_limit(self):
+        from app.publisher import PublishBatcher
+
+        batcher = PublishBatcher(MagicMock(max_in_flight=2), max_messages=200, max_latency_ms=5)
+        for i in range(5):
+            batcher.submit(i, 'a')
+
+        batch, _ = batcher._next_batch()
+
+        assert len(batch) == 2
@@ -0,0 +1,119 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from app.quarantine import QuarantineStore, quarantine_message, record_data
+from app.subscription_config import load_subscriptions
+
+
+class FakeConfirmPublisher:
+    """
+    Confirms or rejects every published message straight away
+    """
+    max_in_flight = 1000
+
+    def __init__(self, acked=True):
+        self.acked = acked
+        self.published = []
+
+    def publish_batch(self, batch):
+        self.published.extend(batch)
+        for message, *_ in batch:
+            message.ack() if self.acked else message.nack()
+
+
+class QuarantineTestCase(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = QuarantineStore(self.directory)
+        self.subscription = load_subscriptions(config_file=None, enabled='offline_receipt')['offline_receipt']
+        self.message = MagicMock()
+        self.message.message_id = 'test-message-id'
+        self.message.attributes = {'test': 'attribute'}
+        self.message.data = b'{"transactionId": "tx-1", "bad": "\xff"}'
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read_records(self):
+        with open(self.store.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_invalid_message_is_stored_and_acked(self):
+        assert quarantine_message(self.subscription, self.message, 'missing_data', MagicMock(), store=self.store,
+                                  routing_key=None)
+
+        record, = self.read_records()
+        assert record['reason'] == 'missing_data'
+        assert record['subscription'] == 'offline_receipt'
+        assert record['translator'] == 'offline_receipt'
+        assert record['message_id'] == 'test-message-id'
+        assert record['attributes'] == {'test': 'attribute'}
+        assert record_data(record) == self.message.data
+        self.message.ack.assert_called_once()
+
+    def test_invalid_message_is_published_to_quarantine_route(self):
+        with patch('app.quarantine.publish_message') as mock_publish_message:
+            assert quarantine_message(self.subscription, self.message, 'not_json', MagicMock(), store=self.store,
+                                      routing_key='quarantine.pubsub')
+
+        assert mock_publish_message.call_args[1]['routing_key'] == 'quarantine.pubsub'
+        assert json.loads(mock_publish_message.call_args[0][1])['reason'] == 'not_json'
+        self.message.ack.assert_not_called()  # acked when rabbitmq confirms the publish
+        assert not os.path.exists(self.store.path)
+
+    def test_message_is_not_acked_without_a_quarantine(self):
+        with patch('app.quarantine.quarantine_store', None):
+            assert not quarantine_message(self.subscription, self.message, 'not_json', MagicMock(), routing_key=None)
+
+        self.message.ack.assert_not_called()
+
+    def test_subscriber_quarantines_invalid_messages(self):
+        from app.subscriber import process_message
+
+        self.message.data = b'not json'
+        with patch('app.quarantine.quarantine_store', self.store), \
+                patch('app.subscriber.publish_message') as mock_publish_message:
+            process_message(self.subscription, self.message)
+
+        assert self.read_records()[0]['reason'] == 'not_json'
+        self.message.ack.assert_called_once()
+        mock_publish_message.assert_not_called()
+
+    def test_fixed_records_are_reinjected(self):
+        from reinject import reinject
+
+        quarantine_message(self.subscription, self.message, 'missing_data', MagicMock(), store=self.store,
+                           routing_key=None)
+        quarantine_message(self.subscription, self.message, 'missing_data', MagicMock(), store=self.store,
+                           routing_key=None)
+        fixed, still_broken = self.read_records()
+        fixed['data'] = json.dumps({'transactionId': 'tx-1', 'questionnaireId': '0120000000001000',
+                                    'channel': 'PQRS', 'dateTime': '2008-08-24T00:00:00'})
+
+        confirm_publisher = FakeConfirmPublisher()
+
+        remaining = reinject([fixed, still_broken], confirm_publisher)
+
+        (message, body, routing_key, subscription_name, _), = confirm_publisher.published
+        assert json.loads(body)['event']['transactionId'] == 'tx-1'
+        assert (routing_key, subscription_name) == (self.subscription.routing_key, 'offline_receipt')
+        assert message.acked
+        assert [record['message_id'] for record in remaining] == ['test-message-id']
+
+    def test_unconfirmed_records_remain_to_be_retried(self):
+        from reinject import UNCONFIRMED, reinject
+
+        quarantine_message(self.subscription, self.message, 'missing_data', MagicMock(), store=self.store,
+                           routing_key=None)
+        record, = self.read_records()
+        record['data'] = json.dumps({'transactionId': 'tx-1', 'questionnaireId': '0120000000001000',
+                                     'channel': 'PQRS', 'dateTime': '2008-08-24T00:00:00'})
+
+        remaining = reinject([record], FakeConfirmPublisher(acked=False))
+
+        assert remaining == [dict(record, reason=UNCONFIRMED)]
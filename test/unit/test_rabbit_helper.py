@@ -34,6 +34,16 @@ class RabbitHelperTestCase(TestCase):
         }
         os.environ.update(test_environment_variables)
 
+        # The module may already have been imported by another test with different settings
+        rabbit_settings = patch.multiple('app.rabbit_helper',
+                                         RABBIT_USERNAME=self.rabbit_username,
+                                         RABBIT_PASSWORD=self.rabbit_password,
+                                         RABBIT_HOST=self.rabbit_host,
+                                         RABBIT_PORT=self.rabbit_port,
+                                         RABBIT_VIRTUALHOST=self.rabbit_virtualhost)
+        rabbit_settings.start()
+        self.addCleanup(rabbit_settings.stop)
+
     def test_rabbit_init(self):
         from app.rabbit_helper import init_rabbitmq
 
@@ -49,7 +59,8 @@ class RabbitHelperTestCase(TestCase):
 
             mock_pika.PlainCredentials.assert_called_once_with(self.rabbit_username, self.rabbit_password)
             mock_pika.ConnectionParameters.assert_called_once_with(
-                self.rabbit_host, self.rabbit_port, self.rabbit_virtualhost, mock_pika.PlainCredentials.return_value)
+                self.rabbit_host, self.rabbit_port, self.rabbit_virtualhost, mock_pika.PlainCredentials.return_value,
+                heartbeat=30)
 
     def test_initialise_messaging_rabbit_fails(self):
         from app.rabbit_helper import init_rabbitmq
@@ -78,10 +89,11 @@ class RabbitHelperTestCase(TestCase):
 
             mock_pika.PlainCredentials.assert_called_once_with(self.rabbit_username, self.rabbit_password)
             mock_pika.ConnectionParameters.assert_called_once_with(
-                self.rabbit_host, self.rabbit_port, self.rabbit_virtualhost, mock_pika.PlainCredentials.return_value)
+                self.rabbit_host, self.rabbit_port, self.rabbit_virtualhost, mock_pika.PlainCredentials.return_value,
+                heartbeat=30)
 
             channel_mock.basic_publish.assert_called_once_with(exchange=self.rabbit_exchange,
                                                                routing_key=self.binding_key,
-                                                               body=str(self.message),
+                                                               body=self.message,
                                                                properties=self.property_class)
             connection_mock.close.assert_called_once()
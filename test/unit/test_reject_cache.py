@@ -0,0 +1,117 @@
+from functools import partial
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from app.reject_cache import FAST_REJECTS, RejectCache, payload_fingerprint
+from app.subscription_config import load_subscriptions
+
+
+def mock_message(message_id, data=b'not json', attributes=None):
+    message = MagicMock()
+    message.message_id = message_id
+    message.data = data
+    message.attributes = attributes or {}
+    return message
+
+
+class RejectCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.cache = RejectCache(max_size=4, log_interval=60)
+        self.subscription = load_subscriptions(config_file=None, enabled='offline_receipt')['offline_receipt']
+
+    def test_payload_fingerprint_covers_data_and_attributes(self):
+        fingerprint = payload_fingerprint(mock_message('1', attributes={'a': '1'}))
+
+        assert payload_fingerprint(mock_message('2', attributes={'a': '1'})) == fingerprint
+        assert payload_fingerprint(mock_message('1', attributes={'a': '2'})) != fingerprint
+        assert payload_fingerprint(mock_message('1', data=b'other', attributes={'a': '1'})) != fingerprint
+
+    def test_redelivery_and_resend_are_known_invalid(self):
+        self.cache.add('offline_receipt', mock_message('1'), 'not_json')
+
+        assert self.cache.get('offline_receipt', mock_message('1', data=b'{}')) == ('not_json', False)
+        assert self.cache.get('offline_receipt', mock_message('2')) == ('not_json', False)
+        assert self.cache.get('offline_receipt', mock_message('3', data=b'{}')) is None
+        assert self.cache.get('eq_receipt', mock_message('1')) is None
+
+    def test_least_recently_seen_fingerprints_are_evicted(self):
+        self.cache.add('offline_receipt', mock_message('1', data=b'1'), 'not_json')
+        self.cache.add('offline_receipt', mock_message('2', data=b'2'), 'not_json')
+        self.cache.add('offline_receipt', mock_message('3', data=b'3'), 'not_json')
+
+        assert len(self.cache) == 4
+        assert self.cache.get('offline_receipt', mock_message('1', data=b'1')) is None
+        assert self.cache.get('offline_receipt', mock_message('3', data=b'3'))
+
+    def test_fast_reject_acks_only_quarantined_messages(self):
+        rejects_before = FAST_REJECTS.labels(self.subscription.subscription_name, 'missing_data').get()
+        self.cache.add('offline_receipt', mock_message('1', data=b'1'), 'missing_data', quarantined=True)
+        self.cache.add('offline_receipt', mock_message('2', data=b'2'), 'missing_data', quarantined=False)
+        quarantined, not_quarantined, valid = mock_message('1'), mock_message('2'), mock_message('3', data=b'3')
+
+        assert self.cache.fast_reject(self.subscription, quarantined)
+        assert self.cache.fast_reject(self.subscription, not_quarantined)
+        assert not self.cache.fast_reject(self.subscription, valid)
+
+        quarantined.ack.assert_called_once()
+        not_quarantined.ack.assert_not_called()
+        assert FAST_REJECTS.labels(self.subscription.subscription_name, 'missing_data').get() == rejects_before + 2
+
+    def test_fast_rejects_are_logged_at_most_once_per_interval(self):
+        self.cache.add('offline_receipt', mock_message('1'), 'not_json')
+
+        with patch('app.reject_cache.logger') as mock_logger, patch('app.reject_cache.monotonic', return_value=1e9):
+            for _ in range(5):
+                self.cache.fast_reject(self.subscription, mock_message('1'))
+
+        mock_logger.warning.assert_called_once_with('Rejected known invalid Pub/Sub Messages', rejected=1)
+
+    def test_disabled_cache_rejects_nothing(self):
+        cache = RejectCache(max_size=0)
+
+        cache.add('offline_receipt', mock_message('1'), 'not_json')
+
+        assert not cache.fast_reject(self.subscription, mock_message('1'))
+
+    def test_subscriber_rejects_resent_invalid_message_without_decoding_it(self):
+        from app import subscriber
+
+        with patch('app.subscriber.reject_cache', self.cache), patch('app.subscriber.logger') as mock_logger:
+            subscriber.process_message(self.subscription, mock_message('1'))
+            mock_logger.reset_mock()
+            with patch('app.translators.json_codec.loads') as mock_loads:
+                subscriber.process_message(self.subscription, mock_message('2'))
+
+        mock_loads.assert_not_called()
+        mock_logger.bind.assert_not_called()
+
+    def test_published_quarantine_is_only_trusted_once_confirmed(self):
+        confirmed, rejected = mock_message('1', data=b'1'), mock_message('2', data=b'2')
+        for message in (confirmed, rejected):
+            self.cache.add('offline_receipt', message, 'not_json')
+            self.cache.track_quarantine('offline_receipt', message)
+
+        self.cache.on_settled(confirmed, True)
+        self.cache.on_settled(rejected, False)
+
+        assert self.cache.get('offline_receipt', mock_message('1', data=b'1')) == ('not_json', True)
+        assert self.cache.get('offline_receipt', mock_message('2', data=b'2')) is None
+
+    def test_subscriber_quarantines_redelivery_when_quarantine_publish_is_nacked(self):
+        from app import subscriber
+        from app.quarantine import quarantine_message
+
+        routed_quarantine_message = partial(quarantine_message, routing_key='quarantine.pubsub')
+        with patch('app.subscriber.reject_cache', self.cache), patch('app.quarantine.reject_cache', self.cache), \
+                patch('app.subscriber.quarantine_message', routed_quarantine_message), \
+                patch('app.quarantine.publish_message') as mock_publish_message:
+            message = mock_message('1')
+            subscriber.process_message(self.subscription, message)
+            self.cache.on_settled(message, False)  # rabbitmq rejected the quarantine record, the message is nacked
+            redelivery = mock_message('1')
+            subscriber.process_message(self.subscription, redelivery)
+
+        assert mock_publish_message.call_count == 2, 'Expected the redelivery to be quarantined again'
+        assert mock_publish_message.call_args[0][0] is redelivery
+        redelivery.ack.assert_not_called()  # acked once its quarantine record is confirmed
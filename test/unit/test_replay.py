@@ -0,0 +1,191 @@
+import base64
+import io
+import json
+import mmap
+import os
+import shutil
+import tempfile
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from app.quarantine import record_data
+from app.subscription_config import load_subscriptions
+from replay import RateLimiter, Replay, parse_record, read_checkpoint, read_lines, replay_export
+
+
+def offline_receipt(tx_id):
+    return json.dumps({'transactionId': tx_id, 'questionnaireId': '01', 'channel': 'PQRS',
+                       'dateTime': '2008-08-24T00:00:00'})
+
+
+def export_line(data, message_id=None):
+    record = {'data': data, 'attributes': {}}
+    if message_id:
+        record['message_id'] = message_id
+    return json.dumps(record) + '\n'
+
+
+class FakePublisher:
+    """
+    Confirms or rejects every published message straight away
+    """
+
+    def __init__(self, acked=True, max_in_flight=1000):
+        self.acked = acked
+        self.max_in_flight = max_in_flight
+        self.published = []
+        self.batch_sizes = []
+
+    def publish_batch(self, batch):
+        self.batch_sizes.append(len(batch))
+        for message, body, routing_key, subscription_name, _timer in batch:
+            self.published.append((json.loads(body), routing_key, subscription_name))
+            message.ack() if self.acked else message.nack()
+
+
+class ReplayTestCase(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.export_file = os.path.join(self.directory, 'export.jsonl')
+        self.subscription = load_subscriptions(config_file=None, enabled=None)['offline_receipt']
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_export(self, lines):
+        with open(self.export_file, 'w') as f:
+            f.writelines(lines)
+
+    def replay(self, publishers, offset=0, **kwargs):
+        replay = Replay(self.subscription, publishers, checkpoint_file=self.export_file + '.checkpoint', **kwargs)
+        with open(self.export_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as export:
+            replayed = replay.run(export, offset)
+        return replay, replayed
+
+    def test_lines_are_read_from_the_offset(self):
+        export = b'{"a": 1}\n\n{"b": 2}\n{"c": 3}'
+
+        assert list(read_lines(export, 0)) == [(0, b'{"a": 1}\n', 9), (10, b'{"b": 2}\n', 19),
+                                               (19, b'{"c": 3}', 27)]
+        assert [line for _, line, _ in read_lines(export, 10)] == [b'{"b": 2}\n', b'{"c": 3}']
+
+    def test_records_are_parsed(self):
+        message = parse_record(export_line('{"a": 1}', message_id='id-1'), offset=0)
+        assert (message.message_id, message.data, message.attributes) == ('id-1', b'{"a": 1}', {})
+
+        encoded = json.dumps({'data': base64.b64encode(b'{"a": 1}').decode(), 'messageId': 'id-2'})
+        message = parse_record(encoded, offset=0, base64_data=True)
+        assert (message.message_id, message.data) == ('id-2', b'{"a": 1}')
+
+        message = parse_record(json.dumps({'data': {'a': 1}}), offset=42)
+        assert message.message_id == 'offset-42'
+        assert json.loads(message.data) == {'a': 1}
+
+        with self.assertRaises(ValueError):
+            parse_record('[]', offset=0)
+        with self.assertRaises(ValueError):
+            parse_record(json.dumps({'data': '{}', 'attributes': ['eventType']}), offset=0)
+
+    def test_records_are_translated_and_published(self):
+        self.write_export([export_line(offline_receipt(str(i))) for i in range(5)])
+        publishers = [FakePublisher(), FakePublisher()]
+
+        replay, replayed = self.replay(publishers, chunk_size=2, publish_batch_size=1)
+
+        assert replayed
+        assert replay.counts == {'records': 5, 'valid': 5, 'published': 5}
+        published = publishers[0].published + publishers[1].published
+        assert len(publishers[0].published) == 3 and len(publishers[1].published) == 2
+        assert sorted(event['event']['transactionId'] for event, _, _ in published) == ['0', '1', '2', '3', '4']
+        assert {(routing_key, subscription_name) for _, routing_key, subscription_name in published} == {
+            (self.subscription.routing_key, self.subscription.subscription_name)}
+        assert read_checkpoint(self.export_file + '.checkpoint') == os.path.getsize(self.export_file)
+
+    def test_publish_batches_fit_the_publishers_in_flight_limit(self):
+        self.write_export([export_line(offline_receipt(str(i))) for i in range(5)])
+        publisher = FakePublisher(max_in_flight=2)
+
+        replay, replayed = self.replay([publisher], publish_batch_size=500)
+
+        assert replayed
+        assert publisher.batch_sizes == [2, 2, 1]
+
+    def test_invalid_records_are_written_as_quarantine_records(self):
+        self.write_export([export_line(offline_receipt('1')), export_line('{"transactionId": "2"}'), 'not json\n'])
+        invalid_file = io.StringIO()
+
+        replay, replayed = self.replay([FakePublisher()], invalid_file=invalid_file)
+
+        assert not replayed
+        assert replay.counts == {'records': 3, 'valid': 1, 'invalid': 2, 'published': 1}
+        missing_data, malformed = [json.loads(line) for line in invalid_file.getvalue().splitlines()]
+        assert missing_data['reason'] == 'missing_data'
+        assert missing_data['translator'] == 'offline_receipt'
+        assert record_data(missing_data) == b'{"transactionId": "2"}'
+        assert malformed['reason'] == 'malformed'
+        assert record_data(malformed) == b'not json'
+
+    def test_replay_stops_at_the_checkpoint_when_not_confirmed(self):
+        self.write_export([export_line(offline_receipt(str(i))) for i in range(4)])
+
+        replay, replayed = self.replay([FakePublisher(acked=False)], chunk_size=2)
+
+        assert not replayed
+        assert replay.counts['failed'] == 2
+        assert replay.offset == 0
+        assert read_checkpoint(self.export_file + '.checkpoint') == 0
+
+    def test_replay_resumes_from_the_checkpoint(self):
+        lines = [export_line(offline_receipt(str(i))) for i in range(4)]
+        self.write_export(lines)
+        publisher = FakePublisher()
+
+        replay, replayed = self.replay([publisher], offset=sum(len(line) for line in lines[:3]))
+
+        assert replayed
+        assert [event['event']['transactionId'] for event, _, _ in publisher.published] == ['3']
+
+    def test_dry_run_only_validates(self):
+        self.write_export([export_line(offline_receipt('1')), export_line('{}')])
+
+        replay, replayed = self.replay(None)
+
+        assert not replayed
+        assert replay.counts == {'records': 2, 'valid': 1, 'invalid': 1}
+        assert replay.offset == os.path.getsize(self.export_file)
+        assert not os.path.exists(self.export_file + '.checkpoint')
+
+    def test_export_is_replayed_from_the_checkpoint_file(self):
+        self.write_export([export_line(offline_receipt('1'))])
+        args = SimpleNamespace(export_file=self.export_file, dry_run=False, checkpoint_file=None, start_offset=None,
+                               invalid_file=None, rate=0, chunk_size=10, base64=False)
+        publisher = FakePublisher()
+
+        replay_export(args, self.subscription, [publisher])
+        replay, replayed = replay_export(args, self.subscription, [publisher])
+
+        assert replayed
+        assert len(publisher.published) == 1  # the second run resumed at the end of the export
+        assert replay.counts['records'] == 0
+        assert not os.path.exists(self.export_file + '.invalid')
+
+    def test_rate_limiter_paces_records(self):
+        with patch('replay.monotonic', return_value=100.0):
+            limiter = RateLimiter(rate=10)
+        mock_sleep = MagicMock()
+
+        with patch('replay.monotonic', return_value=100.0), patch('replay.sleep', mock_sleep):
+            limiter.wait(5)
+            limiter.wait(5)
+        with patch('replay.monotonic', return_value=101.5), patch('replay.sleep', mock_sleep):
+            limiter.wait(5)
+
+        assert [call[0][0] for call in mock_sleep.call_args_list] == [0.5]
+
+    def test_unlimited_rate_does_not_wait(self):
+        with patch('replay.sleep') as mock_sleep:
+            RateLimiter(rate=0).wait(1000)
+
+        mock_sleep.assert_not_called()
@@ -0,0 +1,53 @@
+import json
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from app.stage_timing import NULL_TIMER, STAGE_DURATION, StageTimer, start_timer
+
+
+class StageTimingTestCase(TestCase):
+
+    def test_no_messages_are_timed_when_sampling_is_off(self):
+        assert start_timer('test-subscription', sample_rate=0) is NULL_TIMER
+
+    def test_every_message_is_timed_at_full_sample_rate(self):
+        assert isinstance(start_timer('test-subscription', sample_rate=1), StageTimer)
+
+    def test_repeated_stages_accumulate(self):
+        timer = StageTimer('test-subscription')
+
+        with patch('app.stage_timing.perf_counter', side_effect=[1.0, 1.5, 2.5]):
+            timer._last = 0.0
+            timer.mark('log')
+            timer.mark('decode')
+            timer.mark('log')
+
+        assert timer.timings == {'log': 2.0, 'decode': 0.5}
+
+    def test_record_observes_histogram_and_logs_one_line(self):
+        timer = StageTimer('test-stage-subscription')
+        timer.timings = {'decode': 0.000012, 'publish': 0.0002}
+        log = MagicMock()
+
+        timer.record(log)
+
+        log.info.assert_called_once_with('Message stage timings', stage_timings_us={'decode': 12, 'publish': 200})
+        _, total = STAGE_DURATION.labels('test-stage-subscription', 'publish').get()
+        assert total == 0.0002
+
+    def test_handler_stages_are_timed_when_sampled(self):
+        from app.subscriber import process_message
+        from app.subscription_config import load_subscriptions
+
+        subscription = load_subscriptions(config_file=None, enabled='offline_receipt')['offline_receipt']
+        message = MagicMock()
+        message.data = json.dumps({'dateTime': '2008-08-24T00:00:00', 'transactionId': 'abc',
+                                   'questionnaireId': '0120000000001000', 'channel': 'PQRS'}).encode()
+        timer = StageTimer(subscription.subscription_name)
+
+        with patch('app.subscriber.start_timer', return_value=timer), \
+                patch('app.subscriber.publish_message') as mock_publish_message:
+            process_message(subscription, message)
+
+        assert set(timer.timings) == {'log', 'decode', 'validate', 'datetime', 'build', 'serialise', 'publish'}
+        assert mock_publish_message.call_args[1]['timer'] is timer  # to time the ack once rabbitmq confirms
@@ -1,10 +1,16 @@
 import json
 import os
+import threading
 import uuid
 from contextlib import contextmanager
+from functools import partial
+from types import SimpleNamespace
 from unittest import TestCase
-from unittest.mock import MagicMock, patch
+from unittest.mock import ANY, MagicMock, patch
 
+from google.cloud.pubsub_v1.types import FlowControl
+
+from app.rabbit_helper import RABBIT_ROUTE
 from test import create_stub_function
 
 
@@ -54,6 +60,16 @@ class TestSubscriber(TestCase):
         else:
             self.fail(('No matching log records present', event, missing_keys))
 
+    def assertPublished(self, mock_publish_message, message, expected_body, expected_routing_key):
+        """
+        Assert a single message was published, comparing its bytes body by JSON content
+        """
+        mock_publish_message.assert_called_once_with(message, ANY, routing_key=expected_routing_key,
+                                                     subscription_name=ANY, timer=ANY)
+        body = mock_publish_message.call_args[0][1]
+        self.assertIsInstance(body, bytes)
+        self.assertEqual(json.loads(body), json.loads(expected_body))
+
     @contextmanager
     def checkExpectedLogLine(self, expected_log_level, expected_log_event, expected_log_kwargs):
         """
@@ -99,6 +115,16 @@ class TestSubscriber(TestCase):
         }
         os.environ.update(test_environment_variables)
 
+        from app.subscription_config import load_subscriptions
+        self.subscriptions = load_subscriptions(config_file=None, enabled=None)
+
+        from app.reject_cache import RejectCache
+        reject_cache = RejectCache(max_size=100)
+        for module in ('app.subscriber', 'app.quarantine'):
+            reject_cache_patcher = patch(f'{module}.reject_cache', reject_cache)
+            reject_cache_patcher.start()
+            self.addCleanup(reject_cache_patcher.stop)
+
     def test_subscription_set_up(self):
         from app.subscriber import setup_subscription
 
@@ -108,6 +134,8 @@ class TestSubscriber(TestCase):
             mock_client.subscription_path = create_stub_function(self.subscription_project_id, self.subscription_name,
                                                                  return_value=self.subscription_path)
             mock_client.subscribe = create_stub_function(self.subscription_path, callback_func,
+                                                         expected_kwargs={'flow_control': FlowControl(),
+                                                                          'scheduler': None},
                                                          return_value=self.subscriber_future)
 
             actual_future = setup_subscription(subscription_name=self.subscription_name,
@@ -116,8 +144,38 @@ class TestSubscriber(TestCase):
 
         assert actual_future == self.subscriber_future
 
-    @patch('app.subscriber.send_message_to_rabbitmq')
-    def test_receipt_to_case(self, mock_send_message_to_rabbit_mq):
+    def test_subscription_set_up_with_flow_control(self):
+        from app.subscriber import setup_subscription
+
+        flow_control = FlowControl(max_messages=10, max_bytes=1024, max_lease_duration=60)
+
+        with patch('app.subscriber.client') as mock_client:
+            mock_client.subscription_path.return_value = self.subscription_path
+
+            setup_subscription(subscription_name=self.subscription_name,
+                               subscription_project_id=self.subscription_project_id,
+                               callback=MagicMock(), flow_control=flow_control)
+
+        assert mock_client.subscribe.call_args[1]['flow_control'] == flow_control
+
+    def test_setup_subscriptions(self):
+        from app.subscriber import setup_subscriptions
+
+        with patch('app.subscriber.setup_subscription') as mock_setup_subscription, \
+                patch('app.subscriber.create_scheduler') as mock_create_scheduler:
+            futures = setup_subscriptions(self.subscriptions.values())
+
+        assert len(futures) == 4
+        subscription = self.subscriptions['offline_receipt']
+        mock_create_scheduler.assert_any_call(self.offline_subscription_name, subscription.executor_threads)
+        call_kwargs = mock_setup_subscription.call_args_list[1][1]
+        assert call_kwargs['subscription_name'] == self.offline_subscription_name
+        assert call_kwargs['subscription_project_id'] == self.offline_subscription_project_id
+        assert call_kwargs['callback'].args == (subscription,)
+        assert call_kwargs['flow_control'] == subscription.flow_control
+
+    @patch('app.subscriber.publish_message')
+    def test_receipt_to_case(self, mock_publish_message):
         mock_message = MagicMock()
         mock_message.attributes = {'eventType': 'OBJECT_FINALIZE',
                                    'bucketId': self.gcp_bucket,
@@ -157,16 +215,16 @@ class TestSubscriber(TestCase):
                 }
             })
 
-        from app.subscriber import eq_receipt_to_case
+        from app.subscriber import process_message
 
         with self.checkExpectedLogLine('INFO', expected_log_event, expected_log_kwargs):
-            eq_receipt_to_case(mock_message)
+            process_message(self.subscriptions['eq_receipt'], mock_message)
 
-        mock_send_message_to_rabbit_mq.assert_called_once_with(expected_rabbit_message)
-        mock_message.ack.assert_called_once()
+        self.assertPublished(mock_publish_message, mock_message, expected_rabbit_message, RABBIT_ROUTE)
+        mock_message.ack.assert_not_called()
 
-    @patch('app.subscriber.send_message_to_rabbitmq')
-    def test_offline_receipt_to_case(self, mock_send_message_to_rabbit_mq):
+    @patch('app.subscriber.publish_message')
+    def test_offline_receipt_to_case(self, mock_publish_message):
         mock_message = MagicMock()
         mock_message.data = json.dumps(
             {"transactionId": "1", "questionnaireId": self.questionnaire_id, "dateTime": self.created_offline_spec,
@@ -200,16 +258,16 @@ class TestSubscriber(TestCase):
                 }
             })
 
-        from app.subscriber import offline_receipt_to_case
+        from app.subscriber import process_message
 
         with self.checkExpectedLogLine('INFO', expected_log_event, expected_log_kwargs):
-            offline_receipt_to_case(mock_message)
+            process_message(self.subscriptions['offline_receipt'], mock_message)
 
-        mock_send_message_to_rabbit_mq.assert_called_once_with(expected_rabbit_message)
-        mock_message.ack.assert_called_once()
+        self.assertPublished(mock_publish_message, mock_message, expected_rabbit_message, RABBIT_ROUTE)
+        mock_message.ack.assert_not_called()
 
-    @patch('app.subscriber.send_message_to_rabbitmq')
-    def test_offline_receipt_to_case_unreceipt(self, mock_send_message_to_rabbit_mq):
+    @patch('app.subscriber.publish_message')
+    def test_offline_receipt_to_case_unreceipt(self, mock_publish_message):
         mock_message = MagicMock()
         mock_message.data = json.dumps(
             {"transactionId": "1", "questionnaireId": self.questionnaire_id, "dateTime": self.created_offline_spec,
@@ -243,16 +301,16 @@ class TestSubscriber(TestCase):
                 }
             })
 
-        from app.subscriber import offline_receipt_to_case
+        from app.subscriber import process_message
 
         with self.checkExpectedLogLine('INFO', expected_log_event, expected_log_kwargs):
-            offline_receipt_to_case(mock_message)
+            process_message(self.subscriptions['offline_receipt'], mock_message)
 
-        mock_send_message_to_rabbit_mq.assert_called_once_with(expected_rabbit_message)
-        mock_message.ack.assert_called_once()
+        self.assertPublished(mock_publish_message, mock_message, expected_rabbit_message, RABBIT_ROUTE)
+        mock_message.ack.assert_not_called()
 
-    @patch('app.subscriber.send_message_to_rabbitmq')
-    def test_ppo_undelivered_mail_to_case(self, mock_send_message_to_rabbit_mq):
+    @patch('app.subscriber.publish_message')
+    def test_ppo_undelivered_mail_to_case(self, mock_publish_message):
         mock_message = MagicMock()
         mock_message.data = json.dumps(
             {"transactionId": "1",
@@ -290,16 +348,16 @@ class TestSubscriber(TestCase):
                     }
                 }
             })
-        from app.subscriber import ppo_undelivered_mail_to_case
+        from app.subscriber import process_message
         with self.checkExpectedLogLine('DEBUG', expected_log_event, expected_log_kwargs):
-            ppo_undelivered_mail_to_case(mock_message)
+            process_message(self.subscriptions['ppo_undelivered'], mock_message)
 
-        mock_send_message_to_rabbit_mq.assert_called_once_with(expected_rabbit_message,
-                                                               routing_key='event.fulfilment.undelivered')
-        mock_message.ack.assert_called_once()
+        self.assertPublished(mock_publish_message, mock_message, expected_rabbit_message,
+                             'event.fulfilment.undelivered')
+        mock_message.ack.assert_not_called()
 
-    @patch('app.subscriber.send_message_to_rabbitmq')
-    def test_qm_undelivered_mail_to_case(self, mock_send_message_to_rabbit_mq):
+    @patch('app.subscriber.publish_message')
+    def test_qm_undelivered_mail_to_case(self, mock_publish_message):
         mock_message = MagicMock()
         mock_message.data = json.dumps(
             {"transactionId": "1",
@@ -331,23 +389,84 @@ class TestSubscriber(TestCase):
                 }
             }
         })
-        from app.subscriber import qm_undelivered_mail_to_case
+        from app.subscriber import process_message
         with patch('uuid.uuid4') as mock_uuid:
             with self.checkExpectedLogLine('DEBUG', expected_log_event, expected_log_kwargs):
                 mock_uuid.return_value = '12345'
-                qm_undelivered_mail_to_case(mock_message)
+                process_message(self.subscriptions['qm_undelivered'], mock_message)
+
+        self.assertPublished(mock_publish_message, mock_message, expected_rabbit_message,
+                             'event.fulfilment.undelivered')
+        mock_message.ack.assert_not_called()
 
-        mock_send_message_to_rabbit_mq.assert_called_once_with(expected_rabbit_message,
-                                                               routing_key='event.fulfilment.undelivered')
+    @patch('app.subscriber.publish_message')
+    def test_duplicate_message_is_acked_without_publishing(self, mock_publish_message):
+        from app.dedup import DedupCache
+        from app.subscriber import process_message
+
+        mock_message = MagicMock()
+        mock_message.data = json.dumps({
+            'transactionId': 'duplicate-tx-id',
+            'questionnaireId': self.questionnaire_id,
+            'channel': 'PQRS',
+            'dateTime': self.created_offline_spec,
+        }).encode()
+        cache = DedupCache(max_size=10, ttl=60)
+
+        with patch('app.subscriber.dedup_cache', cache):
+            process_message(self.subscriptions['offline_receipt'], mock_message)
+            cache.on_settled(mock_message, acked=True)
+            mock_publish_message.assert_called_once()
+            mock_message.ack.assert_not_called()
+
+            process_message(self.subscriptions['offline_receipt'], mock_message)
+
+        mock_publish_message.assert_called_once()
         mock_message.ack.assert_called_once()
 
-    @patch('app.subscriber.send_message_to_rabbitmq')
-    def test_receipt_to_case_missing_eventType(self, mock_send_message_to_rabbit_mq):
+    @patch('app.subscriber.publish_message', side_effect=RuntimeError('publisher stopped'))
+    def test_failed_publish_is_not_left_tracked_for_dedup(self, _mock_publish_message):
+        from app.dedup import DedupCache
+        from app.subscriber import process_message
+
+        mock_message = MagicMock()
+        mock_message.data = json.dumps({
+            'transactionId': 'unpublished-tx-id',
+            'questionnaireId': self.questionnaire_id,
+            'channel': 'PQRS',
+            'dateTime': self.created_offline_spec,
+        }).encode()
+        cache = DedupCache(max_size=10, ttl=60)
+
+        with patch('app.subscriber.dedup_cache', cache), self.assertRaises(RuntimeError):
+            process_message(self.subscriptions['offline_receipt'], mock_message)
+
+        assert not cache._pending
+
+    @patch('app.subscriber.publish_message')
+    def test_validation_failures_are_counted_by_reason(self, mock_publish_message):
+        from app.metrics import VALIDATION_FAILURES
+        from app.subscriber import process_message
+
+        subscription = self.subscriptions['offline_receipt']
+        failures = VALIDATION_FAILURES.labels(self.offline_subscription_name, 'not_json')
+        failures_before = failures.get()
+        mock_message = MagicMock()
+        mock_message.data = b'not json'
+
+        process_message(subscription, mock_message)
+
+        assert failures.get() == failures_before + 1
+        mock_publish_message.assert_not_called()
+
+    @patch('app.subscriber.publish_message')
+    def test_receipt_to_case_missing_eventType(self, mock_publish_message):
         mock_message = MagicMock()
         mock_message.message_id = str(uuid.uuid4())
         mock_message.attributes = {
             'bucketId': self.gcp_bucket,
             'objectId': self.gcp_object_id}
+        mock_message.data = b'{}'
 
         expected_log_event = 'Pub/Sub Message missing required attribute'
         expected_log_kwargs = {
@@ -357,21 +476,22 @@ class TestSubscriber(TestCase):
             'message_id': mock_message.message_id,
         }
 
-        from app.subscriber import eq_receipt_to_case
+        from app.subscriber import process_message
 
         with self.checkExpectedLogLine('ERROR', expected_log_event, expected_log_kwargs):
-            eq_receipt_to_case(mock_message)
+            process_message(self.subscriptions['eq_receipt'], mock_message)
 
-        mock_send_message_to_rabbit_mq.assert_not_called()
+        mock_publish_message.assert_not_called()
         mock_message.ack.assert_not_called()
 
-    @patch('app.subscriber.send_message_to_rabbitmq')
-    def test_receipt_to_case_missing_bucketId(self, mock_send_message_to_rabbit_mq):
+    @patch('app.subscriber.publish_message')
+    def test_receipt_to_case_missing_bucketId(self, mock_publish_message):
         mock_message = MagicMock()
         mock_message.message_id = str(uuid.uuid4())
         mock_message.attributes = {
             'eventType': 'OBJECT_FINALIZE',
             'objectId': self.gcp_object_id}
+        mock_message.data = b'{}'
 
         expected_log_event = 'Pub/Sub Message missing required attribute'
         expected_log_kwargs = {
@@ -381,21 +501,22 @@ class TestSubscriber(TestCase):
             'message_id': mock_message.message_id,
         }
 
-        from app.subscriber import eq_receipt_to_case
+        from app.subscriber import process_message
 
         with self.checkExpectedLogLine('ERROR', expected_log_event, expected_log_kwargs):
-            eq_receipt_to_case(mock_message)
+            process_message(self.subscriptions['eq_receipt'], mock_message)
 
-        mock_send_message_to_rabbit_mq.assert_not_called()
+        mock_publish_message.assert_not_called()
         mock_message.ack.assert_not_called()
 
-    @patch('app.subscriber.send_message_to_rabbitmq')
-    def test_receipt_to_case_missing_objectId(self, mock_send_message_to_rabbit_mq):
+    @patch('app.subscriber.publish_message')
+    def test_receipt_to_case_missing_objectId(self, mock_publish_message):
         mock_message = MagicMock()
         mock_message.message_id = str(uuid.uuid4())
         mock_message.attributes = {
             'eventType': 'OBJECT_FINALIZE',
             'bucketId': self.gcp_bucket}
+        mock_message.data = b'{}'
 
         expected_log_event = 'Pub/Sub Message missing required attribute'
         expected_log_kwargs = {
@@ -405,19 +526,20 @@ class TestSubscriber(TestCase):
             'message_id': mock_message.message_id,
         }
 
-        from app.subscriber import eq_receipt_to_case
+        from app.subscriber import process_message
 
         with self.checkExpectedLogLine('ERROR', expected_log_event, expected_log_kwargs):
-            eq_receipt_to_case(mock_message)
+            process_message(self.subscriptions['eq_receipt'], mock_message)
 
-        mock_send_message_to_rabbit_mq.assert_not_called()
+        mock_publish_message.assert_not_called()
         mock_message.ack.assert_not_called()
 
-    @patch('app.subscriber.send_message_to_rabbitmq')
-    def test_receipt_to_case_bad_eventType(self, mock_send_message_to_rabbit_mq):
+    @patch('app.subscriber.publish_message')
+    def test_receipt_to_case_bad_eventType(self, mock_publish_message):
         mock_message = MagicMock()
         mock_message.message_id = str(uuid.uuid4())
         mock_message.attributes = {'eventType': 'FAIL'}
+        mock_message.data = b'{}'
 
         expected_log_event = 'Unknown Pub/Sub Message eventType'
         expected_log_kwargs = {
@@ -427,16 +549,16 @@ class TestSubscriber(TestCase):
             'message_id': mock_message.message_id,
         }
 
-        from app.subscriber import eq_receipt_to_case
+        from app.subscriber import process_message
 
         with self.checkExpectedLogLine('ERROR', expected_log_event, expected_log_kwargs):
-            eq_receipt_to_case(mock_message)
+            process_message(self.subscriptions['eq_receipt'], mock_message)
 
-        mock_send_message_to_rabbit_mq.assert_not_called()
+        mock_publish_message.assert_not_called()
         mock_message.ack.assert_not_called()
 
-    @patch('app.subscriber.send_message_to_rabbitmq')
-    def test_receipt_to_case_missing_json_data(self, mock_send_message_to_rabbit_mq):
+    @patch('app.subscriber.publish_message')
+    def test_receipt_to_case_missing_json_data(self, mock_publish_message):
         mock_message = MagicMock()
         mock_message.message_id = str(uuid.uuid4())
         mock_message.attributes = {'eventType': 'OBJECT_FINALIZE',
@@ -453,16 +575,16 @@ class TestSubscriber(TestCase):
             'message_id': mock_message.message_id,
         }
 
-        from app.subscriber import eq_receipt_to_case
+        from app.subscriber import process_message
 
         with self.checkExpectedLogLine('ERROR', expected_log_event, expected_log_kwargs):
-            eq_receipt_to_case(mock_message)
+            process_message(self.subscriptions['eq_receipt'], mock_message)
 
-        mock_send_message_to_rabbit_mq.assert_not_called()
+        mock_publish_message.assert_not_called()
         mock_message.ack.assert_not_called()
 
-    @patch('app.subscriber.send_message_to_rabbitmq')
-    def test_receipt_to_case_missing_json_metadata(self, mock_send_message_to_rabbit_mq):
+    @patch('app.subscriber.publish_message')
+    def test_receipt_to_case_missing_json_metadata(self, mock_publish_message):
         mock_message = MagicMock()
         mock_message.message_id = str(uuid.uuid4())
         mock_message.attributes = {'eventType': 'OBJECT_FINALIZE',
@@ -480,16 +602,16 @@ class TestSubscriber(TestCase):
             'missing_json_key': 'metadata',
         }
 
-        from app.subscriber import eq_receipt_to_case
+        from app.subscriber import process_message
 
         with self.checkExpectedLogLine('ERROR', expected_log_event, expected_log_kwargs):
-            eq_receipt_to_case(mock_message)
+            process_message(self.subscriptions['eq_receipt'], mock_message)
 
-        mock_send_message_to_rabbit_mq.assert_not_called()
+        mock_publish_message.assert_not_called()
         mock_message.ack.assert_not_called()
 
-    @patch('app.subscriber.send_message_to_rabbitmq')
-    def test_receipt_to_case_missing_json_metadata_questionnaire_id(self, mock_send_message_to_rabbit_mq):
+    @patch('app.subscriber.publish_message')
+    def test_receipt_to_case_missing_json_metadata_questionnaire_id(self, mock_publish_message):
         mock_message = MagicMock()
         mock_message.message_id = str(uuid.uuid4())
         mock_message.attributes = {'eventType': 'OBJECT_FINALIZE',
@@ -507,16 +629,16 @@ class TestSubscriber(TestCase):
             'missing_json_key': 'questionnaire_id',
         }
 
-        from app.subscriber import eq_receipt_to_case
+        from app.subscriber import process_message
 
         with self.checkExpectedLogLine('ERROR', expected_log_event, expected_log_kwargs):
-            eq_receipt_to_case(mock_message)
+            process_message(self.subscriptions['eq_receipt'], mock_message)
 
-        mock_send_message_to_rabbit_mq.assert_not_called()
+        mock_publish_message.assert_not_called()
         mock_message.ack.assert_not_called()
 
-    @patch('app.subscriber.send_message_to_rabbitmq')
-    def test_receipt_to_case_missing_json_metadata_tx_id(self, mock_send_message_to_rabbit_mq):
+    @patch('app.subscriber.publish_message')
+    def test_receipt_to_case_missing_json_metadata_tx_id(self, mock_publish_message):
         mock_message = MagicMock()
         mock_message.message_id = str(uuid.uuid4())
         mock_message.attributes = {'eventType': 'OBJECT_FINALIZE',
@@ -534,16 +656,16 @@ class TestSubscriber(TestCase):
             'missing_json_key': 'tx_id',
         }
 
-        from app.subscriber import eq_receipt_to_case
+        from app.subscriber import process_message
 
         with self.checkExpectedLogLine('ERROR', expected_log_event, expected_log_kwargs):
-            eq_receipt_to_case(mock_message)
+            process_message(self.subscriptions['eq_receipt'], mock_message)
 
-        mock_send_message_to_rabbit_mq.assert_not_called()
+        mock_publish_message.assert_not_called()
         mock_message.ack.assert_not_called()
 
-    @patch('app.subscriber.send_message_to_rabbitmq')
-    def test_receipt_to_case_missing_json_metadata_timeCreated(self, mock_send_message_to_rabbit_mq):
+    @patch('app.subscriber.publish_message')
+    def test_receipt_to_case_missing_json_metadata_timeCreated(self, mock_publish_message):
         mock_message = MagicMock()
         mock_message.message_id = str(uuid.uuid4())
         mock_message.attributes = {'eventType': 'OBJECT_FINALIZE',
@@ -561,16 +683,16 @@ class TestSubscriber(TestCase):
             'missing_json_key': 'timeCreated',
         }
 
-        from app.subscriber import eq_receipt_to_case
+        from app.subscriber import process_message
 
         with self.checkExpectedLogLine('ERROR', expected_log_event, expected_log_kwargs):
-            eq_receipt_to_case(mock_message)
+            process_message(self.subscriptions['eq_receipt'], mock_message)
 
-        mock_send_message_to_rabbit_mq.assert_not_called()
+        mock_publish_message.assert_not_called()
         mock_message.ack.assert_not_called()
 
-    @patch('app.subscriber.send_message_to_rabbitmq')
-    def test_receipt_to_case_timeCreated_valueerror(self, mock_send_message_to_rabbit_mq):
+    @patch('app.subscriber.publish_message')
+    def test_receipt_to_case_timeCreated_valueerror(self, mock_publish_message):
         mock_message = MagicMock()
         mock_message.message_id = str(uuid.uuid4())
         mock_message.attributes = {'eventType': 'OBJECT_FINALIZE',
@@ -588,16 +710,16 @@ class TestSubscriber(TestCase):
             'message_id': mock_message.message_id,
         }
 
-        from app.subscriber import eq_receipt_to_case
+        from app.subscriber import process_message
 
         with self.checkExpectedLogLine('ERROR', expected_log_event, expected_log_kwargs):
-            eq_receipt_to_case(mock_message)
+            process_message(self.subscriptions['eq_receipt'], mock_message)
 
-        mock_send_message_to_rabbit_mq.assert_not_called()
+        mock_publish_message.assert_not_called()
         mock_message.ack.assert_not_called()
 
-    @patch('app.subscriber.send_message_to_rabbitmq')
-    def test_offline_receipt_to_case_dateTime_valueerror(self, mock_send_message_to_rabbit_mq):
+    @patch('app.subscriber.publish_message')
+    def test_offline_receipt_to_case_dateTime_valueerror(self, mock_publish_message):
         mock_message = MagicMock()
         mock_message.data = json.dumps(
             {"transactionId": "1", "questionnaireId": self.questionnaire_id, "dateTime": "I am a garbage dateTime",
@@ -611,16 +733,16 @@ class TestSubscriber(TestCase):
             'message_id': mock_message.message_id,
         }
 
-        from app.subscriber import offline_receipt_to_case
+        from app.subscriber import process_message
 
         with self.checkExpectedLogLine('ERROR', expected_log_event, expected_log_kwargs):
-            offline_receipt_to_case(mock_message)
+            process_message(self.subscriptions['offline_receipt'], mock_message)
 
-        mock_send_message_to_rabbit_mq.assert_not_called()
+        mock_publish_message.assert_not_called()
         mock_message.ack.assert_not_called()
 
-    @patch('app.subscriber.send_message_to_rabbitmq')
-    def test_offline_receipt_to_case_missing_json_data(self, mock_send_message_to_rabbit_mq):
+    @patch('app.subscriber.publish_message')
+    def test_offline_receipt_to_case_missing_json_data(self, mock_publish_message):
         mock_message = MagicMock()
         mock_message.message_id = str(uuid.uuid4())
         mock_message.data = None
@@ -632,16 +754,16 @@ class TestSubscriber(TestCase):
             'message_id': mock_message.message_id,
         }
 
-        from app.subscriber import offline_receipt_to_case
+        from app.subscriber import process_message
 
         with self.checkExpectedLogLine('ERROR', expected_log_event, expected_log_kwargs):
-            offline_receipt_to_case(mock_message)
+            process_message(self.subscriptions['offline_receipt'], mock_message)
 
-        mock_send_message_to_rabbit_mq.assert_not_called()
+        mock_publish_message.assert_not_called()
         mock_message.ack.assert_not_called()
 
-    @patch('app.subscriber.send_message_to_rabbitmq')
-    def test_offline_receipt_to_case_dateTime_missing(self, mock_send_message_to_rabbit_mq):
+    @patch('app.subscriber.publish_message')
+    def test_offline_receipt_to_case_dateTime_missing(self, mock_publish_message):
         mock_message = MagicMock()
         mock_message.data = json.dumps(
             {"transactionId": "1", "questionnaireId": self.questionnaire_id, "channel": "PQRS"})
@@ -656,10 +778,157 @@ class TestSubscriber(TestCase):
 
         }
 
-        from app.subscriber import offline_receipt_to_case
+        from app.subscriber import process_message
 
         with self.checkExpectedLogLine('ERROR', expected_log_event, expected_log_kwargs):
-            offline_receipt_to_case(mock_message)
+            process_message(self.subscriptions['offline_receipt'], mock_message)
 
-        mock_send_message_to_rabbit_mq.assert_not_called()
+        mock_publish_message.assert_not_called()
         mock_message.ack.assert_not_called()
+
+    def pulled_offline_receipt(self, ack_id, transaction_id, valid=True):
+        data = json.dumps({'transactionId': transaction_id, 'questionnaireId': self.questionnaire_id,
+                           'channel': 'PQRS', 'dateTime': self.created_offline_spec}).encode() if valid else b'bad'
+        return SimpleNamespace(ack_id=ack_id, message=SimpleNamespace(message_id=str(uuid.uuid4()), data=data,
+                                                                      attributes={}))
+
+    def test_pulled_batch_is_acknowledged_in_one_request(self):
+        from app.subscriber import pull_batch
+
+        def confirm_publish(message, _body, routing_key=None, subscription_name=None, timer=None):
+            if message.ack_id == 'rejected':
+                message.nack()
+            else:
+                message.ack()
+
+        mock_client = MagicMock()
+        mock_client.pull.return_value = SimpleNamespace(received_messages=[
+            self.pulled_offline_receipt('confirmed', 'tx-confirmed'),
+            self.pulled_offline_receipt('rejected', 'tx-rejected'),
+            self.pulled_offline_receipt('invalid', 'tx-invalid', valid=False),
+        ])
+
+        with patch('app.subscriber.client', mock_client), \
+                patch('app.subscriber.publish_message', side_effect=confirm_publish) as mock_publish_message, \
+                patch('app.quarantine.quarantine_store', None):
+            batch = pull_batch(self.subscriptions['offline_receipt'], self.subscription_path, batch_size=3)
+
+        mock_client.pull.assert_called_once_with(subscription=self.subscription_path, max_messages=3, timeout=ANY)
+        assert mock_publish_message.call_count == 2
+        mock_client.acknowledge.assert_called_once_with(subscription=self.subscription_path, ack_ids=['confirmed'])
+        mock_client.modify_ack_deadline.assert_called_once_with(subscription=self.subscription_path,
+                                                                ack_ids=['rejected'], ack_deadline_seconds=0)
+        assert batch.size == 3
+
+    def test_pulled_batch_waits_for_publishes_to_be_confirmed(self):
+        from app.subscriber import pull_batch
+
+        mock_client = MagicMock()
+        mock_client.pull.return_value = SimpleNamespace(received_messages=[
+            self.pulled_offline_receipt('1', 'tx-1'), self.pulled_offline_receipt('2', 'tx-2')])
+        published = []
+
+        def confirm_later(message, _body, routing_key=None, subscription_name=None, timer=None):
+            published.append(message)
+            if len(published) == 2:
+                for message in published:
+                    threading.Timer(0.05, message.ack).start()
+
+        with patch('app.subscriber.client', mock_client), \
+                patch('app.subscriber.publish_message', side_effect=confirm_later):
+            pull_batch(self.subscriptions['offline_receipt'], self.subscription_path)
+
+        mock_client.acknowledge.assert_called_once_with(subscription=self.subscription_path, ack_ids=ANY)
+        assert sorted(mock_client.acknowledge.call_args[1]['ack_ids']) == ['1', '2']
+
+    def test_ack_deadlines_are_extended_while_waiting_for_confirms(self):
+        from app.subscriber import PULL_ACK_DEADLINE, pull_batch
+
+        mock_client = MagicMock()
+        mock_client.pull.return_value = SimpleNamespace(received_messages=[self.pulled_offline_receipt('1', 'tx-1')])
+
+        def confirm_later(message, _body, routing_key=None, subscription_name=None, timer=None):
+            threading.Timer(0.2, message.ack).start()
+
+        with patch('app.subscriber.client', mock_client), \
+                patch('app.subscriber.publish_message', side_effect=confirm_later), \
+                patch('app.subscriber.MIN_ACK_DEADLINE', 0.1), patch('app.subscriber.LEASE_RENEWAL_MARGIN', 0.05):
+            pull_batch(self.subscriptions['offline_receipt'], self.subscription_path)
+
+        mock_client.modify_ack_deadline.assert_called_once_with(subscription=self.subscription_path, ack_ids=['1'],
+                                                                ack_deadline_seconds=PULL_ACK_DEADLINE)
+        mock_client.acknowledge.assert_called_once_with(subscription=self.subscription_path, ack_ids=['1'])
+
+    def test_quarantine_publishes_are_leased_until_confirmed(self):
+        from app.quarantine import quarantine_message
+        from app.subscriber import PULL_ACK_DEADLINE, pull_batch
+
+        mock_client = MagicMock()
+        mock_client.pull.return_value = SimpleNamespace(received_messages=[
+            self.pulled_offline_receipt('invalid', 'tx-invalid', valid=False)])
+
+        def confirm_later(message, _body, routing_key=None, subscription_name=None, timer=None):
+            threading.Timer(0.2, message.ack).start()
+
+        with patch('app.subscriber.client', mock_client), \
+                patch('app.subscriber.quarantine_message', partial(quarantine_message, routing_key='quarantine')), \
+                patch('app.quarantine.publish_message', side_effect=confirm_later), \
+                patch('app.subscriber.MIN_ACK_DEADLINE', 0.1), patch('app.subscriber.LEASE_RENEWAL_MARGIN', 0.05):
+            batch = pull_batch(self.subscriptions['offline_receipt'], self.subscription_path)
+
+        assert batch.quarantined == ['invalid']
+        mock_client.modify_ack_deadline.assert_called_once_with(subscription=self.subscription_path,
+                                                                ack_ids=['invalid'],
+                                                                ack_deadline_seconds=PULL_ACK_DEADLINE)
+        mock_client.acknowledge.assert_called_once_with(subscription=self.subscription_path, ack_ids=['invalid'])
+
+    def test_batch_pulling_retries_failed_requests(self):
+        from google.api_core.exceptions import ServiceUnavailable
+        from app.subscriber import _pull_batches
+
+        stopped = threading.Event()
+        mock_client = MagicMock()
+
+        def pull(**_kwargs):
+            if mock_client.pull.call_count == 2:
+                stopped.set()
+                return SimpleNamespace(received_messages=[])
+            raise ServiceUnavailable('Try again')
+
+        mock_client.pull.side_effect = pull
+
+        with patch('app.subscriber.client', mock_client), patch('app.subscriber.PULL_RETRY_DELAY', 0.01):
+            _pull_batches(self.subscriptions['offline_receipt'], self.subscription_path, 10, stopped)
+
+        assert mock_client.pull.call_count == 2
+
+    def test_empty_pull_acknowledges_nothing(self):
+        from google.api_core.exceptions import DeadlineExceeded
+        from app.subscriber import pull_batch
+
+        mock_client = MagicMock()
+        mock_client.pull.side_effect = DeadlineExceeded('No messages')
+
+        with patch('app.subscriber.client', mock_client):
+            batch = pull_batch(self.subscriptions['offline_receipt'], self.subscription_path)
+
+        assert batch.size == 0
+        mock_client.acknowledge.assert_not_called()
+
+    def test_batch_subscription_pulls_on_each_thread_until_stopped(self):
+        from app.subscriber import setup_batch_subscription
+
+        stopped = threading.Event()
+        mock_client = MagicMock()
+        mock_client.subscription_path.return_value = self.subscription_path
+        mock_client.pull.return_value = SimpleNamespace(received_messages=[])
+
+        with patch('app.subscriber.client', mock_client):
+            futures = setup_batch_subscription(self.subscriptions['offline_receipt'], batch_size=10,
+                                               concurrent_batches=2, stopped=stopped)
+            stopped.set()
+            for future in futures:
+                future.result(timeout=5)
+
+        assert len(futures) == 2
+        mock_client.pull.assert_called_with(subscription=self.subscription_path, max_messages=10, timeout=ANY)
@@ -0,0 +1,81 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from google.cloud.pubsub_v1.types import FlowControl
+from pytest import raises
+
+from app.subscription_config import load_subscriptions
+
+
+class SubscriptionConfigTestCase(TestCase):
+
+    def write_config(self, config):
+        config_file = tempfile.NamedTemporaryFile('w', suffix='.json')
+        self.addCleanup(config_file.close)
+        json.dump(config, config_file)
+        config_file.flush()
+        return config_file.name
+
+    def test_built_in_subscriptions_are_loaded_by_default(self):
+        subscriptions = load_subscriptions(config_file=None, enabled=None)
+
+        assert list(subscriptions) == ['eq_receipt', 'offline_receipt', 'ppo_undelivered', 'qm_undelivered']
+        assert subscriptions['ppo_undelivered'].translator == 'ppo_undelivered_mail'
+        assert subscriptions['ppo_undelivered'].routing_key == 'event.fulfilment.undelivered'
+        assert subscriptions['eq_receipt'].flow_control == FlowControl()
+        assert subscriptions['eq_receipt'].executor_threads == 10
+
+    def test_built_in_subscription_names_come_from_environment(self):
+        with patch.dict(os.environ, {'OFFLINE_SUBSCRIPTION_NAME': 'env-offline-subscription',
+                                     'OFFLINE_SUBSCRIPTION_PROJECT_ID': 'env-offline-project'}):
+            subscription = load_subscriptions(config_file=None, enabled=None)['offline_receipt']
+
+        assert subscription.subscription_name == 'env-offline-subscription'
+        assert subscription.subscription_project_id == 'env-offline-project'
+
+    def test_only_enabled_subscriptions_are_loaded(self):
+        subscriptions = load_subscriptions(config_file=None, enabled='qm_undelivered, eq_receipt')
+
+        assert list(subscriptions) == ['qm_undelivered', 'eq_receipt']
+
+    def test_unknown_enabled_subscription_is_rejected(self):
+        with raises(ValueError):
+            load_subscriptions(config_file=None, enabled='eq_receipt,not_a_subscription')
+
+    def test_unknown_translator_is_rejected(self):
+        config_file = self.write_config({'eq_receipt': {'translator': 'eq_reciept'}})
+
+        with raises(ValueError, match="'eq_reciept' for subscription eq_receipt"):
+            load_subscriptions(config_file=config_file, enabled=None)
+
+    def test_config_file_overrides_and_declares_subscriptions(self):
+        config_file = self.write_config({
+            'eq_receipt': {'max_messages': 500, 'executor_threads': 20},
+            'eq_receipt_backlog': {'subscription_name': 'rm-receipt-backlog-subscription',
+                                   'subscription_project_id': 'backlog-project',
+                                   'translator': 'eq_receipt',
+                                   'max_lease_duration': 600}})
+
+        subscriptions = load_subscriptions(config_file=config_file, enabled=None)
+
+        assert subscriptions['eq_receipt'].flow_control.max_messages == 500
+        assert subscriptions['eq_receipt'].executor_threads == 20
+        backlog = subscriptions['eq_receipt_backlog']
+        assert backlog.subscription_name == 'rm-receipt-backlog-subscription'
+        assert backlog.translator == 'eq_receipt'
+        assert backlog.flow_control.max_lease_duration == 600
+        assert backlog.log_level == 'info'
+
+    def test_environment_overrides_config_file(self):
+        config_file = self.write_config({'qm_undelivered': {'max_messages': 50, 'max_bytes': 2048}})
+
+        with patch.dict(os.environ, {'QM_UNDELIVERED_SUBSCRIPTION_MAX_BYTES': '4096',
+                                     'QM_UNDELIVERED_SUBSCRIPTION_EXECUTOR_THREADS': '2'}):
+            subscription = load_subscriptions(config_file=config_file, enabled=None)['qm_undelivered']
+
+        assert subscription.flow_control.max_messages == 50
+        assert subscription.flow_control.max_bytes == 4096
+        assert subscription.executor_threads == 2
@@ -0,0 +1,81 @@
+import os
+import shutil
+import signal
+import tempfile
+import threading
+from time import monotonic, sleep
+from unittest import TestCase
+
+from app import metrics
+from app.supervisor import WORKER_RESTARTS, Supervisor, worker_readiness_file
+
+WORKER_MESSAGES = metrics.Counter('test_worker_messages_total', 'Messages handled by a test worker')
+
+
+def worker_main():
+    WORKER_MESSAGES.labels().inc()
+    assert os.environ['WORKER_PROCESSES'] == '1'
+    open(os.environ['READINESS_FILE_PATH'], 'w').close()
+    sleep(60)
+
+
+def wait_for(condition, timeout=30):
+    deadline = monotonic() + timeout
+    while not condition():
+        if monotonic() > deadline:
+            raise AssertionError('Timed out waiting for condition')
+        sleep(0.05)
+
+
+class SupervisorTestCase(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.readiness_file = os.path.join(self.directory, 'pubsub-ready')
+        self.supervisor = Supervisor(worker_main, 2, self.readiness_file, restart_delay=0, metrics_interval=0.05)
+        self.thread = threading.Thread(target=self.supervisor.run, kwargs={'check_interval': 0.05})
+        self.thread.start()
+
+    def tearDown(self):
+        self.supervisor.stop()
+        self.thread.join(60)
+        shutil.rmtree(self.directory)
+
+    def test_readiness_file_is_present_once_every_worker_is_ready(self):
+        wait_for(lambda: os.path.exists(self.readiness_file))
+
+        assert all(os.path.exists(worker_readiness_file(self.readiness_file, index)) for index in range(2))
+
+    def test_worker_metrics_are_combined(self):
+        wait_for(lambda: 'test_worker_messages_total 2.0' in self.supervisor.render_metrics())
+
+        assert self.supervisor.render_metrics().count('# TYPE test_worker_messages_total counter') == 1
+
+    def test_crashed_worker_is_restarted(self):
+        restarts_before = WORKER_RESTARTS.labels().get()
+        wait_for(lambda: os.path.exists(self.readiness_file))
+        crashed = self.supervisor._workers[0]
+
+        os.kill(crashed.pid, signal.SIGKILL)
+
+        wait_for(lambda: self.supervisor._workers[0] is not crashed and self.supervisor._workers[0].is_alive())
+        assert WORKER_RESTARTS.labels().get() == restarts_before + 1
+        wait_for(lambda: os.path.exists(self.readiness_file))
+
+    def test_restarted_worker_metrics_are_kept(self):
+        wait_for(lambda: 'test_worker_messages_total 2.0' in self.supervisor.render_metrics())
+        crashed = self.supervisor._workers[0]
+
+        os.kill(crashed.pid, signal.SIGKILL)
+
+        wait_for(lambda: self.supervisor._workers[0] is not crashed)
+        wait_for(lambda: 'test_worker_messages_total 3.0' in self.supervisor.render_metrics())
+
+    def test_readiness_file_is_removed_when_stopped(self):
+        wait_for(lambda: os.path.exists(self.readiness_file))
+
+        self.supervisor.stop()
+        self.thread.join(60)
+
+        assert not os.path.exists(self.readiness_file)
+        assert not any(worker.is_alive() for worker in self.supervisor._workers)